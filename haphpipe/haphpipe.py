@@ -18,8 +18,12 @@
 
 
 from __future__ import absolute_import
+from __future__ import print_function
 import sys
+import os
 import argparse
+import importlib
+from collections import OrderedDict
 
 from haphpipe.utils import sysutils
 from haphpipe.utils.sysutils import ArgumentDefaultsHelpFormatterSkipNone as HF
@@ -27,35 +31,63 @@ from haphpipe.utils.sysutils import MissingRequiredArgument
 
 from haphpipe._version import VERSION
 
-# Reads stages
-from haphpipe.stages import sample_reads
-from haphpipe.stages import trim_reads
-from haphpipe.stages import join_reads
-from haphpipe.stages import ec_reads
-# Assemble stages
-from haphpipe.stages import assemble_denovo
-from haphpipe.stages import assemble_amplicons
-from haphpipe.stages import assemble_scaffold
-from haphpipe.stages import align_reads
-from haphpipe.stages import call_variants
-from haphpipe.stages import vcf_to_consensus
-from haphpipe.stages import refine_assembly
-from haphpipe.stages import finalize_assembly
-# Haplotype stages
-from haphpipe.stages import predict_haplo
-from haphpipe.stages import ph_parser
-from haphpipe.stages import cliquesnv
-# Annotate stages
-from haphpipe.stages import pairwise_align
-from haphpipe.stages import extract_pairwise
-from haphpipe.stages import annotate_from_ref
-from haphpipe.stages import summary_stats
-# Phylo stages
-from haphpipe.stages import multiple_align
-from haphpipe.stages import model_test
-from haphpipe.stages import build_tree_NG
-# Miscellaneous
-from haphpipe.stages import demo
+
+""" Module implementing each subcommand. A stage module is only imported, and
+    its parser only built, when its subcommand is chosen. This way a call to
+    a small stage does not pay for importing every other stage (and with
+    them Biopython, yaml, etc.).
+"""
+STAGES = OrderedDict([
+    # Reads stages
+    ('sample_reads', 'haphpipe.stages.sample_reads'),
+    ('trim_reads', 'haphpipe.stages.trim_reads'),
+    ('join_reads', 'haphpipe.stages.join_reads'),
+    ('ec_reads', 'haphpipe.stages.ec_reads'),
+    ('collapse_reads', 'haphpipe.stages.collapse_reads'),
+    ('normalize_reads', 'haphpipe.stages.normalize_reads'),
+    ('bin_reads', 'haphpipe.stages.bin_reads'),
+    # Assemble stages
+    ('assemble_denovo', 'haphpipe.stages.assemble_denovo'),
+    ('assemble_amplicons', 'haphpipe.stages.assemble_amplicons'),
+    ('assemble_scaffold', 'haphpipe.stages.assemble_scaffold'),
+    ('align_reads', 'haphpipe.stages.align_reads'),
+    ('call_variants', 'haphpipe.stages.call_variants'),
+    ('vcf_to_consensus', 'haphpipe.stages.vcf_to_consensus'),
+    ('refine_assembly', 'haphpipe.stages.refine_assembly'),
+    ('finalize_assembly', 'haphpipe.stages.finalize_assembly'),
+    # Haplotype stages
+    ('predict_haplo', 'haphpipe.stages.predict_haplo'),
+    ('ph_parser', 'haphpipe.stages.ph_parser'),
+    ('cliquesnv', 'haphpipe.stages.cliquesnv'),
+    # Annotate stages
+    ('pairwise_align', 'haphpipe.stages.pairwise_align'),
+    ('extract_pairwise', 'haphpipe.stages.extract_pairwise'),
+    ('annotate_from_ref', 'haphpipe.stages.annotate_from_ref'),
+    ('summary_stats', 'haphpipe.stages.summary_stats'),
+    # Phylo stages
+    ('multiple_align', 'haphpipe.stages.multiple_align'),
+    ('model_test', 'haphpipe.stages.model_test'),
+    ('build_tree_NG', 'haphpipe.stages.build_tree_NG'),
+    # Pipelines
+    ('run', 'haphpipe.stages.run'),
+    ('batch', 'haphpipe.stages.batch'),
+    # Miscellaneous
+    ('demo', 'haphpipe.stages.demo'),
+    ('trace_report', 'haphpipe.stages.trace_report'),
+    ('serve', 'haphpipe.stages.serve'),
+])
+
+""" Subcommands that use the stage cache when HAPHPIPE_CACHE_DIR is set. These
+    are single stages whose outputs depend only on their arguments and input
+    files. Pipelines are not cached as a whole: "run" and "batch" cache each
+    stage with --cache_dir.
+"""
+CACHED_STAGES = [
+    'sample_reads', 'trim_reads', 'join_reads', 'ec_reads', 'collapse_reads',
+    'normalize_reads', 'bin_reads', 'assemble_denovo', 'assemble_amplicons',
+    'assemble_scaffold', 'align_reads', 'call_variants', 'vcf_to_consensus',
+    'refine_assembly', 'finalize_assembly', 'pairwise_align',
+]
 
 
 BASE_USAGE = '''
@@ -64,10 +96,13 @@ Version: %(version)s
 
 Commands:
  -- Reads
-    sample_reads             subsample reads using seqtk
+    sample_reads             subsample reads
     trim_reads               trim reads using Trimmomatic
     join_reads               join reads using FLASh
     ec_reads                 error correct reads using SPAdes
+    collapse_reads           collapse duplicate reads
+    normalize_reads          normalize read coverage
+    bin_reads                bin reads by amplicon
 
  -- Assemble
     assemble_denovo          assemble reads denovo
@@ -94,8 +129,14 @@ Commands:
     model_test               tests for model of evolution using ModelTest
     build_tree_NG            builds phylogenetic tree with RAxML-NG
 
+ -- Pipelines
+    run                      run an assembly pipeline as a stage graph
+    batch                    run an assembly pipeline for many samples
+
  -- Miscellaneous
     demo                     setup demo directory and test data
+    trace_report             summarize resource usage trace
+    serve                    run Python stages in a worker daemon
 '''
 
 
@@ -118,108 +159,86 @@ class _BaseHelpAction(argparse.Action):
         parser.exit()
 
 
-def console():
+def build_parser(cmd=None):
+    """ Build the argument parser
+
+    Every subcommand is registered, but only the parser for "cmd" has its
+    options added.
+
+    Args:
+        cmd (str): Name of chosen subcommand
+
+    Returns:
+        parser (argparse.ArgumentParser): Top-level parser
+        sub (argparse._SubParsersAction): Subparsers
+
+    """
     parser = argparse.ArgumentParser(formatter_class=HF, add_help=False)
     parser.add_argument('-h', '--help', action=_BaseHelpAction)
 
-    # Exit with help if no args were given
-    if len(sys.argv) == 1:
-        parser.parse_args(['-h'])
-
     # Subparsers
     sub = parser.add_subparsers()
+    for name, modname in STAGES.items():
+        stage_parser = sub.add_parser(name, formatter_class=HF)
+        if name == cmd:
+            importlib.import_module(modname).stageparser(stage_parser)
 
-    # Reads stages
-    sample_reads.stageparser(
-        sub.add_parser('sample_reads', formatter_class=HF)
-    )
-    trim_reads.stageparser(
-        sub.add_parser('trim_reads', formatter_class=HF)
-    )
-    join_reads.stageparser(
-        sub.add_parser('join_reads', formatter_class=HF)
-    )
-    ec_reads.stageparser(
-        sub.add_parser('ec_reads', formatter_class=HF)
-    )
+    return parser, sub
 
-    # Assemble stages
-    assemble_denovo.stageparser(
-        sub.add_parser('assemble_denovo', formatter_class=HF)
-    )
-    assemble_amplicons.stageparser(
-        sub.add_parser('assemble_amplicons', formatter_class=HF)
-    )
-    assemble_scaffold.stageparser(
-        sub.add_parser('assemble_scaffold', formatter_class=HF)
-    )
-    align_reads.stageparser(
-        sub.add_parser('align_reads', formatter_class=HF)
-    )
-    call_variants.stageparser(
-        sub.add_parser('call_variants', formatter_class=HF)
-    )
-    vcf_to_consensus.stageparser(
-        sub.add_parser('vcf_to_consensus', formatter_class=HF)
-    )
-    refine_assembly.stageparser(
-        sub.add_parser('refine_assembly', formatter_class=HF)
-    )
-    finalize_assembly.stageparser(
-        sub.add_parser('finalize_assembly', formatter_class=HF)
-    )
-
-    # Haplotype
-    predict_haplo.stageparser(
-        sub.add_parser('predict_haplo', formatter_class=HF)
-    )
-    ph_parser.stageparser(
-        sub.add_parser('ph_parser', formatter_class=HF)
-    )
-    cliquesnv.stageparser(
-        sub.add_parser('cliquesnv', formatter_class=HF)
-    )
-
-    # Annotate/Description stages
-    pairwise_align.stageparser(
-        sub.add_parser('pairwise_align', formatter_class=HF)
-    )
-    extract_pairwise.stageparser(
-        sub.add_parser('extract_pairwise', formatter_class=HF)
-    )
-    annotate_from_ref.stageparser(
-        sub.add_parser('annotate_from_ref', formatter_class=HF)
-    )
-    summary_stats.stageparser(
-        sub.add_parser('summary_stats', formatter_class=HF)
-    )
-    # post_assembly.stageparser(
-    #     sub.add_parser('post_assembly', formatter_class=HF)
-    # )
-
-    # Phylo
-    multiple_align.stageparser(
-        sub.add_parser('multiple_align', formatter_class=HF)
-    )
-    model_test.stageparser(
-        sub.add_parser('model_test', formatter_class=HF)
-    )
-    build_tree_NG.stageparser(
-        sub.add_parser('build_tree_NG', formatter_class=HF)
-    )
 
-    # Miscellaneous
-    demo.stageparser(
-        sub.add_parser('demo', formatter_class=HF)
-    )
+def dispatch(argv):
+    """ Parse arguments and run the chosen stage
+
+    Args:
+        argv (list): Command line arguments, starting with stage name
+
+    Returns:
+        None
+
+    """
+    cmd = argv[0] if argv else None
+    parser, sub = build_parser(cmd)
+
+    # Exit with help if no args were given
+    if cmd is None:
+        parser.parse_args(['-h'])
+
+    args = parser.parse_args(argv)
+
+    # Reuse stage results if a cache directory is configured
+    if os.environ.get('HAPHPIPE_CACHE_DIR') and cmd in CACHED_STAGES:
+        from haphpipe.utils import stagecache
+        args.func = stagecache.CachedStage(
+            args.func, stagecache.cache_from_env()
+        )
 
-    args = parser.parse_args()
     try:
-        args.func(**sysutils.args_params(args))
+        if os.environ.get('HAPHPIPE_TRACE'):
+            # Record resource usage of the stage
+            from haphpipe.utils import telemetry
+            params = sysutils.args_params(args)
+            with telemetry.context(sample=params.get('sample_id')), \
+                    telemetry.span('stage', cmd):
+                args.func(**params)
+        else:
+            args.func(**sysutils.args_params(args))
     except MissingRequiredArgument as e:
-        sub._name_parser_map[sys.argv[1]].print_usage()
+        sub._name_parser_map[cmd].print_usage()
         print('error: %s' % e, file=sys.stderr)
 
 
+def console():
+    argv = sys.argv[1:]
+
+    # Python stages are sent to "haphpipe serve" if HAPHPIPE_SERVE is set
+    if os.environ.get('HAPHPIPE_SERVE'):
+        from haphpipe.utils import daemon
+        status = daemon.submit(argv)
+        if status is not None:
+            sys.exit(status)
+
+    dispatch(argv)
+
+
 if __name__ == '__main__':
     console()
@@ -5,9 +5,18 @@ from __future__ import print_function
 import sys
 import os
 import argparse
+import shlex
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 from haphpipe.utils import helpers
 from haphpipe.utils import sysutils
+from haphpipe.utils import resources
+from haphpipe.utils import refindex
+from haphpipe.utils import markdup
+from haphpipe.stages import trim_reads
 from haphpipe.utils.sysutils import MissingRequiredArgument
 from haphpipe.utils.sysutils import PipelineStepError
 
@@ -70,30 +79,201 @@ def stageparser(parser):
     group2.add_argument('--encoding',
                         choices=['Phred+33', 'Phred+64'],
                         help='Quality score encoding')
-
-    group3 = parser.add_argument_group('Settings')
-    group3.add_argument('--ncpu', type=int, default=1,
+    group2.add_argument('--markdup_backend', choices=markdup.BACKENDS,
+                        default=markdup.BACKENDS[0],
+                        help='''Tool used to mark duplicates. "samtools"
+                                marks duplicates while alignments are
+                                sorted (fixmate | sort | markdup), without
+                                a JVM or a separate pass over the BAM.''')
+
+    group3 = parser.add_argument_group('Streaming trimming options')
+    group3.add_argument('--trim', action='store_true',
+                        help='''Trim reads with Trimmomatic (see trim_reads)
+                                while aligning. Trimmed reads are streamed to
+                                bowtie2 through named pipes and are not
+                                written to disk.''')
+    group3.add_argument('--adapter_file',
+                        help='Adapter file for trimming')
+    group3.add_argument('--keep_trimmed', action='store_true',
+                        help='''Also write trimmed reads to output directory
+                                (trimmed_1.fastq, trimmed_2.fastq,
+                                trimmed_U.fastq)''')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write kept trimmed reads gzip-compressed')
+
+    group5 = parser.add_argument_group('Sharding options')
+    group5.add_argument('--shards', type=int, default=1,
+                        help='''Split reads into this many shards, aligned
+                                by separate bowtie2 processes at the same
+                                time, and merge the sorted alignments.''')
+    group5.add_argument('--shard_launcher',
+                        help='''Command prefix used to run each shard, for
+                                example "srun -N1 -n1 -c {ncpu}" to run
+                                shards on other nodes. "{ncpu}" and
+                                "{shard}" are replaced by the CPUs of each
+                                shard and the shard number. The temporary
+                                directory is then created in the output
+                                directory, which must be shared by the
+                                nodes, as must the reference index
+                                cache.''')
+
+    group4 = parser.add_argument_group('Settings')
+    group4.add_argument('--ncpu', type=int, default=1,
                         help='Number of CPUs to use')
-    group3.add_argument('--xmx', type=int,
-                        default=sysutils.get_java_heap_size(),
-                        help='Maximum heap size for Java VM, in GB.')
-    group3.add_argument('--keep_tmp', action='store_true',
+    group4.add_argument('--xmx', type=int,
+                        help='''Maximum heap size for Java VM, in GB. By
+                                default, determined from input sizes, the
+                                memory limit (including cgroup limits) and
+                                other running JVMs.''')
+    group4.add_argument('--keep_tmp', action='store_true',
                         help='Do not delete temporary directory')
-    group3.add_argument('--quiet', action='store_true',
+    group4.add_argument('--quiet', action='store_true',
                         help='''Do not write output to console
                                 (silence stdout and stderr)''')
-    group3.add_argument('--logfile', type=argparse.FileType('a'),
+    group4.add_argument('--logfile', type=argparse.FileType('a'),
                         help='Append console output to this file')
-    group3.add_argument('--debug', action='store_true',
+    group4.add_argument('--debug', action='store_true',
                         help='Print commands but do not run')
     parser.set_defaults(func=align_reads)
 
 
+def bowtie2_sort_cmd(reads, bt2_index, encoding, sample_id, bt2_preset,
+                     bt2_out, out_bam, sort_prefix, ncpu=1, fixmate=False,
+                     markdup_stats=None, remove_duplicates=False):
+    """ bowtie2 command piped into samtools sort
+
+    Alignments are sorted as they are produced, without an unsorted SAM.
+    Mate tags needed by samtools markdup are added before sorting with
+    fixmate, and duplicates are marked after sorting with markdup_stats.
+
+    Args:
+        reads (list): bowtie2 options with the input reads
+        bt2_index (str): bowtie2 index prefix
+        encoding (str): Quality score encoding
+        sample_id (str): Read group ID
+        bt2_preset (str): Bowtie2 preset to use for alignment
+        bt2_out (str): Path to write bowtie2 stderr (report)
+        out_bam (str): Path to sorted BAM
+        sort_prefix (str): Prefix for samtools sort temporary files
+        ncpu (int): Number of CPUs to use
+        fixmate (bool): Add mate tags with samtools fixmate
+        markdup_stats (str): Mark duplicates with samtools markdup, writing
+            its counts to this path
+        remove_duplicates (bool): Remove duplicates instead of marking them
+
+    Returns:
+        cmd (list): Command
+
+    """
+    cmd = [
+        'bowtie2',
+        '-p', '%d' % ncpu,
+        '--phred33' if encoding=="Phred+33" else '--phred64',
+        '--no-unal',
+        '--rg-id', sample_id,
+        '--rg', 'SM:%s' % sample_id,
+        '--rg', 'LB:1',
+        '--rg', 'PU:1',
+        '--rg', 'PL:illumina',
+        '--%s' % bt2_preset,
+        '-x', '%s' % bt2_index,
+    ] + reads + ['2>', bt2_out, '|', ]
+    if fixmate or markdup_stats:
+        cmd += markdup.fixmate_cmd() + ['|', ]
+    cmd += ['samtools', 'sort', ] + resources.sort_options(ncpu) + [
+        '-T', sort_prefix,
+    ]
+    if markdup_stats is None:
+        return cmd + ['-o', out_bam, '-', ]
+    return cmd + ['-l', '0', '-o', '-', '-', '|', ] + markdup.markdup_cmd(
+        '-', out_bam, markdup_stats, remove_duplicates, sort_prefix + '.dup'
+    )
+
+
+def _shard_commands(paired, unpaired, bt2_index, encoding, sample_id,
+                    bt2_preset, tempdir, out_bam, shards, shard_launcher, ncpu,
+                    markdup_stats, remove_duplicates, quiet, logfile, debug):
+    """ Split reads into shards, and commands to align and merge them
+
+    Each shard is aligned and sorted separately. All shards get the same
+    read group, and the merged BAM has a single @RG header, so read group
+    tags are the same as for an unsharded alignment. With markdup_stats,
+    duplicates are marked with samtools markdup as the shards are merged.
+
+    Args:
+        paired (list): Fastq files with read 1 and read 2, or None
+        unpaired (str): Fastq file with unpaired reads, or None
+
+    Returns:
+        cmds (list): Commands aligning the shards and merging them into
+            out_bam
+        shard_bt2 (list): Paths to bowtie2 stderr of each shard
+
+    """
+    # Pairs and unpaired reads are split separately
+    inputs = [paired, ] if paired else []
+    inputs += [[unpaired, ], ] if unpaired else []
+    shard_fq = [[] for s in range(shards)]
+    for i, fqs in enumerate(inputs):
+        outs = [
+            [os.path.join(tempdir, 'shard%02d_%d_%d.fastq' % (s, i, j + 1))
+             for j in range(len(fqs))]
+            for s in range(shards)
+        ]
+        msg = '[--- align_reads:shards ---] Splitting %s into %d shards\n' % (
+            ' '.join(fqs), shards)
+        sysutils.log_message(msg, quiet, logfile)
+        if not debug:
+            from haphpipe.utils import sharding
+            sharding.split_reads(fqs, outs, ncpu)
+        for s in range(shards):
+            shard_fq[s].append(outs[s])
+
+    # Shards run on other nodes get all CPUs, local shards share them
+    shard_ncpu = ncpu if shard_launcher else max(1, ncpu // shards)
+    shard_cmds, shard_bam, shard_bt2 = [], [], []
+    for s, fqs in enumerate(shard_fq):
+        shard_reads = []
+        for f in fqs:
+            shard_reads += ['-1', f[0], '-2', f[1], ] if len(f) == 2 \
+                else ['-U', f[0], ]
+        shard_bam.append(os.path.join(tempdir, 'shard%02d.bam' % s))
+        shard_bt2.append(os.path.join(tempdir, 'shard%02d.bt2.out' % s))
+        cmd = bowtie2_sort_cmd(
+            shard_reads, bt2_index, encoding, sample_id, bt2_preset,
+            shard_bt2[-1], shard_bam[-1],
+            os.path.join(tempdir, 'sort%02d' % s), shard_ncpu,
+            fixmate=markdup_stats is not None
+        )
+        if shard_launcher:
+            cmd = shlex.split(
+                shard_launcher.format(ncpu=shard_ncpu, shard=s)
+            ) + ['sh', '-c', quote(' '.join(cmd)), ]
+        shard_cmds.append(cmd)
+
+    # Identical @RG and @PG headers of the shards are combined
+    cmd_merge = ['samtools', 'merge', '-f', '-c', '-p', '-@', '%d' % ncpu, ]
+    if markdup_stats is None:
+        cmd_merge += [out_bam, ] + shard_bam
+    else:
+        cmd_merge += ['-u', '-', ] + shard_bam + ['|', ] + markdup.markdup_cmd(
+            '-', out_bam, markdup_stats, remove_duplicates,
+            os.path.join(tempdir, 'sort.dup')
+        )
+    cmd_rm = ['rm', '-f', ] + shard_bam + \
+        [f for fqs in shard_fq for fs in fqs for f in fs]
+    return [
+        sysutils.ConcurrentCommands(shard_cmds, shards), cmd_merge, cmd_rm,
+    ], shard_bt2
+
+
 def align_reads(
         fq1=None, fq2=None, fqU=None, ref_fa=None, outdir='.',
         bt2_preset='sensitive-local', sample_id='sampleXX',
         no_realign=False, remove_duplicates=False, encoding=None,
-        ncpu=1, xmx=sysutils.get_java_heap_size(),
+        trim=False, adapter_file=None, keep_trimmed=False, compress=False,
+        markdup_backend='picard', shards=1, shard_launcher=None,
+        ncpu=1, xmx=None,
         keep_tmp=False, quiet=False, logfile=None, debug=False,
     ):
     """ Pipeline step to align reads
@@ -109,8 +289,18 @@ def align_reads(
         no_realign (bool): Do not realign indels
         remove_duplicates (bool): Remove duplicates from final alignment
         encoding (str): Quality score encoding
+        markdup_backend (str): Tool used to mark duplicates (see
+            utils.markdup.BACKENDS)
+        trim (bool): Trim reads while aligning, streaming trimmed reads to
+            bowtie2 through named pipes
+        adapter_file (str): Path to adapter file for trimming
+        keep_trimmed (bool): Also write trimmed reads to outdir
+        compress (bool): Write kept trimmed reads gzip-compressed
+        shards (int): Number of shards aligned at the same time
+        shard_launcher (str): Command prefix used to run each shard
         ncpu (int): Number of CPUs to use
-        xmx (int): Maximum heap size for JVM in GB
+        xmx (int): Maximum heap size for JVM in GB. Determined from
+            available memory if None.
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
         logfile (file): Append console output to this file
@@ -132,6 +322,13 @@ def align_reads(
         msg = "incorrect input reads; requires either "
         msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
         raise MissingRequiredArgument(msg)
+    if trim and input_reads == 'both':
+        msg = "--trim requires either (--fq1 AND --fq2) OR (--fqU)"
+        raise MissingRequiredArgument(msg)
+    if shards < 1:
+        raise MissingRequiredArgument("--shards must be at least 1")
+    if trim and shards > 1:
+        raise MissingRequiredArgument("--trim cannot be used with --shards")
     
     if encoding is None:
         if input_reads == 'single':
@@ -142,96 +339,151 @@ def align_reads(
     # Check dependencies
     sysutils.check_dependency('bowtie2')
     sysutils.check_dependency('samtools')
-    sysutils.check_dependency('picard')
+    if markdup_backend == 'picard':
+        sysutils.check_dependency('picard')
 
     # Identify correct command for GATK
     GATK_BIN = sysutils.determine_dependency_path(['gatk', 'gatk3'])
 
-    # Set JVM heap argument (for GATK)
-    JAVA_HEAP = '_JAVA_OPTIONS="-Xmx%dg"' % xmx
+    # Set JVM heap argument (for GATK and picard)
+    if xmx is None:
+        xmx = sysutils.get_java_heap_size([fq1, fq2, fqU, ref_fa])
+    JAVA_HEAP = resources.java_options(xmx, ncpu)
 
     # Outputs
     out_aligned = os.path.join(outdir, 'aligned.bam')
     out_bt2 = os.path.join(outdir, 'aligned.bt2.out')
     
-    # Temporary directory
-    tempdir = sysutils.create_tempdir('align_reads', None, quiet, logfile)
+    # Temporary directory. Shards run by a launcher may run on other nodes,
+    # so the shards are written to the (shared) output directory.
+    tempdir = sysutils.create_tempdir(
+        'align_reads', outdir if shard_launcher else None, quiet, logfile,
+        inputs=[fq1, fq2, fqU, ref_fa]
+    )
     
-    # Copy and index initial reference
-    curref = os.path.join(tempdir, 'initial.fasta')
-    cmd1 = ['cp', ref_fa, curref]
-    cmd2 = ['samtools', 'faidx', curref]
-    cmd3 = ['picard', 'CreateSequenceDictionary', 
-            'R=%s' % curref, 'O=%s' % os.path.join(tempdir, 'initial.dict')]
-    cmd4 = ['bowtie2-build', curref, os.path.join(tempdir, 'initial')]
-    sysutils.command_runner(
-        [cmd1, cmd2, cmd3, cmd4], 'align_reads:index', quiet, logfile, debug
+    # Index reference (or reuse cached indexes)
+    refidx = refindex.get_index(
+        ref_fa, ['faidx', 'dict', 'bowtie2', ], tempdir, 'align_reads:index',
+        ncpu, quiet, logfile, debug
     )
+    curref = refidx.fasta
     
     # Align with bowtie2
-    cmd5 = [
-        'bowtie2',
-        '-p', '%d' % ncpu,
-        '--phred33' if encoding=="Phred+33" else '--phred64',
-        '--no-unal',
-        '--rg-id', sample_id,
-        '--rg', 'SM:%s' % sample_id,
-        '--rg', 'LB:1',
-        '--rg', 'PU:1',
-        '--rg', 'PL:illumina',
-        '--%s' % bt2_preset,
-        '-x', '%s' % os.path.join(tempdir, 'initial'),
-    ]
-    if input_reads in ['paired', 'both', ]:
-        cmd5 += ['-1', fq1, '-2', fq2,]
-    elif input_reads in ['single', 'both', ]:
-        cmd5 += ['-U', fqU, ]
-    cmd5 += ['-S', os.path.join(tempdir, 'aligned.bt2.sam'), ]
-    cmd5 += ['2>', out_bt2, ]
+    if trim:
+        # Trimmed reads are relayed to bowtie2 standard input
+        if input_reads == 'paired':
+            reads = ['--interleaved', '-', ]
+        else:
+            reads = ['-U', '-', ]
+    else:
+        reads = []
+        if input_reads in ['paired', 'both', ]:
+            reads += ['-1', fq1, '-2', fq2, ]
+        if input_reads in ['single', 'both', ]:
+            reads += ['-U', fqU, ]
+    sorted_bam = os.path.join(tempdir, 'sorted.bam')
+    rmdup_bam = os.path.join(tempdir, 'rmdup.bam')
+    rmdup_metrics = os.path.join(tempdir, 'rmdup.metrics.txt')
+
+    # samtools marks duplicates in the alignment pipeline
+    if markdup_backend == 'samtools':
+        markdup_stats = os.path.join(tempdir, 'rmdup.stats.txt')
+        aln_bam = rmdup_bam
+    else:
+        markdup_stats = None
+        aln_bam = sorted_bam
+    if markdup_stats is not None:
+        if remove_duplicates:
+            sysutils.log_message('[--- Removing duplicates ---]\n', quiet, logfile)
+        else:
+            sysutils.log_message('[--- Marking duplicates ---]\n', quiet, logfile)
+
+    if shards > 1:
+        bt2_cmds, shard_bt2 = _shard_commands(
+            [fq1, fq2, ] if input_reads in ['paired', 'both', ] else None,
+            fqU, refidx.path('bowtie2'), encoding, sample_id, bt2_preset,
+            tempdir, aln_bam, shards, shard_launcher, ncpu,
+            markdup_stats, remove_duplicates, quiet, logfile, debug
+        )
+    else:
+        cmd5 = bowtie2_sort_cmd(
+            reads, refidx.path('bowtie2'), encoding, sample_id, bt2_preset,
+            out_bt2, aln_bam, os.path.join(tempdir, 'sort'), ncpu,
+            markdup_stats=markdup_stats, remove_duplicates=remove_duplicates
+        )
+        shard_bt2 = [out_bt2, ]
+        if trim:
+            # Trimming and alignment run at the same time
+            pre, trim_cmd, relay_cmd, post = trim_reads.stream_trimmed(
+                fq1, fq2, fqU, tempdir, outdir, adapter_file,
+                encoding=encoding, keep_trimmed=keep_trimmed,
+                compress=compress, ncpu=max(1, ncpu // 4),
+            )
+            stream = sysutils.StreamingCommands(
+                [trim_cmd, relay_cmd + ['|', ] + cmd5, ]
+            )
+            bt2_cmds = pre + [stream, ] + post
+        else:
+            bt2_cmds = [cmd5, ]
 
+    if markdup_stats is not None:
+        # The samtools BAM is final, index it for realignment. With picard,
+        # MarkDuplicates indexes the BAM it writes (CREATE_INDEX).
+        bt2_cmds += [['samtools', 'index', aln_bam], ]
     try:
         sysutils.command_runner(
-            [cmd5,], 'align_reads:bowtie2', quiet, logfile, debug
+            bt2_cmds, 'align_reads:bowtie2', quiet, logfile, debug
         )
     except PipelineStepError as e:
-        if os.path.exists(out_bt2):
-            with open(out_bt2, 'r') as fh:
-                print('[--- bowtie2 stderr ---]\n%s' % fh.read(), file=sys.stderr)
+        for f in shard_bt2:
+            if os.path.exists(f):
+                with open(f, 'r') as fh:
+                    print('[--- bowtie2 stderr ---]\n%s' % fh.read(), file=sys.stderr)
         raise
 
-    cmd6 = [
-        'samtools', 'view', '-u', os.path.join(tempdir, 'aligned.bt2.sam'), '|',
-        'samtools', 'sort', '>', os.path.join(tempdir, 'sorted.bam'),
-    ]
-    cmd7 = ['samtools', 'index',  os.path.join(tempdir, 'sorted.bam'),]
-    sysutils.command_runner(
-        [cmd6, cmd7,], 'align_reads:samsort', quiet, logfile, debug
-    )
-    
-    cur_bam = os.path.join(tempdir, 'sorted.bam')
-    
-    if remove_duplicates:
-        sysutils.log_message('[--- Removing duplicates ---]', quiet, logfile)
+    if shards > 1 and not debug:
+        # bowtie2 summary of all reads
+        from haphpipe.utils import sharding
+        texts = []
+        for f in shard_bt2:
+            with open(f, 'r') as fh:
+                texts.append(fh.read())
+        with open(out_bt2, 'w') as outh:
+            outh.write(sharding.merge_bt2_summaries(texts))
+
+    cur_bam = aln_bam
+
+    if markdup_stats is not None:
+        # Metrics in the format of picard MarkDuplicates
+        if not debug:
+            markdup.write_metrics(
+                markdup_stats, rmdup_metrics, '1',
+                ' '.join(markdup.markdup_cmd('-', rmdup_bam, markdup_stats,
+                                             remove_duplicates))
+            )
     else:
-        sysutils.log_message('[--- Marking duplicates ---]', quiet, logfile)
-
-    # MarkDuplicates
-    cmd8 = [
-        'picard', 'MarkDuplicates',
-        'CREATE_INDEX=true',
-        'USE_JDK_DEFLATER=true',
-        'USE_JDK_INFLATER=true',
-        'M=%s' % os.path.join(tempdir, 'rmdup.metrics.txt'),
-        'I=%s' % cur_bam,
-        'O=%s' % os.path.join(tempdir, 'rmdup.bam'),
-        'VALIDATION_STRINGENCY=LENIENT'
-    ]
-    if remove_duplicates:
-        cmd8 += ['REMOVE_DUPLICATES=true', ]
-    sysutils.command_runner(
-        [cmd8,], 'align_reads:markdups', quiet, logfile, debug
-    )
-    cur_bam = os.path.join(tempdir, 'rmdup.bam')
+        if remove_duplicates:
+            sysutils.log_message('[--- Removing duplicates ---]\n', quiet, logfile)
+        else:
+            sysutils.log_message('[--- Marking duplicates ---]\n', quiet, logfile)
+
+        # MarkDuplicates
+        cmd8 = [
+            JAVA_HEAP, 'picard', 'MarkDuplicates',
+            'CREATE_INDEX=true',
+            'USE_JDK_DEFLATER=true',
+            'USE_JDK_INFLATER=true',
+            'M=%s' % rmdup_metrics,
+            'I=%s' % cur_bam,
+            'O=%s' % rmdup_bam,
+            'VALIDATION_STRINGENCY=LENIENT'
+        ]
+        if remove_duplicates:
+            cmd8 += ['REMOVE_DUPLICATES=true', ]
+        sysutils.command_runner(
+            [cmd8,], 'align_reads:markdups', quiet, logfile, debug
+        )
+        cur_bam = rmdup_bam
     
     if no_realign:
         print('[--- Skipping realignment ---]', file=sys.stderr)
@@ -271,6 +523,7 @@ def align_reads(
         [cmd11a, cmd11b, cmd11c, ], 'align_reads:copy', quiet, logfile, debug
     )
 
+    refidx.release()
     if not keep_tmp:
         sysutils.remove_tempdir(tempdir, 'align_reads', quiet, logfile)
     
@@ -14,7 +14,6 @@ from collections import defaultdict, Counter
 from haphpipe.utils import sysutils
 # import existing_file, args_params
 from haphpipe.utils.sequtils import wrap, parse_seq_id, region_to_tuple
-from haphpipe.utils.blastalign import called_regions, get_seg_stats, load_slot_json
 from haphpipe.utils.gtfparse import gtf_parser, GTFRow
 
 from haphpipe.utils.sysutils import PipelineStepError
@@ -55,6 +54,8 @@ def annotate_from_ref(
         outfmt=None,
         debug=False,
     ):
+    from haphpipe.utils.blastalign import called_regions, get_seg_stats, load_slot_json
+
     outh = sys.stdout if outfile is None else open(outfile, 'w')
     jaln = load_slot_json(align_json, 'padded_alignments')    
     
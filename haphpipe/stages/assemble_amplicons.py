@@ -6,11 +6,8 @@ from builtins import str
 import os
 import argparse
 
-from Bio import SeqIO
-
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
-from haphpipe.utils import alignutils
 from haphpipe.utils import gtfparse
 
 
@@ -102,6 +99,9 @@ def assemble_amplicons(
         out_padded (str): Path to padded output file
 
     """
+    from Bio import SeqIO
+    from haphpipe.utils import alignutils
+
     # Check dependencies
     sysutils.check_dependency('nucmer')
     sysutils.check_dependency('delta-filter')
@@ -5,10 +5,16 @@ import sys
 import os
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from haphpipe.utils import sysutils
+from haphpipe.utils import telemetry
 from haphpipe.utils import sequtils
+from haphpipe.utils import gzutils
 from haphpipe.stages import sample_reads
+from haphpipe.stages import collapse_reads
+from haphpipe.stages import normalize_reads
+from haphpipe.stages import bin_reads
 from haphpipe.utils.sysutils import MissingRequiredArgument
 
 
@@ -28,6 +34,9 @@ __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+""" Bins with fewer reads (counting each mate) are not assembled """
+MIN_BIN_READS = 100
+
 def stageparser(parser):
     """ Add stage-specific options to argparse parser
 
@@ -76,11 +85,40 @@ def stageparser(parser):
         group2.add_argument('--min_contig_length', type=int, default=200,
                             help='''Minimum assembled contig length to report
                                     [Trinity only]''')
-    group2.add_argument('--subsample', type=int,
-                        help='Use a subsample of reads for assembly.')
+    group2.add_argument('--subsample', type=sample_reads.subsample_arg,
+                        help='''Use a subsample of reads for assembly. With
+                                "auto", the number of reads is chosen to
+                                reach --target_depth over --ref_fa.''')
+    group2.add_argument('--target_depth', type=int,
+                        default=sample_reads.TARGET_DEPTH,
+                        help='Target depth for --subsample auto')
+    group2.add_argument('--collapse', action='store_true',
+                        help='''Collapse duplicate reads before assembly
+                                (see collapse_reads). Reads should already
+                                be error-corrected: SPAdes error correction
+                                is skipped, since it needs the copies of
+                                each read to count k-mers.''')
+    group2.add_argument('--normalize', type=int, metavar='TARGET',
+                        help='''Normalize read coverage to TARGET before
+                                assembly (see normalize_reads).''')
     group2.add_argument('--seed', type=int,
                         help='''Seed for random number generator (ignored if
                                 not subsampling).''')
+    group2.add_argument('--ref_fa', type=sysutils.existing_file,
+                        help='''Reference fasta file, for --subsample auto
+                                and --amplicons''')
+    if is_spades:
+        group2.add_argument('--amplicons', action='store_true',
+                            help='''Bin reads by amplicon (see bin_reads) and
+                                    assemble each bin separately, in
+                                    parallel [spades only]''')
+        group2.add_argument('--ref_gtf', type=sysutils.existing_file,
+                            help='''GTF format file containing amplicon
+                                    regions, for --amplicons''')
+        group2.add_argument('--min_bin_reads', type=int,
+                            default=MIN_BIN_READS,
+                            help='''Minimum number of reads in a bin for it
+                                    to be assembled, for --amplicons''')
 
     group3 = parser.add_argument_group('Settings')
     group3.add_argument('--ncpu', type=int, default=1,
@@ -109,6 +147,13 @@ def assemble_denovo(**kwargs):
     Returns:
 
     """
+    target_depth = kwargs.pop('target_depth', sample_reads.TARGET_DEPTH)
+    if kwargs.get('subsample') == 'auto':
+        kwargs['subsample'] = sample_reads.auto_subsample(
+            fq1=kwargs.get('fq1'), fq2=kwargs.get('fq2'), fqU=kwargs.get('fqU'),
+            ref_fa=kwargs.get('ref_fa'), target_depth=target_depth,
+            quiet=kwargs.get('quiet', False), logfile=kwargs.get('logfile')
+        )
     if kwargs['assembler'] == 'spades':
         return assemble_denovo_spades(**kwargs)
     elif kwargs['assembler'] == 'trinity':
@@ -118,9 +163,10 @@ def assemble_denovo(**kwargs):
 
 def assemble_denovo_spades(
         fq1=None, fq2=None, fqU=None, outdir='.',
-        no_error_correction=False, subsample=None, seed=None,
-        ncpu=1, keep_tmp=False, quiet=False, logfile=None, debug=False,
-        **kwargs
+        no_error_correction=False, subsample=None, seed=None, collapse=False,
+        normalize=None, amplicons=False, ref_fa=None, ref_gtf=None,
+        min_bin_reads=MIN_BIN_READS, ncpu=1, keep_tmp=False, quiet=False,
+        logfile=None, debug=False, **kwargs
     ):
     """ Pipeline step to assemble reads using spades (denovo)
 
@@ -132,6 +178,14 @@ def assemble_denovo_spades(
         no_error_correction (bool): do not perform error correction
         subsample (int): use a subsample of reads for assembly
         seed (int): Seed for random number generator
+        collapse (bool): Collapse duplicate reads before assembly, implies
+            no_error_correction
+        normalize (int): Normalize read coverage to this target
+        amplicons (bool): Assemble reads of each amplicon separately
+        ref_fa (str): Path to reference fasta file, for amplicons
+        ref_gtf (str): Path to reference GTF file with amplicons
+        min_bin_reads (int): Minimum number of reads in a bin for it to be
+            assembled
         ncpu (int): Number of CPUs to use
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
@@ -155,6 +209,8 @@ def assemble_denovo_spades(
         msg = "incorrect input reads; requires either "
         msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
         raise MissingRequiredArgument(msg)
+    if amplicons and (ref_fa is None or ref_gtf is None):
+        raise MissingRequiredArgument("--amplicons requires --ref_fa AND --ref_gtf")
 
     # Check dependencies
     sysutils.check_dependency('spades.py')
@@ -164,7 +220,9 @@ def assemble_denovo_spades(
     out_summary = os.path.join(outdir, 'denovo_summary.txt')
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('assemble_spades', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'assemble_spades', None, quiet, logfile, inputs=[fq1, fq2, fqU]
+    )
 
     # Subsample
     if subsample is not None:
@@ -175,25 +233,116 @@ def assemble_denovo_spades(
                 quiet=quiet, logfile=logfile, debug=debug
             )
 
-    # spades command
-    cmd1 = [
-        'spades.py',
-        '-o', tempdir,
-        '-t', '%d' % ncpu,
-    ]
-    if input_reads in ['paired', 'both', ]:
-        cmd1 += ['-1', os.path.abspath(fq1),
-                 '-2', os.path.abspath(fq2),
-                 ]
-    if input_reads in ['single', 'both', ]:
-        cmd1 += ['-s', os.path.abspath(fqU), ]
-    if no_error_correction:
-        cmd1 += ['--only-assembler', ]
-
-    sysutils.command_runner(
-        [cmd1, ], 'assemble_spades', quiet, logfile, debug
-    )
-    shutil.copy(os.path.join(tempdir, 'contigs.fasta'), out_fa)
+    # Normalize coverage
+    if normalize is not None:
+        fq1, fq2, fqU = normalize_reads.normalize_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, outdir=tempdir, target=normalize,
+            ncpu=ncpu, quiet=quiet, logfile=logfile, debug=debug
+        )
+
+    # Collapse duplicates
+    if collapse:
+        fq1, fq2, fqU = collapse_reads.collapse_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, outdir=tempdir, ncpu=ncpu,
+            quiet=quiet, logfile=logfile, debug=debug
+        )
+
+    # Bin reads by amplicon
+    if amplicons:
+        bindir = os.path.join(tempdir, 'bins')
+        os.makedirs(bindir)
+        bins, bins_tsv = bin_reads.bin_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, ref_fa=ref_fa, ref_gtf=ref_gtf,
+            outdir=bindir, ncpu=ncpu, quiet=quiet, logfile=logfile, debug=debug
+        )
+        # Reads in each bin, from the bin summary
+        nreads = {}
+        if os.path.exists(bins_tsv):
+            with open(bins_tsv, 'r') as fh:
+                header = fh.readline().rstrip('\n').split('\t')
+                for l in fh:
+                    r = dict(zip(header, l.rstrip('\n').split('\t')))
+                    nreads[r['bin']] = 2 * int(r['pairs']) + int(r['unpaired'])
+        jobs = []
+        for b, r1, r2, rU in bins:
+            if nreads.get(b, 0) < min_bin_reads:
+                msg = '[--- assemble_spades ---] Skipping bin %s (%d reads)\n' % (
+                    b, nreads.get(b, 0)
+                )
+                sysutils.log_message(msg, quiet, logfile)
+                continue
+            jobs.append((b, os.path.join(tempdir, 'spades_%s' % b), r1, r2, rU))
+        if not jobs and not debug:
+            raise sysutils.PipelineStepError(
+                'No amplicon bin has at least %d reads' % min_bin_reads
+            )
+    else:
+        jobs = [(None, tempdir, fq1, fq2, fqU), ]
+
+    # spades commands. Bins are assembled in parallel, sharing the CPUs.
+    njobs = max(1, min(len(jobs), ncpu))
+    cmds = []
+    for b, spadesdir, r1, r2, rU in jobs:
+        cmd1 = [
+            'spades.py',
+            '-o', spadesdir,
+            '-t', '%d' % max(1, ncpu // max(njobs, 1)),
+        ]
+        if r1 is not None:
+            cmd1 += ['-1', os.path.abspath(r1),
+                     '-2', os.path.abspath(r2),
+                     ]
+        if rU is not None:
+            cmd1 += ['-s', os.path.abspath(rU), ]
+        # Collapsed reads have lost the k-mer counts BayesHammer relies on
+        if no_error_correction or collapse:
+            cmd1 += ['--only-assembler', ]
+        cmds.append(cmd1)
+
+    if amplicons:
+        # A bin that fails to assemble does not fail the others
+        tags = telemetry.current_tags()
+        def run_bin(b, cmd):
+            with telemetry.context(**tags):
+                try:
+                    sysutils.command_runner(
+                        [cmd, ], 'assemble_spades:%s' % b, quiet, logfile, debug
+                    )
+                except sysutils.PipelineStepError as e:
+                    return b, e
+            return b, None
+        with ThreadPoolExecutor(max_workers=njobs) as pool:
+            res = list(pool.map(run_bin, [j[0] for j in jobs], cmds))
+        failed = [b for b, e in res if e is not None]
+        for b, e in res:
+            if e is not None:
+                msg = '[--- assemble_spades ---] WARNING: bin %s failed, ' \
+                      'skipping it:\n%s\n' % (b, e)
+                sysutils.log_message(msg, quiet, logfile)
+        if jobs and len(failed) == len(jobs):
+            raise sysutils.PipelineStepError(
+                'SPAdes failed for all bins: %s' % ', '.join(failed)
+            )
+        # Merge contigs, prefixed with the bin name. Bins with too few reads
+        # may have no contigs.
+        if not debug:
+            with open(out_fa, 'w') as outh:
+                for b, spadesdir, _, _, _ in jobs:
+                    if b in failed:
+                        continue
+                    contigs = os.path.join(spadesdir, 'contigs.fasta')
+                    if not os.path.exists(contigs):
+                        continue
+                    with open(contigs, 'r') as fh:
+                        for l in fh:
+                            if l.startswith('>'):
+                                l = '>%s_%s' % (b, l[1:])
+                            outh.write(l)
+    else:
+        sysutils.command_runner(
+            [cmds[0], ], 'assemble_spades', quiet, logfile, debug
+        )
+        shutil.copy(os.path.join(tempdir, 'contigs.fasta'), out_fa)
 
     if os.path.isfile(out_fa):
         with open(out_summary, 'w') as outh:
@@ -207,7 +356,8 @@ def assemble_denovo_spades(
 
 def assemble_denovo_trinity(
         fq1=None, fq2=None, fqU=None, outdir='.',
-        min_contig_length=200, subsample=None, seed=None,
+        min_contig_length=200, subsample=None, seed=None, collapse=False,
+        normalize=None,
         ncpu=1, keep_tmp=False, quiet=False, logfile=None, debug=False,
         **kwargs
     ):
@@ -221,6 +371,8 @@ def assemble_denovo_trinity(
         min_contig_length (int): minimum assembled contig length to report
         subsample (int): use a subsample of reads for assembly
         seed (int): Seed for random number generator
+        collapse (bool): Collapse duplicate reads before assembly
+        normalize (int): Normalize read coverage to this target
         ncpu (int): Number of CPUs to use
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
@@ -232,6 +384,9 @@ def assemble_denovo_trinity(
         out1 (str): Path to assembled contigs file (fasta format)
 
     """
+    if kwargs.get('amplicons'):
+        raise sysutils.PipelineStepError('--amplicons requires SPAdes.')
+
     # Check inputs
     if fq1 is not None and fq2 is not None and fqU is None:
         input_reads = "paired" # Paired end
@@ -251,7 +406,26 @@ def assemble_denovo_trinity(
     out1 = os.path.join(outdir, 'contigs.fa')
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('assemble_trinity', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'assemble_trinity', None, quiet, logfile, inputs=[fq1, fq2, fqU]
+    )
+
+    # Normalize coverage
+    if normalize is not None:
+        fq1, fq2, fqU = normalize_reads.normalize_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, outdir=tempdir, target=normalize,
+            ncpu=ncpu, quiet=quiet, logfile=logfile, debug=debug
+        )
+
+    # Collapse duplicates
+    if collapse:
+        fq1, fq2, fqU = collapse_reads.collapse_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, outdir=tempdir, ncpu=ncpu,
+            quiet=quiet, logfile=logfile, debug=debug
+        )
+
+    # Older versions of Trinity read plain FASTQ only
+    (fq1, fq2, fqU), cmd0 = gzutils.uncompressed([fq1, fq2, fqU], tempdir, ncpu)
     
     # Trinity command
     cmd1 = [
@@ -276,7 +450,7 @@ def assemble_denovo_trinity(
     ]
 
     sysutils.command_runner(
-        [cmd1, cmd2, ], 'assemble_trinity', quiet, logfile, debug
+        cmd0 + [cmd1, cmd2, ], 'assemble_trinity', quiet, logfile, debug
     )
 
     if not keep_tmp:
@@ -6,7 +6,6 @@ import argparse
 
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
-from haphpipe.utils import alignutils
 
 
 __author__ = 'Matthew L. Bendall'
@@ -82,6 +81,8 @@ def assemble_scaffold(
         out_padded (str):   Path to output with all contigs aligned to
                             reference.
     """
+    from haphpipe.utils import alignutils
+
     # Check dependencies
     sysutils.check_dependency('nucmer')
     sysutils.check_dependency('delta-filter')
@@ -0,0 +1,278 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import dagrunner
+from haphpipe.utils import stagecache
+from haphpipe.utils import telemetry
+from haphpipe.utils.sysutils import PipelineStepError
+from haphpipe.utils.sysutils import MissingRequiredArgument
+from haphpipe.stages import run
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--samples', type=sysutils.existing_file,
+                        required=True,
+                        help='''Sample sheet (tab-separated) with header. Required
+                                columns are "sample_id", "fq1" and "fq2".
+                                Optional columns "ref_fa", "ref_gtf" and
+                                "outdir" override the defaults for a sample.''')
+    group1.add_argument('--ref_fa', type=sysutils.existing_file,
+                        help='''Reference sequence (fasta). For assemble_02,
+                                this is the amplicon reference.''')
+    group1.add_argument('--ref_gtf', type=sysutils.existing_file,
+                        help='Amplicon regions (GTF). Required for assemble_01')
+    group1.add_argument('--outdir', type=sysutils.new_or_existing_dir,
+                        default='.',
+                        help='''Output directory. Each sample is written to a
+                                subdirectory named with the sample ID.''')
+
+    group2 = parser.add_argument_group('Pipeline options')
+    group2.add_argument('--pipeline', default='assemble_01',
+                        choices=sorted(run.PIPELINES.keys()),
+                        help='Pipeline to run for each sample.')
+    group2.add_argument('--max_step', type=int, default=5,
+                        help='Maximum number of refinement steps')
+    group2.add_argument('--compress', action='store_true',
+                        help='''Keep trimmed and corrected reads
+                                gzip-compressed (.fastq.gz)''')
+    group2.add_argument('--force', action='store_true',
+                        help='Rerun stages that have already completed')
+    group2.add_argument('--cache_dir', type=sysutils.new_or_existing_dir,
+                        help='''Reuse results of stages that were run earlier
+                                with the same inputs and parameters. Results
+                                are stored in this directory.''')
+    group2.add_argument('--cache_size', type=stagecache.parse_size,
+                        help='''Maximum size of cache, e.g. "200G". Least
+                                recently used results are removed first.''')
+
+    group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--total_cpus', '--total-cpus', type=int,
+                        default=run.default_ncpu(),
+                        help='Total number of CPUs shared by all samples')
+    group3.add_argument('--keep_tmp', action='store_true',
+                        help='Do not delete temporary directory')
+    group3.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group3.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    group3.add_argument('--trace',
+                        help='''Append resource usage of each stage and command
+                                to this file (JSON lines). See
+                                "haphpipe trace_report".''')
+    group3.add_argument('--debug', action='store_true',
+                        help='Print commands but do not run')
+    parser.set_defaults(func=batch)
+
+
+def parse_sample_sheet(samples, pipeline=None, ref_fa=None, ref_gtf=None):
+    """ Parse sample sheet
+
+    The sample sheet is tab-separated, with a header line. Blank lines and
+    lines starting with "#" are ignored. Each sample must have the reference
+    files required by the pipeline, in the sheet or given as defaults.
+
+    Args:
+        samples (str): Path to sample sheet
+        pipeline (str): Pipeline to run, references are not checked if None
+        ref_fa (str): Default reference sequence
+        ref_gtf (str): Default reference GTF
+
+    Returns:
+        rows (list): One dictionary per sample
+
+    """
+    required = ['sample_id', 'fq1', 'fq2', ]
+    header = None
+    rows = []
+    with open(samples, 'r') as fh:
+        for lineno, l in enumerate(fh, 1):
+            if not l.strip() or l.startswith('#'):
+                continue
+            fields = [f.strip() for f in l.rstrip('\n').split('\t')]
+            if header is None:
+                header = fields
+                missing = [c for c in required if c not in header]
+                if missing:
+                    msg = 'Sample sheet is missing column(s): %s' % ', '.join(missing)
+                    raise MissingRequiredArgument(msg)
+                continue
+            row = {k:v for k,v in zip(header, fields) if v}
+            missing = [c for c in required if c not in row]
+            if missing:
+                msg = 'Sample sheet line %d: no value for %s' % (
+                    lineno, ', '.join(missing))
+                raise MissingRequiredArgument(msg)
+            rows.append(row)
+
+    ids = [r['sample_id'] for r in rows]
+    dups = sorted(set(i for i in ids if ids.count(i) > 1))
+    if dups:
+        raise PipelineStepError('Duplicate sample IDs: %s' % ', '.join(dups))
+    for r in rows:
+        for k in ['fq1', 'fq2', 'ref_fa', 'ref_gtf']:
+            if k in r and not os.path.isfile(r[k]):
+                msg = 'Sample %s: %s does not exist' % (r['sample_id'], r[k])
+                raise PipelineStepError(msg)
+    defaults = {'ref_fa': ref_fa, 'ref_gtf': ref_gtf}
+    for k in run.REQUIRED_REFS.get(pipeline, []):
+        missing = [r['sample_id'] for r in rows
+                   if r.get(k, defaults[k]) is None]
+        if missing:
+            msg = '%s requires --%s or a "%s" column for sample(s): %s' % (
+                pipeline, k, k, ', '.join(missing))
+            raise MissingRequiredArgument(msg)
+    return rows
+
+
+def batch(
+        samples=None, ref_fa=None, ref_gtf=None, outdir='.',
+        pipeline='assemble_01', max_step=5, compress=False, force=False,
+        cache_dir=None, cache_size=None,
+        total_cpus=1,
+        keep_tmp=False, quiet=False, logfile=None, trace=None, debug=False,
+    ):
+    """ Run an assembly pipeline for many samples
+
+    The stages of every sample are scheduled together in a pool of worker
+    processes that share "total_cpus" CPUs. Each stage receives no more CPUs
+    than it can make use of (see run.STAGE_THREADS), and when more stages
+    are ready than there are CPUs, each stage runs single-threaded so that
+    as many samples as possible make progress at once. A failed sample does
+    not stop the other samples.
+
+    Args:
+        samples (str): Path to sample sheet
+        ref_fa (str): Path to reference fasta file
+        ref_gtf (str): Path to GTF file with amplicon regions
+        outdir (str): Path to output directory
+        pipeline (str): Name of pipeline to run
+        max_step (int): Maximum number of refinement steps
+        compress (bool): Keep trimmed and corrected reads compressed
+        force (bool): Rerun stages that have already completed
+        cache_dir (str): Path to stage cache directory
+        cache_size (int): Maximum size of stage cache in bytes
+        total_cpus (int): Total number of CPUs shared by all samples
+        keep_tmp (bool): Do not delete temporary directory
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        trace (str): Append resource usage trace to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        out_summary (str): Path to batch summary
+
+    """
+    if samples is None:
+        raise MissingRequiredArgument('No sample sheet given.')
+    if pipeline not in run.PIPELINES:
+        raise PipelineStepError('Unknown pipeline: %s' % pipeline)
+
+    # Outputs
+    out_summary = os.path.join(outdir, 'batch_summary.tsv')
+
+    dags = []
+    for row in parse_sample_sheet(samples, pipeline, ref_fa, ref_gtf):
+        sampdir = row.get('outdir', os.path.join(outdir, row['sample_id']))
+        if not os.path.isdir(sampdir):
+            os.makedirs(sampdir)
+        dag = run.PIPELINES[pipeline](
+            fq1=row['fq1'], fq2=row['fq2'],
+            ref_fa=row.get('ref_fa', ref_fa),
+            ref_gtf=row.get('ref_gtf', ref_gtf),
+            outdir=sampdir, sample_id=row['sample_id'],
+            max_step=max_step, compress=compress, keep_tmp=keep_tmp,
+        )
+        dag.name = row['sample_id']
+        # Stage output for each sample goes to the sample log
+        for node in dag.nodes.values():
+            node.kwargs['quiet'] = True
+            node.kwargs['logfile'] = os.path.join(sampdir, 'haphpipe.out')
+        dags.append(dag)
+
+    msg = '[--- batch ---] %d samples, %d CPUs\n' % (len(dags), total_cpus)
+    sysutils.log_message(msg, quiet, logfile)
+
+    if trace is not None:
+        telemetry.enable(trace)
+    cache = None
+    if cache_dir is not None:
+        cache = stagecache.StageCache(cache_dir, cache_size)
+
+    executed, failed = dagrunner.run_dags(
+        dags, ncpu=total_cpus, executor='process', force=force, cache=cache,
+        quiet=quiet, logfile=logfile, debug=debug
+    )
+
+    with open(out_summary, 'w') as outh:
+        print('\t'.join(['sample_id', 'status', 'executed', 'failed']), file=outh)
+        for dag in dags:
+            print('\t'.join([
+                dag.name,
+                'FAILED' if dag.name in failed else 'COMPLETED',
+                ','.join(executed[dag.name]) or '.',
+                ','.join(failed.get(dag.name, {})) or '.',
+            ]), file=outh)
+
+    if failed:
+        msg = '%d of %d samples failed: %s\n' % (len(failed), len(dags), ', '.join(failed))
+        msg += 'See %s and the sample logs for details.' % out_summary
+        raise PipelineStepError(msg)
+
+    return out_summary
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Run an assembly pipeline for many samples.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+from collections import OrderedDict
+
+from haphpipe.utils import gzutils
+from haphpipe.utils import sysutils
+from haphpipe.utils.sysutils import MissingRequiredArgument
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--fq1', type=sysutils.existing_file,
+                        help='Fastq file with read 1')
+    group1.add_argument('--fq2', type=sysutils.existing_file,
+                        help='Fastq file with read 2')
+    group1.add_argument('--fqU', type=sysutils.existing_file,
+                        help='Fastq file with unpaired reads')
+    group1.add_argument('--ref_fa', type=sysutils.existing_file, required=True,
+                        help='Reference fasta file')
+    group1.add_argument('--ref_gtf', type=sysutils.existing_file, required=True,
+                        help='GTF format file containing amplicon regions')
+    group1.add_argument('--outdir', type=sysutils.existing_dir, default='.',
+                        help='Output directory')
+
+    group2 = parser.add_argument_group('Binning options')
+    group2.add_argument('--ksize', type=int, default=15,
+                        help='K-mer size (at most 31)')
+    group2.add_argument('--min_kmers', type=int, default=20,
+                        help='''Minimum number of k-mers a read (or pair)
+                                shares with an amplicon to be binned''')
+    group2.add_argument('--padding', type=int, default=50,
+                        help='Bases to include outside amplicon regions')
+
+    group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write gzip-compressed reads (.fastq.gz)')
+    group3.add_argument('--ncpu', type=int, default=1,
+                        help='Number of CPU to use')
+    group3.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group3.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    group3.add_argument('--debug', action='store_true',
+                        help='Print commands but do not run')
+    parser.set_defaults(func=bin_reads)
+
+
+def bin_reads(
+        fq1=None, fq2=None, fqU=None, ref_fa=None, ref_gtf=None, outdir='.',
+        ksize=15, min_kmers=20, padding=50, compress=False,
+        ncpu=1, quiet=False, logfile=None, debug=False,
+    ):
+    """ Pipeline step to bin reads by amplicon
+
+    Each read (or pair) is assigned to the amplicon sharing the most k-mers
+    with it. Reads of each amplicon are written to "<amplicon>_1.fastq",
+    "<amplicon>_2.fastq" and "<amplicon>_U.fastq", and other reads to
+    "unbinned_*.fastq". Only files with reads are written. The bins are
+    listed in "bins.tsv".
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        fqU (str): Path to fastq file with unpaired reads
+        ref_fa (str): Path to reference fasta file
+        ref_gtf (str): Path to reference GTF file with amplicons
+        outdir (str): Path to output directory
+        ksize (int): K-mer size
+        min_kmers (int): Minimum number of k-mers shared with amplicon
+        padding (int): Bases to include outside amplicon regions
+        compress (bool): Write gzip-compressed reads
+        ncpu (int): Number of CPUs to use
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        bins (list): (bin name, fq1, fq2, fqU) for each bin with reads, with
+            None for missing files
+        out_tsv (str): Path to bin summary
+
+    """
+    # Check inputs
+    if fq1 is not None and fq2 is not None and fqU is None:
+        input_reads = "paired"  # Paired end
+    elif fq1 is None and fq2 is None and fqU is not None:
+        input_reads = "single"  # Single end
+    elif fq1 is not None and fq2 is not None and fqU is not None:
+        input_reads = "both"
+    else:
+        msg = "incorrect input reads; requires either "
+        msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
+        raise MissingRequiredArgument(msg)
+
+    # Outputs
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    out_tsv = os.path.join(outdir, 'bins.tsv')
+    jobs = []
+    if input_reads in ['paired', 'both', ]:
+        jobs.append(('pairs', [fq1, fq2],
+                     [fq('%s_1.fastq'), fq('%s_2.fastq')]))
+    if input_reads in ['single', 'both', ]:
+        jobs.append(('unpaired reads', [fqU], [fq('%s_U.fastq')]))
+
+    for label, inputs, outputs in jobs:
+        sysutils.log_message(
+            '[--- bin_reads ---] %s -> %s\n' % (' '.join(inputs), outdir),
+            quiet, logfile
+        )
+    if debug:
+        return [], out_tsv
+
+    from haphpipe.utils import fastq
+    from haphpipe.utils import binning
+    from haphpipe.utils import readsampler
+
+    try:
+        index = binning.AmpliconIndex.from_reference(ref_fa, ref_gtf, ksize,
+                                                     padding)
+    except ValueError as e:
+        raise sysutils.PipelineStepError(str(e))
+
+    # Bin name to [fq1, fq2, fqU] and counts
+    bins = OrderedDict()
+    for label, inputs, outputs in jobs:
+        try:
+            res = binning.bin_reads(inputs, outputs, index, min_kmers, ncpu)
+        except (readsampler.MateMismatchError, fastq.FastqFormatError) as e:
+            raise sysutils.PipelineStepError(str(e))
+        for name, outs, n in res:
+            files, counts = bins.setdefault(name, ([None] * 3, [0, 0]))
+            if len(outs) == 2:
+                files[:2], counts[0] = outs, n
+            else:
+                files[2], counts[1] = outs[0], n
+            sysutils.log_message(
+                '[--- bin_reads ---] %s: %d %s\n' % (name, n, label),
+                quiet, logfile
+            )
+
+    # Unbinned reads last
+    names = [n for n in bins if n != binning.UNBINNED]
+    names += [n for n in bins if n == binning.UNBINNED]
+    with open(out_tsv, 'w') as outh:
+        print('bin\tfq1\tfq2\tfqU\tpairs\tunpaired', file=outh)
+        for name in names:
+            files, counts = bins[name]
+            print('\t'.join([name] + [f or 'NA' for f in files] +
+                            ['%d' % c for c in counts]), file=outh)
+    return [tuple([n] + bins[n][0]) for n in names], out_tsv
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Bin reads by amplicon.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
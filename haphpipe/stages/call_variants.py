@@ -6,6 +6,8 @@ import os
 import argparse
 
 from haphpipe.utils import sysutils
+from haphpipe.utils import resources
+from haphpipe.utils import refindex
 
 
 __author__ = 'Matthew L. Bendall'
@@ -56,8 +58,10 @@ def stageparser(parser):
     group3.add_argument('--ncpu', type=int,
                         help='Number of CPU to use')
     group3.add_argument('--xmx', type=int,
-                        default=sysutils.get_java_heap_size(),
-                        help='Maximum heap size for Java VM, in GB.')
+                        help='''Maximum heap size for Java VM, in GB. By
+                                default, determined from input sizes, the
+                                memory limit (including cgroup limits) and
+                                other running JVMs.''')
     group3.add_argument('--keep_tmp', action='store_true',
                         help='Do not delete temporary directory')
     group3.add_argument('--quiet', action='store_true',
@@ -73,7 +77,7 @@ def stageparser(parser):
 def call_variants(
         aln_bam=None, ref_fa=None, outdir='.',
         emit_all=False, min_base_qual=15,
-        ncpu=1, xmx=sysutils.get_java_heap_size(),
+        ncpu=1, xmx=None,
         keep_tmp=False, quiet=False, logfile=None, debug=False,
     ):
     """ Pipeline step to call variants
@@ -85,7 +89,8 @@ def call_variants(
         emit_all (bool): Output calls for all sites
         min_base_qual (int): Minimum base quality for calling
         ncpu (int): Number of CPUs to use
-        xmx (int): Maximum heap size for JVM in GB
+        xmx (int): Maximum heap size for JVM in GB. Determined from
+            available memory if None.
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
         logfile (file): Append console output to this file
@@ -95,15 +100,13 @@ def call_variants(
         out_vcf (str): Path to output VCF
 
     """
-    # Check dependencies
-    sysutils.check_dependency('samtools')
-    sysutils.check_dependency('picard')
-
     # Identify correct command for GATK
     GATK_BIN = sysutils.determine_dependency_path(['gatk', 'gatk3'])
 
     # Set JVM heap argument (for GATK)
-    JAVA_HEAP = '_JAVA_OPTIONS="-Xmx%dg"' % xmx
+    if xmx is None:
+        xmx = sysutils.get_java_heap_size([aln_bam, ref_fa])
+    JAVA_HEAP = resources.java_options(xmx, ncpu)
 
     # Outputs
     out_vcf = os.path.join(outdir, 'variants.vcf.gz')    
@@ -111,13 +114,13 @@ def call_variants(
     # Temporary directory
     tempdir = sysutils.create_tempdir('call_variants', None, quiet, logfile)
     
-    # Copy and index initial reference
-    curref = os.path.join(tempdir, 'initial.fasta')
-    cmd1 = ['cp', ref_fa, curref]
-    cmd2 = ['samtools', 'faidx', curref]
-    cmd3 = ['picard', 'CreateSequenceDictionary', 
-            'R=%s' % curref, 'O=%s' % os.path.join(tempdir, 'initial.dict')]
-        
+    # Index reference (or reuse cached indexes)
+    refidx = refindex.get_index(
+        ref_fa, ['faidx', 'dict', ], tempdir, 'call_variants:index',
+        ncpu, quiet, logfile, debug
+    )
+    curref = refidx.fasta
+
     # UnifiedGenotyper
     cmd4 = [JAVA_HEAP, GATK_BIN, '-T', 'UnifiedGenotyper',
         '--use_jdk_deflater', '--use_jdk_inflater',
@@ -137,8 +140,9 @@ def call_variants(
         cmd4 += ['-out_mode', 'EMIT_ALL_SITES']
 
     sysutils.command_runner(
-        [cmd1, cmd2, cmd3, cmd4,], 'call_variants:GATK', quiet, logfile, debug
+        [cmd4,], 'call_variants:GATK', quiet, logfile, debug
     )
+    refidx.release()
 
     if not keep_tmp:
         sysutils.remove_tempdir(tempdir, 'call_variants:GATK', quiet, logfile)
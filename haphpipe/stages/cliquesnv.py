@@ -5,10 +5,9 @@ import argparse
 import shutil
 import json
 
-from past.utils import old_div
-from Bio import SeqIO
-
 from haphpipe.utils import sysutils
+from haphpipe.utils import gzutils
+from haphpipe.utils import refindex
 from haphpipe.utils.sysutils import MissingRequiredArgument
 
 __author__ = 'Margaret C. Steiner, Keylie M. Gibson, and Matthew L. Bendall'
@@ -63,6 +62,7 @@ def stageparser(parser):
 
 def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22min=None,O22minfreq=None,printlog=None,single=False,
               merging=None,fasta_format='extended4',outputstart=None,outputend=None,keep_tmp=False, quiet=False, logfile=None, debug=False,ncpu=1):
+    from Bio import SeqIO
 
     # check if paired vs. single
     if fq1 is None and fq2 is None and fqU is not None:
@@ -91,7 +91,9 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
             raise MissingRequiredArgument("No JAR file found.")
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('clique_snv', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'clique_snv', None, quiet, logfile, inputs=[fq1, fq2, fqU, ref_fa]
+    )
 
     # Load reference fasta
     refs = {s.id: s for s in SeqIO.parse(ref_fa, 'fasta')}
@@ -109,9 +111,13 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
         # remove .1 and .2 from read names
         fq1_c = os.path.join(tempdir,"fq1_corrected.fastq")
         fq2_c = os.path.join(tempdir, "fq2_corrected.fastq")
-        cmd01 = ["cat %s | sed 's/\.1 / /' > %s" % (fq1,fq1_c)]
-        cmd02 = ["cat %s | sed 's/\.2 / /' > %s" % (fq2,fq2_c)]
-        sysutils.command_runner([cmd01,cmd02],'clique_snv:setup',quiet,logfile,debug)
+        cat = ' '.join(gzutils.decompress_cmd())
+        cmd01 = ["%s %s | sed 's/\.1 / /' > %s" % (cat,fq1,fq1_c)]
+        cmd02 = ["%s %s | sed 's/\.2 / /' > %s" % (cat,fq2,fq2_c)]
+        sysutils.command_runner(
+            [sysutils.ConcurrentCommands([cmd01, cmd02], ncpu)],
+            'clique_snv:setup', quiet, logfile, debug
+        )
 
         # Create alignment for each REFERENCE in the reconstruction regions
         alnmap = {}
@@ -121,12 +127,15 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
                 tmp_ref_fa = os.path.join(tempdir, 'ref.%d.fa' % len(alnmap))
                 tmp_sam = os.path.join(tempdir, 'aligned.%d.sam' % len(alnmap))
                 SeqIO.write(refs[rname], tmp_ref_fa, 'fasta')
-                cmd1 = ['bwa', 'index', tmp_ref_fa, ]
-                cmd2 = ['bwa', 'mem', tmp_ref_fa, fq1_c, fq2_c, '|', 'samtools', 'view', '-h', '-F', '12', '>', tmp_sam, ]
-                cmd3 = ['rm', '-f', '%s.*' % tmp_ref_fa]
+                refidx = refindex.get_index(
+                    tmp_ref_fa, ['bwa', ], tempdir, 'clique_snv:index',
+                    quiet=quiet, logfile=logfile, debug=debug
+                )
+                cmd2 = ['bwa', 'mem', refidx.path('bwa'), fq1_c, fq2_c, '|', 'samtools', 'view', '-h', '-F', '12', '>', tmp_sam, ]
                 sysutils.command_runner(
-                    [cmd1, cmd2, cmd3], 'clique_snv:setup', quiet, logfile, debug
+                    [cmd2, ], 'clique_snv:setup', quiet, logfile, debug
                 )
+                refidx.release()
                 alnmap[rname] = (tmp_ref_fa, tmp_sam)
 
     else: #single read
@@ -139,13 +148,16 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
                 tmp_ref_fa = os.path.join(tempdir, 'ref.%d.fa' % len(alnmap))
                 tmp_sam = os.path.join(tempdir, 'aligned.%d.sam' % len(alnmap))
                 SeqIO.write(refs[rname], tmp_ref_fa, 'fasta')
-                cmd1 = ['bwa', 'index', tmp_ref_fa, ]
-                cmd2 = ['bwa', 'mem', tmp_ref_fa, fqU, '|', 'samtools', 'view', '-h', '-F', '12', '>',
+                refidx = refindex.get_index(
+                    tmp_ref_fa, ['bwa', ], tempdir, 'clique_snv:index',
+                    quiet=quiet, logfile=logfile, debug=debug
+                )
+                cmd2 = ['bwa', 'mem', refidx.path('bwa'), fqU, '|', 'samtools', 'view', '-h', '-F', '12', '>',
                         tmp_sam, ]
-                cmd3 = ['rm', '-f', '%s.*' % tmp_ref_fa]
                 sysutils.command_runner(
-                    [cmd1, cmd2, cmd3], 'clique_snv:setup', quiet, logfile, debug
+                    [cmd2, ], 'clique_snv:setup', quiet, logfile, debug
                 )
+                refidx.release()
                 alnmap[rname] = (tmp_ref_fa, tmp_sam)
 
 
@@ -224,7 +236,7 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
     
                 freq_sqrd = [x ** 2 for x in freqs]
                 freq_sqrd_sum = sum(freq_sqrd)
-                hap_div = ((old_div(7000, (7000 - 1))) * (1 - freq_sqrd_sum))
+                hap_div = ((7000 // (7000 - 1)) * (1 - freq_sqrd_sum))
                 sumfile.write('CliqueSNV_hap_diversity\t%s\n' % hap_div)
                 sumfile.write('CliqueSNV_seq_len\t%s\n' % len(haps[0]))
         elif os.path.exists(out_json):
@@ -234,7 +246,7 @@ def cliquesnv(fq1=None,fq2=None,fqU=None,ref_fa=None,outdir='.',jardir=None,O22m
                 freqs = [h['frequency'] for h in dat['haplotypes']]
                 freq_sqrd = [x ** 2 for x in freqs]
                 freq_sqrd_sum = sum(freq_sqrd)
-                hap_div = ((old_div(7000, (7000 - 1))) * (1 - freq_sqrd_sum))           
+                hap_div = ((7000 // (7000 - 1)) * (1 - freq_sqrd_sum))           
                 sumfile.write('CliqueSNV_hap_diversity\t%f\n' % hap_div)
                 sumfile.write('CliqueSNV_seq_len\t%s\n' % len(dat['haplotypes'][0]['haplotype']))        
         
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from haphpipe.utils import gzutils
+from haphpipe.utils import sysutils
+from haphpipe.utils.sysutils import MissingRequiredArgument
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--fq1', type=sysutils.existing_file,
+                        help='Fastq file with read 1')
+    group1.add_argument('--fq2', type=sysutils.existing_file,
+                        help='Fastq file with read 2')
+    group1.add_argument('--fqU', type=sysutils.existing_file,
+                        help='Fastq file with unpaired reads')
+    group1.add_argument('--outdir', type=sysutils.existing_dir, default='.',
+                        help='Output directory')
+
+    group2 = parser.add_argument_group('Collapse options')
+    group2.add_argument('--expand', action='store_true',
+                        help='''Expand collapsed reads instead, writing each
+                                read as many times as its ";size=N" tag.''')
+    group2.add_argument('--max_memory', type=int, default=2048,
+                        help='''Memory for collapsing, in MB. Larger inputs
+                                are split into buckets in the temporary
+                                directory.''')
+
+    group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write gzip-compressed reads (.fastq.gz)')
+    group3.add_argument('--ncpu', type=int, default=1,
+                        help='Number of CPU to use')
+    group3.add_argument('--keep_tmp', action='store_true',
+                        help='Keep temporary directory')
+    group3.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group3.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    group3.add_argument('--debug', action='store_true',
+                        help='Print commands but do not run')
+    parser.set_defaults(func=collapse_reads)
+
+
+def collapse_reads(
+        fq1=None, fq2=None, fqU=None, outdir='.',
+        expand=False, max_memory=2048, compress=False,
+        ncpu=1, keep_tmp=False, quiet=False, logfile=None, debug=False,
+    ):
+    """ Pipeline step to collapse duplicate reads
+
+    Reads (or pairs) with identical sequences are written once, with the
+    number of copies added to the read name as ";size=N". Pairs are
+    collapsed only if both mates are identical. With expand, collapsed
+    reads are written as many times as their size tag instead.
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        fqU (str): Path to fastq file with unpaired reads
+        outdir (str): Path to output directory
+        expand (bool): Expand collapsed reads
+        max_memory (int): Memory for collapsing, in MB
+        compress (bool): Write gzip-compressed reads
+        ncpu (int): Number of CPUs to use
+        keep_tmp (bool): Do not delete temporary directory
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        out1 (str): Path to collapsed fastq file with read 1
+        out2 (str): Path to collapsed fastq file with read 2
+        outU (str): Path to collapsed fastq file with unpaired reads
+
+    """
+    # Check inputs
+    if fq1 is not None and fq2 is not None and fqU is None:
+        input_reads = "paired"  # Paired end
+    elif fq1 is None and fq2 is None and fqU is not None:
+        input_reads = "single"  # Single end
+    elif fq1 is not None and fq2 is not None and fqU is not None:
+        input_reads = "both"
+    else:
+        msg = "incorrect input reads; requires either "
+        msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
+        raise MissingRequiredArgument(msg)
+
+    # Outputs
+    prefix = 'expanded' if expand else 'collapsed'
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    jobs = []
+    out1 = out2 = outU = None
+    if input_reads in ['paired', 'both', ]:
+        out1 = fq('%s_1.fastq' % prefix)
+        out2 = fq('%s_2.fastq' % prefix)
+        jobs.append(('pairs', [fq1, fq2], [out1, out2]))
+    if input_reads in ['single', 'both', ]:
+        outU = fq('%s_U.fastq' % prefix)
+        jobs.append(('unpaired reads', [fqU], [outU]))
+
+    for label, inputs, outputs in jobs:
+        sysutils.log_message(
+            '[--- collapse_reads ---] %s -> %s\n' % (
+                ' '.join(inputs), ' '.join(outputs)
+            ), quiet, logfile
+        )
+    if debug:
+        return out1, out2, outU
+
+    from haphpipe.utils import fastq
+    from haphpipe.utils import collapse
+    from haphpipe.utils import readsampler
+
+    tempdir = None
+    if not expand:
+        nbuckets = sum(collapse.num_buckets(inputs, max_memory << 20)
+                       for _, inputs, _ in jobs)
+        if nbuckets > len(jobs):
+            tempdir = sysutils.create_tempdir(
+                'collapse_reads', None, quiet, logfile, inputs=[fq1, fq2, fqU]
+            )
+
+    def run_job(job):
+        label, inputs, outputs = job
+        try:
+            if expand:
+                # Mates have the same size tags, so are expanded separately
+                res = [collapse.expand(i, o, ncpu)
+                       for i, o in zip(inputs, outputs)]
+                return res[0]
+            return collapse.collapse(inputs, outputs, tempdir,
+                                     max_memory << 20, ncpu)
+        except (readsampler.MateMismatchError, fastq.FastqFormatError) as e:
+            raise sysutils.PipelineStepError(str(e))
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            results = list(pool.map(run_job, jobs))
+    finally:
+        if tempdir is not None and not keep_tmp:
+            sysutils.remove_tempdir(tempdir, 'collapse_reads', quiet, logfile)
+
+    for (label, _, _), (nin, nout) in zip(jobs, results):
+        sysutils.log_message(
+            '[--- collapse_reads ---] %s %d %s to %d\n' % (
+                'Expanded' if expand else 'Collapsed', nin, label, nout
+            ), quiet, logfile
+        )
+    return out1, out2, outU
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Collapse duplicate reads.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
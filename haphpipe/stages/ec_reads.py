@@ -5,9 +5,9 @@ import sys
 import os
 import argparse
 
-import yaml
-
 from haphpipe.utils import sysutils
+from haphpipe.utils import gzutils
+from haphpipe.stages import normalize_reads
 from haphpipe.utils.sysutils import MissingRequiredArgument
 
 
@@ -46,7 +46,15 @@ def stageparser(parser):
                         help='Fastq file with unpaired reads')              
     group1.add_argument('--outdir', type=sysutils.existing_dir,
                         help='Output directory')
+    group2 = parser.add_argument_group('Error correction options')
+    group2.add_argument('--normalize', type=int, metavar='TARGET',
+                        help='''Normalize read coverage to TARGET before
+                                error correction (see normalize_reads).''')
     group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='''Write gzip-compressed reads (.fastq.gz). The
+                                compressed output of SPAdes is kept as is
+                                instead of being decompressed.''')
     group3.add_argument('--ncpu', type=int, default=1,
                         help='Number of CPU to use')
     group3.add_argument('--keep_tmp', action='store_true',
@@ -62,8 +70,9 @@ def stageparser(parser):
 
 
 def ec_reads(
-        fq1=None, fq2=None, fqU=None, outdir='.',
-        ncpu=1, keep_tmp=False, quiet=False, logfile=None, debug=False,
+        fq1=None, fq2=None, fqU=None, outdir='.', normalize=None,
+        compress=False, ncpu=1, keep_tmp=False, quiet=False, logfile=None,
+        debug=False,
     ):
     """ Pipeline step to error-correct reads using spades
 
@@ -72,6 +81,8 @@ def ec_reads(
         fq2 (str): Path to fastq file with read 2
         fqU (str): Path to fastq file with unpaired reads
         outdir (str): Path to output directory
+        normalize (int): Normalize read coverage to this target
+        compress (bool): Write gzip-compressed reads
         ncpu (int): Number of CPUs to use
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
@@ -100,12 +111,22 @@ def ec_reads(
     sysutils.check_dependency('spades.py')
 
     # Outputs
-    out1 = os.path.join(outdir, 'corrected_1.fastq')
-    out2 = os.path.join(outdir, 'corrected_2.fastq')
-    outU = os.path.join(outdir, 'corrected_U.fastq')
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    out1 = fq('corrected_1.fastq')
+    out2 = fq('corrected_2.fastq')
+    outU = fq('corrected_U.fastq')
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('ec_reads', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'ec_reads', None, quiet, logfile, inputs=[fq1, fq2, fqU]
+    )
+
+    # Normalize coverage
+    if normalize is not None:
+        fq1, fq2, fqU = normalize_reads.normalize_reads(
+            fq1=fq1, fq2=fq2, fqU=fqU, outdir=tempdir, target=normalize,
+            ncpu=ncpu, quiet=quiet, logfile=logfile, debug=debug
+        )
 
     # spades command
     cmd1 = [
@@ -128,23 +149,20 @@ def ec_reads(
     if not os.path.exists(yaml_file):
         sysutils.PipelineStepError("YAML file %s not found" % yaml_file)
 
+    import yaml
     with open(yaml_file, 'rU') as fh:
         d = yaml.load(fh, Loader=yaml.FullLoader)[0]
+    # SPAdes writes gzipped reads. Concatenated gzip files are valid gzip.
+    copy = ['cat', ] if compress else ['gunzip', '-c', ]
     cmds = []
-    if 'left reads' in d:
-        cmds.append(
-            ['gunzip', '-c', ] + sorted(d['left reads']) + ['>', out1]
-        )
-    if 'right reads' in d:
-        cmds.append(
-            ['gunzip', '-c', ] + sorted(d['right reads']) + ['>', out2]
-        )
-    if 'single reads' in d:
-        cmds.append(
-            ['gunzip', '-c', ] + sorted(d['single reads']) + ['>', outU]
-        )
+    for k, o in [('left reads', out1), ('right reads', out2),
+                 ('single reads', outU)]:
+        if k in d:
+            cmds.append(copy + sorted(d[k]) + ['>', o])
 
-    sysutils.command_runner(cmds, 'ec_reads', quiet, logfile, debug)
+    sysutils.command_runner(
+        [sysutils.ConcurrentCommands(cmds, ncpu)], 'ec_reads', quiet, logfile, debug
+    )
 
     if not keep_tmp:
         sysutils.remove_tempdir(tempdir, 'ec_reads', quiet, logfile)
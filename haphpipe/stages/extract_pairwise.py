@@ -5,7 +5,6 @@ from __future__ import print_function
 from __future__ import division
 from builtins import str
 from builtins import range
-from past.utils import old_div
 import sys
 # import os
 # import json
@@ -14,12 +13,10 @@ import argparse
 # from collections import defaultdict
 
 # from Bio import SeqIO
-from Bio.Seq import Seq
 
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
 # from haphpipe.utils.gtfparse import gtf_parser, GTFRow
-from haphpipe.utils.blastalign import load_slot_json
 
 from ..utils.sysutils import PipelineStepError
 
@@ -68,6 +65,10 @@ def extract_pairwise(align_json=None, outfile=None,
         outfmt=None, refreg=None,
         debug=False,
     ):
+    # Biopython is slow to import, only load it when the stage is run
+    from Bio.Seq import Seq
+    from haphpipe.utils.blastalign import load_slot_json
+
     outh = sys.stdout if outfile is None else open(outfile, 'w')
     
     if outfmt == 'nuc_fa' or outfmt == 'prot_fa':
@@ -80,7 +81,7 @@ def extract_pairwise(align_json=None, outfile=None,
                 if outfmt == 'nuc_fa':
                     print(sequtils.wrap(nucstr), file=outh)
                 else:
-                    s = Seq(nucstr[:(old_div(len(nucstr),3))*3])
+                    s = Seq(nucstr[:(len(nucstr) // 3)*3])
                     print(sequtils.wrap(str(s.translate())), file=outh)
         else:
             refmap = {sequtils.parse_seq_id(k)['ref']:k for k in list(jaln.keys())}
@@ -108,7 +109,7 @@ def extract_pairwise(align_json=None, outfile=None,
             if outfmt == 'nuc_fa':            
                 print(sequtils.wrap(nucstr), file=outh)
             else:
-                s = Seq(nucstr[:(old_div(len(nucstr),3))*3])
+                s = Seq(nucstr[:(len(nucstr) // 3)*3])
                 print(sequtils.wrap(str(s.translate())), file=outh)
 
     elif outfmt == 'aln_fa':
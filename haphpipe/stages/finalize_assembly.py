@@ -10,8 +10,6 @@ import os
 import argparse
 import shutil
 
-from Bio import SeqIO
-
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
 from haphpipe.stages import align_reads
@@ -79,6 +77,8 @@ def finalize_assembly(fq1=None, fq2=None, fqU=None, ref_fa=None, outdir='.',
     ):
     """ Pipeline step to finalize consensus
     """
+    from Bio import SeqIO
+
     # Outputs
     out_ref = os.path.join(outdir, 'final.fna')
     out_aligned = os.path.join(outdir, 'final.bam')
@@ -87,7 +87,7 @@ def finalize_assembly(fq1=None, fq2=None, fqU=None, ref_fa=None, outdir='.',
 
     # Temporary directory
     tempdir = sysutils.create_tempdir(
-        'finalize_assembly', None, quiet, logfile
+        'finalize_assembly', None, quiet, logfile, inputs=[fq1, fq2, fqU, ref_fa]
     )
 
     # Copy reference and rename sequences
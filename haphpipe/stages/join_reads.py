@@ -5,6 +5,7 @@ import os
 import argparse
 
 from haphpipe.utils import helpers
+from haphpipe.utils import gzutils
 from haphpipe.utils import sysutils
 
 
@@ -57,6 +58,8 @@ def stageparser(parser):
                         help='Quality score encoding')
 
     group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write gzip-compressed reads (.fastq.gz)')
     group3.add_argument('--ncpu', type=int,
                         help='Number of CPU to use')
     group3.add_argument('--keep_tmp', action='store_true',
@@ -73,7 +76,7 @@ def stageparser(parser):
 def join_reads(
         fq1=None, fq2=None, outdir=".",
         min_overlap=None, max_overlap=None, allow_outies=None,
-        encoding=None,
+        encoding=None, compress=False,
         ncpu=1, keep_tmp=False, quiet=False, logfile=None, debug=False,
     ):
     """ Pipeline step to join paired-end reads
@@ -86,6 +89,7 @@ def join_reads(
         max_overlap (int): Maximum overlap length
         allow_outies (bool): Try combining "outie" reads
         encoding (str): Quality score encoding
+        compress (bool): Write gzip-compressed reads
         ncpu (int): Number of CPUs to use
         keep_tmp (bool): Do not delete temporary directory
         quiet (bool): Do not write output to console
@@ -113,12 +117,15 @@ def join_reads(
         encoding = helpers.guess_encoding(fq1)
     
     # Outputs
-    outU = os.path.join(outdir, 'joined.fastq')
-    out1 = os.path.join(outdir, 'notjoined_1.fastq')
-    out2 = os.path.join(outdir, 'notjoined_2.fastq')
+    fq = lambda f: gzutils.fastq_name(f, compress)
+    outU = fq(os.path.join(outdir, 'joined.fastq'))
+    out1 = fq(os.path.join(outdir, 'notjoined_1.fastq'))
+    out2 = fq(os.path.join(outdir, 'notjoined_2.fastq'))
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('join_reads', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'join_reads', None, quiet, logfile, inputs=[fq1, fq2]
+    )
 
     # Flash command
     cmd1 = [
@@ -134,11 +141,18 @@ def join_reads(
         cmd1 += ['-M', '%d' % max_overlap]
     if allow_outies is True:
         cmd1 += ['-O']        
+    if compress:
+        # FLASh pipes each output through the compressor
+        prog = gzutils.compressor_args(ncpu)
+        cmd1 += ['--compress-prog=%s' % prog[0], '--output-suffix=gz', ]
+        if len(prog) > 1:
+            cmd1 += ["--compress-prog-args='%s'" % ' '.join(prog[1:]), ]
     cmd1 += [fq1, fq2]
 
-    cmd2 = ['mv', os.path.join(tempdir, 'out.extendedFrags.fastq'), outU, ]
-    cmd3 = ['mv', os.path.join(tempdir, 'out.notCombined_1.fastq'), out1, ]
-    cmd4 = ['mv', os.path.join(tempdir, 'out.notCombined_2.fastq'), out2, ]
+    tmp = lambda f: fq(os.path.join(tempdir, f))
+    cmd2 = ['mv', tmp('out.extendedFrags.fastq'), outU, ]
+    cmd3 = ['mv', tmp('out.notCombined_1.fastq'), out1, ]
+    cmd4 = ['mv', tmp('out.notCombined_2.fastq'), out2, ]
     sysutils.command_runner(
         [cmd1, cmd2, cmd3, cmd4, ], 'join_reads', quiet, logfile, debug
     )
@@ -4,7 +4,6 @@ import sys
 import argparse
 from haphpipe.utils import sysutils
 from haphpipe.utils.sysutils import MissingRequiredArgument
-from Bio import SeqIO
 
 __author__ = 'Margaret C. Steiner'
 __copyright__ = 'Copyright (C) 2020 Margaret C. Steiner'
@@ -103,6 +102,7 @@ def get_regions(ref_gtf):
 
 def generate_fastas(dir_list=None, ref_gtf=None, seqs=None, msadir='.'):
     ### function to format input data from individual fasta files ###
+    from Bio import SeqIO
 
     ## open dir_list
     if dir_list is not None:
@@ -262,6 +262,7 @@ def run_mafft(inputseqs=None, out_align="alignment.fasta", auto=None, algo=None,
     sysutils.command_runner([cmd1, ], 'multiple_align', quiet, logfile, debug)
 
     if phylipout is True:
+        from Bio import SeqIO
         phyout = outName[:-6] + '.phy'
         SeqIO.convert(outName, 'fasta', phyout, 'phylip-relaxed')  # relaxed allows for long sequence names
         cmd2 = ['echo', 'Output converted to PHYLIP format from FASTA format.']
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+
+from haphpipe.utils import gzutils
+from haphpipe.utils import sysutils
+from haphpipe.utils.sysutils import MissingRequiredArgument
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--fq1', type=sysutils.existing_file,
+                        help='Fastq file with read 1')
+    group1.add_argument('--fq2', type=sysutils.existing_file,
+                        help='Fastq file with read 2')
+    group1.add_argument('--fqU', type=sysutils.existing_file,
+                        help='Fastq file with unpaired reads')
+    group1.add_argument('--outdir', type=sysutils.existing_dir, default='.',
+                        help='Output directory')
+
+    group2 = parser.add_argument_group('Normalization options')
+    group2.add_argument('--target', type=int, default=20,
+                        help='''Target coverage. Reads whose median k-mer
+                                abundance reaches the target are discarded.''')
+    group2.add_argument('--ksize', type=int, default=20,
+                        help='K-mer size (at most 31)')
+    group2.add_argument('--max_memory', type=int, default=1024,
+                        help='Memory for counting k-mers, in MB')
+
+    group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write gzip-compressed reads (.fastq.gz)')
+    group3.add_argument('--ncpu', type=int, default=1,
+                        help='Number of CPU to use')
+    group3.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group3.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    group3.add_argument('--debug', action='store_true',
+                        help='Print commands but do not run')
+    parser.set_defaults(func=normalize_reads)
+
+
+def normalize_reads(
+        fq1=None, fq2=None, fqU=None, outdir='.',
+        target=20, ksize=20, max_memory=1024, compress=False,
+        ncpu=1, quiet=False, logfile=None, debug=False,
+    ):
+    """ Pipeline step to normalize read coverage
+
+    Reads are discarded if the median abundance of their k-mers, among the
+    reads kept so far, has reached the target coverage. Pairs are kept or
+    discarded together. Unpaired reads are normalized after the pairs,
+    counting the k-mers of kept pairs.
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        fqU (str): Path to fastq file with unpaired reads
+        outdir (str): Path to output directory
+        target (int): Target coverage
+        ksize (int): K-mer size
+        max_memory (int): Memory for counting k-mers, in MB
+        compress (bool): Write gzip-compressed reads
+        ncpu (int): Number of CPUs to use
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        out1 (str): Path to normalized fastq file with read 1
+        out2 (str): Path to normalized fastq file with read 2
+        outU (str): Path to normalized fastq file with unpaired reads
+
+    """
+    # Check inputs
+    if fq1 is not None and fq2 is not None and fqU is None:
+        input_reads = "paired"  # Paired end
+    elif fq1 is None and fq2 is None and fqU is not None:
+        input_reads = "single"  # Single end
+    elif fq1 is not None and fq2 is not None and fqU is not None:
+        input_reads = "both"
+    else:
+        msg = "incorrect input reads; requires either "
+        msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
+        raise MissingRequiredArgument(msg)
+
+    # Outputs
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    jobs = []
+    out1 = out2 = outU = None
+    if input_reads in ['paired', 'both', ]:
+        out1 = fq('normalized_1.fastq')
+        out2 = fq('normalized_2.fastq')
+        jobs.append(('pairs', [fq1, fq2], [out1, out2]))
+    if input_reads in ['single', 'both', ]:
+        outU = fq('normalized_U.fastq')
+        jobs.append(('unpaired reads', [fqU], [outU]))
+
+    for label, inputs, outputs in jobs:
+        sysutils.log_message(
+            '[--- normalize_reads ---] %s -> %s\n' % (
+                ' '.join(inputs), ' '.join(outputs)
+            ), quiet, logfile
+        )
+    if debug:
+        return out1, out2, outU
+
+    from haphpipe.utils import fastq
+    from haphpipe.utils import normalize
+    from haphpipe.utils import readsampler
+
+    try:
+        normalizer = normalize.Normalizer(target, ksize, max_memory << 20)
+    except ValueError as e:
+        raise sysutils.PipelineStepError(str(e))
+
+    # Jobs share the normalizer, so are run in order
+    for label, inputs, outputs in jobs:
+        try:
+            nin, nout = normalize.normalize(inputs, outputs, normalizer, ncpu)
+        except (readsampler.MateMismatchError, fastq.FastqFormatError) as e:
+            raise sysutils.PipelineStepError(str(e))
+        sysutils.log_message(
+            '[--- normalize_reads ---] Kept %d of %d %s\n' % (
+                nout, nin, label
+            ), quiet, logfile
+        )
+    return out1, out2, outU
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Normalize read coverage.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
@@ -10,13 +10,10 @@ import argparse
 import json
 from collections import defaultdict
 
-from Bio import SeqIO
-
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
-from haphpipe.utils import gtfparse
+from haphpipe.utils import refstore
 from haphpipe.utils.gtfparse import GTFRow
-from haphpipe.utils import blastalign as baln
 
 
 __author__ = 'Matthew L. Bendall'
@@ -96,6 +93,9 @@ def pairwise_align(
         out_aln (str): Path to alignment in JSON format
 
     """
+    from Bio import SeqIO
+    from haphpipe.utils import blastalign as baln
+
     # Check dependencies
     sysutils.check_dependency('blastx')
 
@@ -106,10 +106,10 @@ def pairwise_align(
     tempdir = sysutils.create_tempdir('pairwise_align', None, quiet, logfile)
 
     # Load reference sequence(s)
-    refseqs = {s.id:s for s in SeqIO.parse(ref_fa, 'fasta')}
+    refseqs = refstore.load_fasta(ref_fa)
     
     # Load amplicons from GTF file
-    amps = [gl for gl in gtfparse.gtf_parser(ref_gtf) if
+    amps = [gl for gl in refstore.load_gtf(ref_gtf) if
             gl.feature == 'amplicon']
     ampdict = {(gl.chrom, gl.attrs['name']):gl for gl in amps}
     
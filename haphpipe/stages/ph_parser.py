@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 from __future__ import division
-from past.utils import old_div
 import argparse
 import os
 
@@ -108,7 +107,7 @@ def ph_parser(
         freq_sqrd = [x ** 2 for x in freq]
         freq_sqrd_sum = sum(freq_sqrd)
 
-        hap_div = ((old_div(7000, (7000 - 1))) * (1 - freq_sqrd_sum))
+        hap_div = ((7000 // (7000 - 1)) * (1 - freq_sqrd_sum))
 
         print("PH_num_hap %s" % num_hap, file=summary_txt)
         print("PH_hap_diversity %s" % hap_div, file=summary_txt)
@@ -11,10 +11,9 @@ import argparse
 from glob import glob
 import shutil
 
-from Bio import SeqIO
-
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
+from haphpipe.utils import refindex
 from haphpipe.utils.sysutils import PipelineStepError
 
 
@@ -194,12 +193,16 @@ def predict_haplo(
         best_fa (list): Path to best haplotype files (FASTA)
 
     """
+    from Bio import SeqIO
+
     # Check dependencies
     sysutils.check_dependency('PredictHaplo-Paired')
     sysutils.check_dependency('bwa')
 
     # Temporary directory
-    tempdir = sysutils.create_tempdir('predict_haplo', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'predict_haplo', None, quiet, logfile, inputs=[fq1, fq2, ref_fa]
+    )
 
     # Load reference fasta
     refs = {s.id:s for s in SeqIO.parse(ref_fa, 'fasta')}
@@ -231,12 +234,15 @@ def predict_haplo(
             tmp_ref_fa = os.path.join(tempdir, 'ref.%d.fa' % len(alnmap))
             tmp_sam = os.path.join(tempdir, 'aligned.%d.sam' % len(alnmap))
             SeqIO.write(refs[rname], tmp_ref_fa, 'fasta')
-            cmd1 = ['bwa', 'index', tmp_ref_fa, ]
-            cmd2 = ['bwa', 'mem', tmp_ref_fa, fq1, fq2, '|', 'samtools', 'view', '-h', '-F', '12', '>', tmp_sam, ]
-            cmd3 = ['rm', '-f', '%s.*' % tmp_ref_fa]
+            refidx = refindex.get_index(
+                tmp_ref_fa, ['bwa', ], tempdir, 'predict_haplo:index',
+                quiet=quiet, logfile=logfile, debug=debug
+            )
+            cmd2 = ['bwa', 'mem', refidx.path('bwa'), fq1, fq2, '|', 'samtools', 'view', '-h', '-F', '12', '>', tmp_sam, ]
             sysutils.command_runner(
-                [cmd1, cmd2, cmd3], 'predict_haplo:setup', quiet, logfile, debug
+                [cmd2, ], 'predict_haplo:setup', quiet, logfile, debug
             )
+            refidx.release()
             alnmap[rname] = (tmp_ref_fa, tmp_sam)
     
     best_fa = []
@@ -16,11 +16,9 @@ import argparse
 import random
 from collections import OrderedDict
 
-from Bio import SeqIO
-from Bio import pairwise2
-
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
+from haphpipe.utils import telemetry
 from haphpipe.stages import align_reads
 from haphpipe.stages import call_variants
 from haphpipe.stages import vcf_to_consensus
@@ -70,8 +68,13 @@ def stageparser(parser):
     group2 = parser.add_argument_group('Refinement options')
     group2.add_argument('--max_step', type=int, default=1,
                         help='Maximum number of refinement steps')
-    group2.add_argument('--subsample', type=int,
-                        help='Use a subsample of reads for refinement.')
+    group2.add_argument('--subsample', type=sample_reads.subsample_arg,
+                        help='''Use a subsample of reads for refinement. With
+                                "auto", the number of reads is chosen to
+                                reach --target_depth over --ref_fa.''')
+    group2.add_argument('--target_depth', type=int,
+                        default=sample_reads.TARGET_DEPTH,
+                        help='Target depth for --subsample auto')
     group2.add_argument('--seed', type=int,
                         help='''Seed for random number generator (ignored if
                                 not subsampling).''')
@@ -82,8 +85,10 @@ def stageparser(parser):
     group3.add_argument('--ncpu', type=int, default=1,
                         help='Number of CPUs to use')
     group3.add_argument('--xmx', type=int,
-                        default=sysutils.get_java_heap_size(),
-                        help='Maximum heap size for Java VM, in GB.')
+                        help='''Maximum heap size for Java VM, in GB. By
+                                default, determined from input sizes, the
+                                memory limit (including cgroup limits) and
+                                other running JVMs.''')
     group3.add_argument('--keep_tmp', action='store_true',
                         help='Do not delete temporary directory')
     group3.add_argument('--quiet', action='store_true',
@@ -97,6 +102,13 @@ def stageparser(parser):
 
 
 def refine_assembly(**kwargs):
+    target_depth = kwargs.pop('target_depth', sample_reads.TARGET_DEPTH)
+    if kwargs.get('subsample') == 'auto':
+        kwargs['subsample'] = sample_reads.auto_subsample(
+            fq1=kwargs.get('fq1'), fq2=kwargs.get('fq2'), fqU=kwargs.get('fqU'),
+            ref_fa=kwargs.get('ref_fa'), target_depth=target_depth,
+            quiet=kwargs.get('quiet', False), logfile=kwargs.get('logfile')
+        )
     max_step = kwargs.pop('max_step')
     if max_step == 1:
         kwargs['iteration'] = None
@@ -109,11 +121,13 @@ def refine_assembly(**kwargs):
 def refine_assembly_step(
         fq1=None, fq2=None, fqU=None, ref_fa=None, outdir='.',
         iteration=None, subsample=None, seed=None, sample_id='sampleXX',
-        ncpu=1, xmx=sysutils.get_java_heap_size(),
+        ncpu=1, xmx=None,
         keep_tmp=False, quiet=False, logfile=None, debug=False,
     ):
     # Temporary directory
-    tempdir = sysutils.create_tempdir('refine_assembly', None, quiet, logfile)
+    tempdir = sysutils.create_tempdir(
+        'refine_assembly', None, quiet, logfile, inputs=[fq1, fq2, fqU, ref_fa]
+    )
 
     if subsample is not None:
         seed = seed if seed is not None else random.randrange(1, 1000)
@@ -165,9 +179,11 @@ def refine_assembly_step(
 def progressive_refine_assembly(
         fq1=None, fq2=None, fqU=None, ref_fa=None, outdir='.',
         max_step=None, subsample=None, seed=None, sample_id='sampleXX',
-        ncpu=1, xmx=sysutils.get_java_heap_size(),
+        ncpu=1, xmx=None,
         keep_tmp=False, quiet=False, logfile=None, debug=False,
     ):
+    from Bio import SeqIO
+    from Bio import pairwise2
 
     # Outputs
     out_refined = os.path.join(outdir, 'refined.fna')
@@ -191,12 +207,14 @@ def progressive_refine_assembly(
     
     for i in range(1, max_step+1):
         # Generate a refined assembly
-        tmp_refined, tmp_bt2 = refine_assembly_step(
-            fq1=fq1, fq2=fq2, fqU=fqU, ref_fa=cur_asm, outdir=outdir,
-            iteration=i, subsample=subsample, sample_id=sample_id,
-            ncpu=ncpu, xmx=xmx, keep_tmp=keep_tmp,
-            quiet=True, logfile=logfile, debug=debug
-        )
+        with telemetry.context(iteration=i), \
+                telemetry.span('iteration', 'refine_assembly'):
+            tmp_refined, tmp_bt2 = refine_assembly_step(
+                fq1=fq1, fq2=fq2, fqU=fqU, ref_fa=cur_asm, outdir=outdir,
+                iteration=i, subsample=subsample, sample_id=sample_id,
+                ncpu=ncpu, xmx=xmx, keep_tmp=keep_tmp,
+                quiet=True, logfile=logfile, debug=debug
+            )
 
         # Check whether alignments are different
         diffs = OrderedDict()
@@ -0,0 +1,348 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import dagrunner
+from haphpipe.utils import stagecache
+from haphpipe.utils import telemetry
+from haphpipe.utils import gzutils
+from haphpipe.utils import resources
+from haphpipe.utils.sysutils import MissingRequiredArgument
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Number of CPUs each pipeline stage can make use of. A stage holds its
+    CPUs until it finishes, so stages with single-threaded steps get fewer.
+
+    trim_reads, ec_reads and assemble_denovo are dominated by Trimmomatic,
+    BayesHammer and SPAdes, which scale to many threads. assemble_amplicons
+    (nucmer) is single-threaded.
+
+    In refine_assembly and finalize_assembly only bowtie2, samtools sort and
+    UnifiedGenotyper are multithreaded; about half of each iteration is
+    spent in single-threaded picard MarkDuplicates, GATK IndelRealigner and
+    vcf_to_consensus. With half of the work parallel, n CPUs finish an
+    iteration in 0.5 + 0.5/n of the single-threaded time: 0.56 with 8 CPUs,
+    0.63 with 4. Four CPUs are 11% slower than eight but leave the other four
+    to stages of other samples, which would otherwise be idle for most of
+    the stage.
+"""
+STAGE_THREADS = {
+    'trim_reads': 8,
+    'ec_reads': 16,
+    'assemble_denovo': 16,
+    'assemble_amplicons': 1,
+    'refine_assembly': 4,
+    'finalize_assembly': 4,
+}
+
+
+def default_ncpu():
+    """ Number of CPUs to use by default
+
+    First examines NCPU environment variable, then the number of CPUs this
+    process may use (CPU affinity and cgroup CPU quota).
+    """
+    if 'NCPU' in os.environ:
+        return int(os.environ['NCPU'])
+    return resources.available_cpus()
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--fq1', type=sysutils.existing_file, required=True,
+                        help='Fastq file with read 1. May be compressed (.gz)')
+    group1.add_argument('--fq2', type=sysutils.existing_file, required=True,
+                        help='Fastq file with read 2. May be compressed (.gz)')
+    group1.add_argument('--ref_fa', type=sysutils.existing_file, required=True,
+                        help='''Reference sequence (fasta). For assemble_02,
+                                this is the amplicon reference.''')
+    group1.add_argument('--ref_gtf', type=sysutils.existing_file,
+                        help='Amplicon regions (GTF). Required for assemble_01')
+    group1.add_argument('--outdir', type=sysutils.new_or_existing_dir,
+                        default='.',
+                        help='Output directory')
+
+    group2 = parser.add_argument_group('Pipeline options')
+    group2.add_argument('--pipeline', default='assemble_01',
+                        choices=sorted(PIPELINES.keys()),
+                        help='''Pipeline to run. assemble_01 uses denovo
+                                assembly, assemble_02 uses reference-based
+                                assembly.''')
+    group2.add_argument('--sample_id', default='sampleXX',
+                        help='Sample ID.')
+    group2.add_argument('--max_step', type=int, default=5,
+                        help='Maximum number of refinement steps')
+    group2.add_argument('--compress', action='store_true',
+                        help='''Keep trimmed and corrected reads
+                                gzip-compressed (.fastq.gz)''')
+    group2.add_argument('--force', action='store_true',
+                        help='Rerun stages that have already completed')
+    group2.add_argument('--cache_dir', type=sysutils.new_or_existing_dir,
+                        help='''Reuse results of stages that were run earlier
+                                with the same inputs and parameters. Results
+                                are stored in this directory.''')
+    group2.add_argument('--cache_size', type=stagecache.parse_size,
+                        help='''Maximum size of cache, e.g. "200G". Least
+                                recently used results are removed first.''')
+
+    group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--ncpu', type=int, default=default_ncpu(),
+                        help='''Total number of CPUs shared by all running
+                                stages''')
+    group3.add_argument('--keep_tmp', action='store_true',
+                        help='Do not delete temporary directory')
+    group3.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group3.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    group3.add_argument('--trace',
+                        help='''Append resource usage of each stage and command
+                                to this file (JSON lines). See
+                                "haphpipe trace_report".''')
+    group3.add_argument('--debug', action='store_true',
+                        help='Print commands but do not run')
+    parser.set_defaults(func=run)
+
+
+def build_assemble_01(fq1=None, fq2=None, ref_fa=None, ref_gtf=None,
+                      outdir='.', sample_id='sampleXX', max_step=5,
+                      compress=False, keep_tmp=False):
+    """ Amplicon assembly using a denovo approach
+
+    Reads are error-corrected and used to refine the initial assembly, with
+    up to "max_step" refinement steps. Error correction and denovo assembly
+    of the trimmed reads are independent and run concurrently.
+
+    Returns:
+        dag (dagrunner.StageDAG): Pipeline graph
+
+    """
+    from haphpipe.stages import trim_reads
+    from haphpipe.stages import ec_reads
+    from haphpipe.stages import assemble_denovo
+    from haphpipe.stages import assemble_amplicons
+    from haphpipe.stages import refine_assembly
+    from haphpipe.stages import finalize_assembly
+
+    if ref_gtf is None:
+        raise MissingRequiredArgument('assemble_01 requires --ref_gtf')
+
+    o = lambda f: os.path.join(outdir, f)
+    fq = lambda f: gzutils.fastq_name(o(f), compress)
+    dag = dagrunner.StageDAG('assemble_01', o('.haphpipe'), sample_id)
+    dag.add('trim_reads', trim_reads.trim_reads,
+        kwargs={'fq1': fq1, 'fq2': fq2, 'outdir': outdir,
+                'compress': compress},
+        outputs=[fq('trimmed_1.fastq'), fq('trimmed_2.fastq')],
+        max_threads=STAGE_THREADS['trim_reads'],
+    )
+    dag.add('ec_reads', ec_reads.ec_reads,
+        kwargs={'fq1': fq('trimmed_1.fastq'), 'fq2': fq('trimmed_2.fastq'),
+                'outdir': outdir, 'compress': compress, 'keep_tmp': keep_tmp},
+        deps=['trim_reads'],
+        outputs=[fq('corrected_1.fastq'), fq('corrected_2.fastq')],
+        max_threads=STAGE_THREADS['ec_reads'],
+    )
+    dag.add('assemble_denovo', assemble_denovo.assemble_denovo,
+        kwargs={'fq1': fq('trimmed_1.fastq'), 'fq2': fq('trimmed_2.fastq'),
+                'outdir': outdir, 'assembler': 'spades',
+                'keep_tmp': keep_tmp},
+        deps=['trim_reads'],
+        outputs=[o('denovo_contigs.fna')],
+        max_threads=STAGE_THREADS['assemble_denovo'],
+    )
+    dag.add('assemble_amplicons', assemble_amplicons.assemble_amplicons,
+        kwargs={'contigs_fa': o('denovo_contigs.fna'), 'ref_fa': ref_fa,
+                'ref_gtf': ref_gtf, 'sample_id': sample_id, 'outdir': outdir,
+                'keep_tmp': keep_tmp},
+        deps=['assemble_denovo'],
+        outputs=[o('amplicon_assembly.fna')],
+        max_threads=STAGE_THREADS['assemble_amplicons'],
+    )
+    dag.add('refine_assembly', refine_assembly.refine_assembly,
+        kwargs={'fq1': fq('corrected_1.fastq'), 'fq2': fq('corrected_2.fastq'),
+                'ref_fa': o('amplicon_assembly.fna'), 'sample_id': sample_id,
+                'max_step': max_step, 'outdir': outdir, 'keep_tmp': keep_tmp},
+        deps=['ec_reads', 'assemble_amplicons'],
+        outputs=[o('refined.fna')],
+        max_threads=STAGE_THREADS['refine_assembly'],
+    )
+    dag.add('finalize_assembly', finalize_assembly.finalize_assembly,
+        kwargs={'fq1': fq('corrected_1.fastq'), 'fq2': fq('corrected_2.fastq'),
+                'ref_fa': o('refined.fna'), 'sample_id': sample_id,
+                'outdir': outdir, 'keep_tmp': keep_tmp},
+        deps=['refine_assembly'],
+        outputs=[o('final.fna'), o('final.bam'), o('final.vcf.gz')],
+        max_threads=STAGE_THREADS['finalize_assembly'],
+    )
+    return dag
+
+
+def build_assemble_02(fq1=None, fq2=None, ref_fa=None, ref_gtf=None,
+                      outdir='.', sample_id='sampleXX', max_step=5,
+                      compress=False, keep_tmp=False):
+    """ Amplicon assembly using a reference-based approach
+
+    Reads are error-corrected and aligned to the provided amplicon reference
+    with up to "max_step" refinement steps.
+
+    Returns:
+        dag (dagrunner.StageDAG): Pipeline graph
+
+    """
+    from haphpipe.stages import trim_reads
+    from haphpipe.stages import ec_reads
+    from haphpipe.stages import refine_assembly
+    from haphpipe.stages import finalize_assembly
+
+    o = lambda f: os.path.join(outdir, f)
+    fq = lambda f: gzutils.fastq_name(o(f), compress)
+    dag = dagrunner.StageDAG('assemble_02', o('.haphpipe'), sample_id)
+    dag.add('trim_reads', trim_reads.trim_reads,
+        kwargs={'fq1': fq1, 'fq2': fq2, 'outdir': outdir,
+                'compress': compress},
+        outputs=[fq('trimmed_1.fastq'), fq('trimmed_2.fastq')],
+        max_threads=STAGE_THREADS['trim_reads'],
+    )
+    dag.add('ec_reads', ec_reads.ec_reads,
+        kwargs={'fq1': fq('trimmed_1.fastq'), 'fq2': fq('trimmed_2.fastq'),
+                'outdir': outdir, 'compress': compress, 'keep_tmp': keep_tmp},
+        deps=['trim_reads'],
+        outputs=[fq('corrected_1.fastq'), fq('corrected_2.fastq')],
+        max_threads=STAGE_THREADS['ec_reads'],
+    )
+    dag.add('refine_assembly', refine_assembly.refine_assembly,
+        kwargs={'fq1': fq('corrected_1.fastq'), 'fq2': fq('corrected_2.fastq'),
+                'ref_fa': ref_fa, 'sample_id': sample_id,
+                'max_step': max_step, 'outdir': outdir, 'keep_tmp': keep_tmp},
+        deps=['ec_reads'],
+        outputs=[o('refined.fna')],
+        max_threads=STAGE_THREADS['refine_assembly'],
+    )
+    dag.add('finalize_assembly', finalize_assembly.finalize_assembly,
+        kwargs={'fq1': fq('corrected_1.fastq'), 'fq2': fq('corrected_2.fastq'),
+                'ref_fa': o('refined.fna'), 'sample_id': sample_id,
+                'outdir': outdir, 'keep_tmp': keep_tmp},
+        deps=['refine_assembly'],
+        outputs=[o('final.fna'), o('final.bam'), o('final.vcf.gz')],
+        max_threads=STAGE_THREADS['finalize_assembly'],
+    )
+    return dag
+
+
+PIPELINES = {
+    'assemble_01': build_assemble_01,
+    'assemble_02': build_assemble_02,
+}
+
+""" Reference files that must be given for each pipeline """
+REQUIRED_REFS = {
+    'assemble_01': ['ref_fa', 'ref_gtf', ],
+    'assemble_02': ['ref_fa', ],
+}
+
+
+def run(
+        fq1=None, fq2=None, ref_fa=None, ref_gtf=None, outdir='.',
+        pipeline='assemble_01', sample_id='sampleXX', max_step=5,
+        compress=False, force=False, cache_dir=None, cache_size=None, ncpu=1,
+        keep_tmp=False, quiet=False, logfile=None, trace=None, debug=False,
+    ):
+    """ Run a complete assembly pipeline
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        ref_fa (str): Path to reference fasta file
+        ref_gtf (str): Path to GTF file with amplicon regions
+        outdir (str): Path to output directory
+        pipeline (str): Name of pipeline to run
+        sample_id (str): Sample ID
+        max_step (int): Maximum number of refinement steps
+        compress (bool): Keep trimmed and corrected reads compressed
+        force (bool): Rerun stages that have already completed
+        cache_dir (str): Path to stage cache directory
+        cache_size (int): Maximum size of stage cache in bytes
+        ncpu (int): Total number of CPUs shared by all running stages
+        keep_tmp (bool): Do not delete temporary directory
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        trace (str): Append resource usage trace to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        executed (list): Names of stages that were run
+
+    """
+    if pipeline not in PIPELINES:
+        raise sysutils.PipelineStepError('Unknown pipeline: %s' % pipeline)
+
+    dag = PIPELINES[pipeline](
+        fq1=fq1, fq2=fq2, ref_fa=ref_fa, ref_gtf=ref_gtf, outdir=outdir,
+        sample_id=sample_id, max_step=max_step, compress=compress,
+        keep_tmp=keep_tmp,
+    )
+    if trace is not None:
+        telemetry.enable(trace)
+    cache = None
+    if cache_dir is not None:
+        cache = stagecache.StageCache(cache_dir, cache_size)
+    return dagrunner.run_dag(
+        dag, ncpu=ncpu, force=force, cache=cache,
+        quiet=quiet, logfile=logfile, debug=debug
+    )
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Run an assembly pipeline.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
@@ -6,7 +6,10 @@ import sys
 import os
 import argparse
 import random
+from concurrent.futures import ThreadPoolExecutor
 
+from haphpipe.utils import helpers
+from haphpipe.utils import sequtils
 from haphpipe.utils import sysutils
 from haphpipe.utils.sysutils import MissingRequiredArgument
 
@@ -27,6 +30,90 @@ __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+""" Default depth for automatic subsample size (--subsample auto) """
+TARGET_DEPTH = 1000
+
+
+def subsample_arg(value):
+    """ Argument type for --subsample: number of reads or "auto" """
+    if value == 'auto':
+        return value
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError(
+            'must be a positive number of reads or "auto": %s' % value
+        )
+    return n
+
+
+def auto_subsample(
+        fq1=None, fq2=None, fqU=None, ref_fa=None, target_depth=TARGET_DEPTH,
+        quiet=False, logfile=None,
+    ):
+    """ Number of reads to sample to reach a target depth
+
+    The number of reads and mean read length of each file are estimated
+    from a sample of the file (see readsampler.estimate_reads), and the
+    depth is computed over the total length of the reference sequences.
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        fqU (str): Path to fastq file with unpaired reads
+        ref_fa (str): Path to reference fasta file
+        target_depth (int): Target depth
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+
+    Returns:
+        nreads (int): Number of reads (or pairs) to sample, or None if the
+            reads do not exceed the target depth
+
+    """
+    if ref_fa is None:
+        raise MissingRequiredArgument('--subsample auto requires --ref_fa')
+    from haphpipe.utils import readsampler
+
+    with open(ref_fa, 'r') as fh:
+        reflen = sum(len(s) for n, s in sequtils.fastagen(fh) if n is not None)
+    nreads = 0
+    bases_per_read = 0.0
+    total_bases = 0.0
+    for f in [fq1, fq2, fqU]:
+        if f is None:
+            continue
+        n, meanlen = readsampler.estimate_reads(f)
+        # Pairs and unpaired reads are sampled nreads each
+        nreads = max(nreads, n)
+        bases_per_read += meanlen
+        total_bases += n * meanlen
+    if not reflen or not bases_per_read:
+        raise sysutils.PipelineStepError('Cannot estimate depth: no reads or '
+                                         'empty reference')
+    depth = total_bases / reflen
+    subsample = int(-(-target_depth * reflen // bases_per_read))
+    msg = '[--- sample_reads ---] Estimated %d reads (or pairs) of ' % nreads
+    msg += '%.0f bases, ' % bases_per_read
+    msg += 'depth %.0fx over %d bp\n' % (depth, reflen)
+    sysutils.log_message(msg, quiet, logfile)
+    if subsample >= nreads:
+        sysutils.log_message(
+            '[--- sample_reads ---] Depth below %dx, using all reads\n' % (
+                target_depth
+            ), quiet, logfile
+        )
+        return None
+    sysutils.log_message(
+        '[--- sample_reads ---] Sampling %d reads for %dx depth\n' % (
+            subsample, target_depth
+        ), quiet, logfile
+    )
+    return subsample
+
+
 def stageparser(parser):
     """ Add stage-specific options to argparse parser
 
@@ -52,14 +139,21 @@ def stageparser(parser):
     group2a.add_argument('--nreads', type=int,
                         help='''Number of reads to sample. If greater than the
                                 number of reads in file, all reads will be
-                                sampled.''')
+                                sampled. Pairs are sampled together.''')
     group2a.add_argument('--frac', type=float,
                         help='''Fraction of reads to sample, between 0 and 1.
                                 Each read has [frac] probability of being
                                 sampled, so number of sampled reads is not
-                                precisely [frac * num_reads].''')
+                                precisely [frac * num_reads]. Whether a read
+                                is sampled depends on its name and the seed.''')
     group2.add_argument('--seed', type=int,
                         help='''Seed for random number generator.''')
+    group2.add_argument('--qc', action='store_true',
+                        help='''Collect statistics of all input reads while
+                                sampling (sample.qc.json).''')
+    group2.add_argument('--encoding',
+                        choices=['Phred+33', 'Phred+64'],
+                        help='Quality score encoding, for read statistics')
 
     group3 = parser.add_argument_group('Settings')
     group3.add_argument('--quiet', action='store_true',
@@ -74,10 +168,15 @@ def stageparser(parser):
 
 def sample_reads(
         fq1=None, fq2=None, fqU=None, outdir='.',
-        nreads=None, frac=None, seed=None,
+        nreads=None, frac=None, seed=None, qc=False, encoding=None,
         quiet=False, logfile=None, debug=False,
     ):
-    """
+    """ Subsample reads
+
+    Reads in fq1 and fq2 are sampled as pairs, in a single pass over both
+    files. With nreads, exactly nreads reads (or pairs) are sampled from
+    each input using reservoir sampling. With frac, reads are sampled by a
+    hash of the read name. Output is gzip-compressed.
 
     Args:
         fq1 (str): Path to fastq file with read 1
@@ -87,6 +186,8 @@ def sample_reads(
         nreads (int): Number of reads to sample
         frac (float): Fraction of reads to sample
         seed (int): Seed for random number generator
+        qc (bool): Write statistics of input reads to sample.qc.json
+        encoding (str): Quality score encoding
         quiet (bool): Do not write output to console
         logfile (file): Append console output to this file
         debug (bool): Print commands but do not run
@@ -108,9 +209,6 @@ def sample_reads(
         msg += "(--fq1 AND --fq2) OR (--fqU) OR (--fq1 AND --fq2 AND --fqU)"
         raise MissingRequiredArgument(msg)
 
-    # Check dependencies
-    sysutils.check_dependency('seqtk')
-
     # Set seed
     seed = seed if seed is not None else random.randrange(1,1000)
     sysutils.log_message(
@@ -121,36 +219,64 @@ def sample_reads(
     if frac is not None:
         if frac <= 0 or frac > 1:
             raise sysutils.PipelineStepError('--frac must be > 0 and <= 1.')
-        frac_arg = '%f' % frac
-    else:
-        frac_arg = '%d' % nreads
-
-    cmds  = None
-    if input_reads == 'single':
-        out1 = out2 = None
-        outU = os.path.join(outdir, 'sample_U.fastq')
-        cmds = [
-            [ 'seqtk', 'sample', '-s%d' % seed, fqU, frac_arg, '>', outU, ],
-        ]
-    elif input_reads == 'paired':
-        out1 = os.path.join(outdir, 'sample_1.fastq')
-        out2 = os.path.join(outdir, 'sample_2.fastq')
-        outU = None
-        cmds = [
-            ['seqtk', 'sample', '-s%d' % seed, fq1, frac_arg, '>', out1, ],
-            ['seqtk', 'sample', '-s%d' % seed, fq2, frac_arg, '>', out2, ],
-        ]
-    elif input_reads == 'both':
-        out1 = os.path.join(outdir, 'sample_1.fastq')
-        out2 = os.path.join(outdir, 'sample_2.fastq')
-        outU = os.path.join(outdir, 'sample_U.fastq')
-        cmds = [
-            ['seqtk', 'sample', '-s%d' % seed, fq1, frac_arg, '>', out1, ],
-            ['seqtk', 'sample', '-s%d' % seed, fq2, frac_arg, '>', out2, ],
-            ['seqtk', 'sample', '-s%d' % seed, fqU, frac_arg, '>', outU, ],
-        ]
-
-    sysutils.command_runner(cmds, 'sample_reads', quiet, logfile, debug)
+
+    # Mates are sampled together, unpaired reads separately
+    jobs = []
+    out1 = out2 = outU = None
+    if input_reads in ['paired', 'both', ]:
+        out1 = os.path.join(outdir, 'sample_1.fastq.gz')
+        out2 = os.path.join(outdir, 'sample_2.fastq.gz')
+        jobs.append(('pairs', [fq1, fq2], [out1, out2], ['1', '2']))
+    if input_reads in ['single', 'both', ]:
+        outU = os.path.join(outdir, 'sample_U.fastq.gz')
+        jobs.append(('unpaired reads', [fqU], [outU], ['U']))
+
+    for label, inputs, outputs, _ in jobs:
+        sysutils.log_message(
+            '[--- sample_reads ---] %s -> %s\n' % (
+                ' '.join(inputs), ' '.join(outputs)
+            ), quiet, logfile
+        )
+    if debug:
+        return out1, out2, outU
+
+    from haphpipe.utils import fastq
+    from haphpipe.utils import readqc
+    from haphpipe.utils import readsampler
+
+    # Statistics are collected from the reads as they are sampled
+    qcs = {}
+    if qc:
+        out_qc = os.path.join(outdir, readqc.SAMPLE_QC)
+        if encoding is None:
+            encoding = helpers.guess_encoding(fq1 if fq1 is not None else fqU)
+        for _, _, _, labels in jobs:
+            for l in labels:
+                qcs[l] = readqc.ReadQC(readqc.encoding_offset(encoding))
+
+    def run_job(job):
+        label, inputs, outputs, labels = job
+        jqcs = [qcs[l] for l in labels] if qc else None
+        try:
+            if frac is not None:
+                return readsampler.sample_frac(inputs, outputs, frac, seed,
+                                               jqcs)
+            return readsampler.sample_nreads(inputs, outputs, nreads, seed,
+                                             jqcs)
+        except (readsampler.MateMismatchError, fastq.FastqFormatError) as e:
+            raise sysutils.PipelineStepError(str(e))
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = list(pool.map(run_job, jobs))
+
+    for (label, _, _, _), (nseen, nkept) in zip(jobs, results):
+        sysutils.log_message(
+            '[--- sample_reads ---] Sampled %d of %d %s\n' % (
+                nkept, nseen, label
+            ), quiet, logfile
+        )
+    if qc:
+        readqc.write_sidecar(out_qc, qcs)
     return out1, out2, outU
 
 
@@ -162,7 +288,7 @@ def console():
 
     """
     parser = argparse.ArgumentParser(
-        description='Subsample reads using seqtk.',
+        description='Subsample reads.',
         formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
     )
     stageparser(parser)
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import json
+import argparse
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import daemon
+from haphpipe.utils import resources
+from haphpipe.utils.sysutils import PipelineStepError
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Daemon options')
+    group1.add_argument('--socket',
+                        help='''Path to UNIX socket (default: HAPHPIPE_SOCKET,
+                                or haphpipe/serve.sock in XDG_RUNTIME_DIR, or
+                                haphpipe-<uid>/serve.sock in the temporary
+                                directory). The directory must not be writable
+                                by other users.''')
+    group1.add_argument('--nworkers', type=int,
+                        help='''Number of worker processes (default: number
+                                of available CPUs).''')
+    group1.add_argument('--preload', nargs='+', type=sysutils.existing_file,
+                        help='''Reference FASTA and GTF files to parse when
+                                workers start.''')
+    group1.add_argument('--status', action='store_true',
+                        help='Print status of running daemon and exit.')
+    group1.add_argument('--stop', action='store_true',
+                        help='Stop running daemon and exit.')
+
+    group2 = parser.add_argument_group('Settings')
+    group2.add_argument('--quiet', action='store_true',
+                        help='''Do not write output to console
+                                (silence stdout and stderr)''')
+    group2.add_argument('--logfile', type=argparse.FileType('a'),
+                        help='Append console output to this file')
+    parser.set_defaults(func=serve)
+
+
+def serve(socket=None, nworkers=None, preload=None, status=False, stop=False,
+          quiet=False, logfile=None):
+    """ Run Python stages in a worker daemon
+
+    The daemon accepts jobs for the stages in daemon.SERVE_STAGES. While it
+    is running, "haphpipe <stage>" for these stages sends the job to the
+    daemon instead of running it in a new process if HAPHPIPE_SERVE is set.
+
+    Args:
+        socket (str): Path to UNIX socket
+        nworkers (int): Number of worker processes
+        preload (list): Reference FASTA and GTF files to parse in advance
+        status (bool): Print status of running daemon and exit
+        stop (bool): Stop running daemon and exit
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+
+    Returns:
+        None
+
+    """
+    if status or stop:
+        resp = daemon.request({'op': 'stop' if stop else 'status'}, socket)
+        if resp is None:
+            raise PipelineStepError(
+                'haphpipe serve is not running on %s' %
+                (socket or daemon.socket_path())
+            )
+        if status:
+            print(json.dumps(resp, indent=1, sort_keys=True), file=sys.stdout)
+        return
+
+    if nworkers is None:
+        nworkers = resources.available_cpus()
+
+    server = daemon.Server(socket, nworkers, preload, quiet, logfile)
+    server.serve_forever()
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Run Python stages in a worker daemon.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    args.func(**sysutils.args_params(args))
+
+
+if __name__ == '__main__':
+    console()
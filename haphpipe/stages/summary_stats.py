@@ -4,7 +4,6 @@ import argparse
 import sys
 from haphpipe.utils import sysutils
 from haphpipe.utils.sysutils import MissingRequiredArgument
-from Bio import SeqIO
 
 __author__ = 'Margaret C. Steiner, Keylie M. Gibson, and Matthew L. Bendall'
 __copyright__ = 'Copyright (C) 2020 Margaret C. Steiner; (C) 2019 Keylie M. Gibson and Matthew L. Bendall'
@@ -61,7 +60,32 @@ def parse_vcf_file(file, reg):
     return count
 
 
+def write_read_qc(outfile, qcfile, label):
+    """ Write read statistics from a readqc sidecar, if it exists
+
+    Returns:
+        overview (dict): Combined statistics (see readqc.overview), or None
+            if qcfile does not exist
+
+    """
+    from haphpipe.utils import readqc
+    if not os.path.isfile(qcfile):
+        return None
+    ov = readqc.overview(readqc.read_sidecar(qcfile))
+    outfile.write("\t %s reads (%s):\n" % (label, os.path.basename(qcfile)))
+    outfile.write("\t\t Number of reads: %d\n" % ov['reads'])
+    outfile.write("\t\t Mean read length: %.1f\n" % ov['mean_length'])
+    outfile.write("\t\t GC content: %.2f percent\n" % (ov['gc_fraction'] * 100))
+    outfile.write("\t\t Mean quality: %.1f\n" % ov['mean_quality'])
+    outfile.write("\t\t Bases with quality >= 30: %.2f percent\n" % (ov['q30_fraction'] * 100))
+    outfile.write("\t\t Estimated duplicate reads: %.2f percent\n" % (ov['dup_fraction'] * 100))
+    return ov
+
+
 def summary_stats(dir_list=None, ph_list=None, quiet=False, logfile=None, debug=False, amplicons=False, outdir='.'):
+    from Bio import SeqIO
+    from haphpipe.utils import readqc
+
     # check for samtools
     sysutils.check_dependency('samtools')
 
@@ -110,6 +134,7 @@ def summary_stats(dir_list=None, ph_list=None, quiet=False, logfile=None, debug=
                 for x in range(num_cols):
                     tsv_header += ['dir_%s' % str(x)]
                 tsv_header += ['RAW', 'CLEAN', 'ALN_RATE']
+                tsv_header += ['CLEAN_LEN', 'CLEAN_GC', 'CLEAN_Q30', 'CLEAN_DUP']
 
             # output block 1
             outfile.write("SAMPLE " + "%s:\n" % sampname)
@@ -121,10 +146,21 @@ def summary_stats(dir_list=None, ph_list=None, quiet=False, logfile=None, debug=
             aln_rate = search_file(bowtiefile, "overall alignment rate").split(' ')[0]
             outfile.write("\t Overall alignment rate: %s\n" % aln_rate)
 
+            # read statistics from sample_reads --qc and trim_reads --qc
+            write_read_qc(outfile, os.path.join(filenames[i], readqc.SAMPLE_QC), 'Input')
+            clean_qc = write_read_qc(outfile, os.path.join(filenames[i], readqc.TRIMMED_QC), 'Trimmed')
+
             # create tsv line
             tsv_samp_temp = []
             tsv_samp_temp += sampname.split('/')
             tsv_samp_temp += [str(raw), str(cleaned), str(aln_rate)]
+            if clean_qc is not None:
+                tsv_samp_temp += ['%.1f' % clean_qc['mean_length'],
+                                  '%.4f' % clean_qc['gc_fraction'],
+                                  '%.4f' % clean_qc['q30_fraction'],
+                                  '%.4f' % clean_qc['dup_fraction']]
+            else:
+                tsv_samp_temp += ['NA'] * 4
 
             # index bam file with samtools
             cmd0 = ["samtools index %s" % bamfile]
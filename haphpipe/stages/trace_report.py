@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import json
+import argparse
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import telemetry
+from haphpipe.utils.sysutils import MissingRequiredArgument
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+GROUP_CHOICES = ['sample', 'iteration', 'stage', 'name', ]
+
+
+def stageparser(parser):
+    """ Add stage-specific options to argparse parser
+
+    Args:
+        parser (argparse.ArgumentParser): ArgumentParser object
+
+    Returns:
+        None
+
+    """
+    group1 = parser.add_argument_group('Input/Output')
+    group1.add_argument('--trace', type=sysutils.existing_file, required=True,
+                        help='''Trace file (JSON lines) written by setting
+                                HAPHPIPE_TRACE or with "--trace" for
+                                "haphpipe run" and "haphpipe batch".''')
+    group1.add_argument('--outfile', type=argparse.FileType('w'),
+                        help='Write summary table to this file (default: stdout)')
+    group1.add_argument('--chrome',
+                        help='''Export trace in Chrome trace format (JSON) to
+                                this file, for viewing in chrome://tracing or
+                                Perfetto.''')
+
+    group2 = parser.add_argument_group('Report options')
+    group2.add_argument('--group_by', nargs='+', default=GROUP_CHOICES,
+                        choices=GROUP_CHOICES,
+                        help='''Fields used to group commands. "name" is the
+                                program name.''')
+    parser.set_defaults(func=trace_report)
+
+
+def trace_report(trace=None, outfile=None, chrome=None,
+                 group_by=GROUP_CHOICES):
+    """ Summarize resource usage in a trace
+
+    For each group the table reports the number of processes, the total wall
+    time, user and system CPU time (seconds), and the largest peak resident
+    set size of a single process (KB).
+
+    Args:
+        trace (str): Path to trace file
+        outfile (file): Output for summary table
+        chrome (str): Path to Chrome trace output
+        group_by (list): Fields used to group commands
+
+    Returns:
+        None
+
+    """
+    if trace is None:
+        raise MissingRequiredArgument('No trace file given.')
+
+    records = telemetry.load(trace)
+    outh = sys.stdout if outfile is None else outfile
+    cols = list(group_by) + ['n', 'wall', 'user', 'sys', 'maxrss_kb']
+    print('\t'.join(cols), file=outh)
+    for row in telemetry.summarize(records, group_by):
+        vals = []
+        for c in cols:
+            v = row[c]
+            if v is None:
+                vals.append('.')
+            elif isinstance(v, float):
+                vals.append('%.2f' % v)
+            else:
+                vals.append(str(v))
+        print('\t'.join(vals), file=outh)
+
+    if chrome is not None:
+        with open(chrome, 'w') as outh:
+            json.dump(telemetry.to_chrome(records), outh)
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Summarize resource usage recorded in a trace.',
+        formatter_class=sysutils.ArgumentDefaultsHelpFormatterSkipNone,
+    )
+    stageparser(parser)
+    args = parser.parse_args()
+    try:
+        args.func(**sysutils.args_params(args))
+    except MissingRequiredArgument as e:
+        parser.print_usage()
+        print('error: %s' % e, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    console()
@@ -7,6 +7,7 @@ import os
 import argparse
 
 from haphpipe.utils import helpers
+from haphpipe.utils import gzutils
 from haphpipe.utils import sysutils
 from haphpipe.utils.sysutils import PipelineStepError
 from haphpipe.utils.sysutils import MissingRequiredArgument
@@ -68,6 +69,12 @@ def stageparser(parser):
                         help='Quality score encoding')
 
     group3 = parser.add_argument_group('Settings')
+    group3.add_argument('--compress', action='store_true',
+                        help='Write gzip-compressed reads (.fastq.gz)')
+    group3.add_argument('--qc', action='store_true',
+                        help='''Collect statistics of trimmed reads while
+                                they are written (trimmed.qc.json). Reads
+                                that lose their mate are not included.''')
     group3.add_argument('--ncpu', type=int, default=1,
                         help='Number of CPU to use')
     group3.add_argument('--quiet', action='store_true',
@@ -81,10 +88,151 @@ def stageparser(parser):
     parser.set_defaults(func=trim_reads)
 
 
+def trimmomatic_command():
+    """ Command to run Trimmomatic
+
+    There are two different ways to call Trimmomatic. If using modules on
+    C1, the path to the jar file is stored in the "$Trimmomatic" environment
+    variable. Otherwise, if using conda, the "trimmomatic" script is in PATH.
+
+    Returns:
+        cmd (list): Words that start the Trimmomatic command
+
+    """
+    try:
+        sysutils.check_dependency('trimmomatic')
+        return ['trimmomatic']
+    except PipelineStepError as e:
+        if 'Trimmomatic' in os.environ:
+            return ['java', '-jar', '$Trimmomatic']
+        raise e
+
+
+def trimmomatic_args(inputs, outputs, out_summary,
+                     adapter_file, trimmers, encoding, ncpu):
+    """ Arguments for Trimmomatic
+
+    Args:
+        inputs (list): One fastq file (SE) or two mate files (PE)
+        outputs (list): Output for SE, or paired and unpaired output for
+            each mate for PE
+        out_summary (str): Path to summary file
+        adapter_file (str): Path to adapter file (fasta)
+        trimmers (`list` of `str`): Trim commands for trimmomatic
+        encoding (str): Quality score encoding
+        ncpu (int): Number of CPUs to use
+
+    Returns:
+        args (list): Arguments following the Trimmomatic command
+
+    """
+    args = [
+        'SE' if len(inputs) == 1 else 'PE',
+        '-threads', '%d' % ncpu,
+        '-phred33' if encoding == "Phred+33" else '-phred64',
+        '-summary', out_summary,
+    ]
+    args += inputs + outputs
+    # Specify trimming steps
+    if adapter_file is not None:
+        if len(inputs) == 1:
+            adapter_file = adapter_file.replace('PE', 'SE')
+        args.append("ILLUMINACLIP:%s:2:30:10" % adapter_file)
+    return args + trimmers
+
+
+def stream_trimmed(
+        fq1=None, fq2=None, fqU=None, tempdir=None, outdir='.',
+        adapter_file=None, trimmers=TRIMMERS, encoding=None,
+        keep_trimmed=False, compress=False, qc=None, ncpu=1,
+    ):
+    """ Commands to trim reads into named pipes
+
+    Trimmomatic writes trimmed reads into named pipes in tempdir, and a relay
+    (utils.fqstream) reads them and writes the records to its standard
+    output, with mates interleaved. The relay command is meant to be the
+    start of the pipeline that uses the reads, as in
+    "<relay> | bowtie2 --interleaved -", and the Trimmomatic and relay
+    pipelines must be run together in a sysutils.StreamingCommands group.
+    Trimmed reads are not written to disk unless keep_trimmed is set, in
+    which case they are written to outdir with the names used by
+    trim_reads. Reads that lose their mate are not streamed.
+
+    Args:
+        fq1 (str): Path to fastq file with read 1
+        fq2 (str): Path to fastq file with read 2
+        fqU (str): Path to fastq file with unpaired reads
+        tempdir (str): Directory for named pipes
+        outdir (str): Path to output directory
+        adapter_file (str): Path to adapter file (fasta)
+        trimmers (`list` of `str`): Trim commands for trimmomatic
+        encoding (str): Quality score encoding
+        keep_trimmed (bool): Also write trimmed reads to outdir
+        compress (bool): Write gzip-compressed reads
+        qc (str): Path to write statistics of trimmed reads (see readqc)
+        ncpu (int): Number of CPUs to use for Trimmomatic, and for
+            compressing kept reads (shared by the files)
+
+    Returns:
+        pre_cmds (list): Commands to run before the streaming group
+        trim_cmd (list): Trimmomatic command
+        relay_cmd (list): Relay command, writing reads to standard output
+        post_cmds (list): Commands to run after the streaming group
+
+    """
+    # Check inputs
+    if fq1 is not None and fq2 is not None and fqU is None:
+        inputs = [fq1, fq2, ]
+    elif fq1 is None and fq2 is None and fqU is not None:
+        inputs = [fqU, ]
+    else:
+        msg = "incorrect input reads for streaming; requires either "
+        msg += "(--fq1 and --fq2) OR (--fqU)"
+        raise MissingRequiredArgument(msg)
+
+    if encoding is None:
+        encoding = helpers.guess_encoding(inputs[0])
+
+    out_summary = os.path.join(outdir, 'trimmomatic_summary.out')
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    fifos = [os.path.join(tempdir, 'trim_%d.fifo' % (i + 1))
+             for i in range(len(inputs))]
+    relay_cmd = [sys.executable, '-m', 'haphpipe.utils.fqstream', ] + fifos
+    if qc is not None:
+        relay_cmd += ['--qc', qc, '--encoding', encoding, ]
+    post_cmds = []
+
+    if keep_trimmed and compress:
+        relay_cmd += ['--ncpu', '%d' % max(1, ncpu // len(inputs)), ]
+    if len(inputs) == 1:
+        outputs = fifos
+        if keep_trimmed:
+            relay_cmd += ['--keep', fq('trimmed_U.fastq'), ]
+    else:
+        udir = outdir if keep_trimmed else tempdir
+        tmp1U = gzutils.fastq_name(os.path.join(udir, 'tmp1U.fq'), compress)
+        tmp2U = gzutils.fastq_name(os.path.join(udir, 'tmp2U.fq'), compress)
+        outputs = [fifos[0], tmp1U, fifos[1], tmp2U, ]
+        if keep_trimmed:
+            relay_cmd += ['--keep', fq('trimmed_1.fastq'),
+                          fq('trimmed_2.fastq'), ]
+            post_cmds = [
+                ['cat', tmp1U, tmp2U, '>>', fq('trimmed_U.fastq'), ],
+                ['rm', '-f', tmp1U, tmp2U, ],
+            ]
+
+    trim_cmd = trimmomatic_command() + trimmomatic_args(
+        inputs, outputs, out_summary, adapter_file, trimmers, encoding, ncpu
+    )
+    pre_cmds = [['rm', '-f', ] + fifos, ['mkfifo', ] + fifos, ]
+    return pre_cmds, trim_cmd, relay_cmd, post_cmds
+
+
 def trim_reads(
         fq1=None, fq2=None, fqU=None, outdir=".",
         adapter_file=None, trimmers=TRIMMERS, encoding=None,
-        ncpu=1, quiet=False, logfile=None, debug=False,
+        compress=False, qc=False, ncpu=1, quiet=False, logfile=None,
+        debug=False,
     ):
     """ Pipeline step to trim reads
 
@@ -96,6 +244,8 @@ def trim_reads(
         adapter_file (str): Path to adapter file (fasta)
         trimmers (`list` of `str`): Trim commands for trimmomatic
         encoding (str): Quality score encoding
+        compress (bool): Write gzip-compressed reads
+        qc (bool): Write statistics of trimmed reads to trimmed.qc.json
         ncpu (int): Number of CPUs to use
         quiet (bool): Do not write output to console
         logfile (file): Append console output to this file
@@ -117,20 +267,8 @@ def trim_reads(
         msg += "(--fq1 and --fq2) OR (--fqU)"
         raise MissingRequiredArgument(msg)
         
-    """ There are two different ways to call Trimmomatic. If using modules on
-        C1, the path to the jar file is stored in the "$Trimmomatic"
-        environment variable. Otherwise, if using conda, the "trimmomatic"
-        script is in PATH.
-    """
     # Check dependencies
-    try:
-        sysutils.check_dependency('trimmomatic')
-        cmd1 = ['trimmomatic']
-    except PipelineStepError as e:
-        if 'Trimmomatic' in os.environ:
-            cmd1 = ['java', '-jar', '$Trimmomatic']
-        else:
-            raise e
+    cmd1 = trimmomatic_command()
 
     # Get encoding
     if encoding is None:
@@ -141,25 +279,42 @@ def trim_reads(
 
     # Outputs for both single and paired
     out_summary = os.path.join(outdir, 'trimmomatic_summary.out')
-    outU = os.path.join(outdir, 'trimmed_U.fastq')
+    # Trimmomatic compresses output files named ".gz"
+    fq = lambda f: gzutils.fastq_name(os.path.join(outdir, f), compress)
+    outU = fq('trimmed_U.fastq')
+
+    if qc:
+        # Trimmomatic writes into named pipes, and the relay collects
+        # statistics while writing the reads to their output files
+        from haphpipe.utils import readqc
+        tempdir = sysutils.create_tempdir('trim_reads', None, quiet, logfile)
+        pre, trim_cmd, relay_cmd, post = stream_trimmed(
+            fq1, fq2, fqU, tempdir, outdir, adapter_file, trimmers, encoding,
+            keep_trimmed=True, compress=compress,
+            qc=os.path.join(outdir, readqc.TRIMMED_QC), ncpu=ncpu,
+        )
+        relay_cmd += ['--no_output', ]
+        stream = sysutils.StreamingCommands([trim_cmd, relay_cmd, ])
+        try:
+            sysutils.command_runner(
+                pre + [stream, ] + post, 'trim_reads', quiet, logfile, debug
+            )
+        finally:
+            sysutils.remove_tempdir(tempdir, 'trim_reads', quiet, logfile)
+        if input_reads == 'single':
+            return None, None, outU
+        out1 = fq('trimmed_1.fastq')
+        out2 = fq('trimmed_2.fastq')
+        return out1, out2, outU, out_summary
 
     if input_reads is 'single':
         # Outputs
         out1 = out2 = None
         # Trimmomatic command
-        cmd1 += [
-            'SE',
-            '-threads', '%d' % ncpu,
-            '-phred33' if encoding == "Phred+33" else '-phred64',
-            '-summary', out_summary,
-            fqU,
-            outU,
-        ]
-        # Specify trimming steps
-        if adapter_file is not None:
-            adapter_file = adapter_file.replace('PE', 'SE')
-            cmd1.append("ILLUMINACLIP:%s:2:30:10" % adapter_file)
-        cmd1 += trimmers
+        cmd1 += trimmomatic_args(
+            [fqU, ], [outU, ], out_summary,
+            adapter_file, trimmers, encoding, ncpu
+        )
         
         # Run command
         sysutils.command_runner(
@@ -168,26 +323,17 @@ def trim_reads(
         return out1, out2, outU
     elif input_reads is 'paired':
         # Outputs
-        out1 = os.path.join(outdir, 'trimmed_1.fastq')
-        out2 = os.path.join(outdir, 'trimmed_2.fastq')
-        tmp1U = os.path.join(outdir, 'tmp1U.fq')
-        tmp2U = os.path.join(outdir, 'tmp2U.fq')
+        out1 = fq('trimmed_1.fastq')
+        out2 = fq('trimmed_2.fastq')
+        tmp1U = fq('tmp1U.fq')
+        tmp2U = fq('tmp2U.fq')
         # Trimmomatic command
-        cmd1 += [
-            'PE',
-            '-threads', '%d' % ncpu,
-            '-phred33' if encoding == "Phred+33" else '-phred64',
-            '-summary', out_summary,
-            fq1, fq2,
-            out1, tmp1U,
-            out2, tmp2U,
-        ]
-        # Specify trimming steps
-        if adapter_file is not None:
-            cmd1.append("ILLUMINACLIP:%s:2:30:10" % adapter_file)
-        cmd1 += trimmers
+        cmd1 += trimmomatic_args(
+            [fq1, fq2, ], [out1, tmp1U, out2, tmp2U, ], out_summary,
+            adapter_file, trimmers, encoding, ncpu
+        )
         
-        # Concat files command
+        # Concat files command (concatenated gzip files are valid gzip)
         cmd2 = ['cat', tmp1U, tmp2U, '>>',  outU, ]
         cmd3 = ['rm', '-f', tmp1U, tmp2U, ]
         
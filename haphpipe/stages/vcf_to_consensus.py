@@ -6,13 +6,17 @@ from __future__ import print_function
 from builtins import map
 from builtins import str
 from builtins import zip
-from past.builtins import basestring
 
 import os
 import argparse
 import gzip
 import re
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 from haphpipe.utils import sysutils
 from haphpipe.utils import sequtils
 from haphpipe.utils.helpers import cast_str
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Bin reads by amplicon using k-mers of the amplicon sequences
+
+The amplicon regions of a reference (GTF lines with feature "amplicon"),
+extended by some padding, are cut from the reference sequence and their
+canonical k-mers indexed. K-mers found in more than one amplicon are
+dropped, so each indexed k-mer points to a single amplicon.
+
+Each read (or pair, counting the k-mers of both mates) is assigned to the
+amplicon sharing the most k-mers with it, if it shares at least min_kmers
+and no other amplicon shares as many. Other reads are left unbinned.
+"""
+from __future__ import print_function
+from __future__ import division
+import re
+
+import numpy as np
+
+from haphpipe.utils import gtfparse
+from haphpipe.utils import gzutils
+from haphpipe.utils import kmers
+from haphpipe.utils import readsampler
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Default k-mer size. Short k-mers tolerate divergence from the reference.
+"""
+KSIZE = 15
+
+""" Default minimum number of k-mers shared with an amplicon """
+MIN_KMERS = 20
+
+""" Default bases included outside the amplicon regions """
+PADDING = 50
+
+""" Name of the bin of reads not assigned to an amplicon """
+UNBINNED = 'unbinned'
+
+
+def bin_name(name):
+    """ Amplicon name usable in file names """
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+class AmpliconIndex(object):
+    """ Canonical k-mers of amplicon sequences
+
+    Args:
+        names (list): Amplicon names
+        seqs (list): Amplicon sequences (str)
+        k (int): K-mer size
+    """
+    def __init__(self, names, seqs, k=KSIZE):
+        self.names = names
+        self.k = k
+        batch = kmers.SeqBatch.from_records(list(zip(names, seqs)))
+        km, index = kmers.batch_kmers(batch, k)
+        # Distinct (k-mer, amplicon) pairs, without k-mers of several amplicons
+        order = np.lexsort((index, km))
+        km, index = km[order], index[order]
+        first = np.ones(len(km), dtype=bool)
+        first[1:] = (km[1:] != km[:-1]) | (index[1:] != index[:-1])
+        km, index = km[first], index[first]
+        shared = np.zeros(len(km), dtype=bool)
+        shared[1:] = km[1:] == km[:-1]
+        shared[:-1] |= shared[1:]
+        self.kmers = km[~shared]
+        self.labels = index[~shared]
+
+    @classmethod
+    def from_reference(cls, ref_fa, ref_gtf, k=KSIZE, padding=PADDING):
+        """ Index of the amplicons of a reference
+
+        Args:
+            ref_fa (str): Path to reference FASTA
+            ref_gtf (str): Path to GTF with amplicon regions
+            k (int): K-mer size
+            padding (int): Bases to include outside the amplicon regions
+
+        """
+        refseqs = {}
+        for batch in kmers.read_fasta_batches(ref_fa):
+            for i, name in enumerate(batch.names):
+                s, e = batch.offsets[i], batch.offsets[i + 1]
+                refseqs[name.split()[0]] = batch.seq[s:e].tobytes().decode()
+        names, seqs = [], []
+        for gl in gtfparse.gtf_parser(ref_gtf):
+            if gl.feature != 'amplicon':
+                continue
+            if gl.chrom not in refseqs:
+                raise ValueError('Reference "%s" for amplicon %s not found' %
+                                 (gl.chrom, gl.attrs['name']))
+            ref = refseqs[gl.chrom]
+            names.append(gl.attrs['name'])
+            seqs.append(ref[max(0, gl.start - 1 - padding):gl.end + padding])
+        if not names:
+            raise ValueError('No amplicons found in %s' % ref_gtf)
+        return cls(names, seqs, k)
+
+    def lookup(self, km):
+        """ Amplicon number of each k-mer (uint64 array), -1 if not found """
+        ret = np.full(len(km), -1, dtype=np.int64)
+        if len(self.kmers):
+            idx = np.minimum(np.searchsorted(self.kmers, km),
+                             len(self.kmers) - 1)
+            found = self.kmers[idx] == km
+            ret[found] = self.labels[idx[found]]
+        return ret
+
+    def assign(self, batches, min_kmers=MIN_KMERS):
+        """ Amplicon of each read (or pair)
+
+        Args:
+            batches (list): One fastq.FastqBatch per mate, with the same
+                records
+            min_kmers (int): Minimum number of k-mers shared with amplicon
+
+        Returns:
+            bins (numpy.ndarray): Amplicon number of each read (or pair),
+                -1 if unbinned
+
+        """
+        n, na = len(batches[0]), len(self.names)
+        hits = np.zeros(n * na, dtype=np.int64)
+        for b in batches:
+            km, index = kmers.batch_kmers(b, self.k)
+            label = self.lookup(km)
+            found = label >= 0
+            hits += np.bincount(index[found] * na + label[found],
+                                minlength=n * na)
+        hits = hits.reshape(n, na)
+        best = np.argmax(hits, axis=1)
+        top = hits[np.arange(n), best]
+        if na > 1:
+            second = np.partition(hits, na - 2, axis=1)[:, na - 2]
+        else:
+            second = np.zeros(n, dtype=np.int64)
+        return np.where((top >= min_kmers) & (top > second), best, -1)
+
+
+def bin_reads(paths, out_fmt, index, min_kmers=MIN_KMERS, ncpu=1):
+    """ Write reads (or pairs) to one file per bin
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        out_fmt (list): Output path for each input, formatted with the bin
+            name. Files named ".gz" are compressed.
+        index (AmpliconIndex): Amplicon index
+        min_kmers (int): Minimum number of k-mers shared with amplicon
+        ncpu (int): Number of CPUs for compression
+
+    Returns:
+        bins (list): (bin name, output paths, number of reads) for each
+            bin with reads, in order of amplicons, the unbinned last
+
+    """
+    names = [bin_name(n) for n in index.names] + [UNBINNED, ]
+    ouths = {}
+    counts = np.zeros(len(names), dtype=np.int64)
+    try:
+        for batches in readsampler.lockstep_batches(paths):
+            assigned = index.assign(batches, min_kmers)
+            # Unbinned reads go to the last bin
+            assigned[assigned < 0] = len(names) - 1
+            n = np.bincount(assigned, minlength=len(names))
+            counts += n
+            for j in np.flatnonzero(n):
+                sel = assigned == j
+                if j not in ouths:
+                    ouths[j] = [
+                        gzutils.open_writer(f % names[j], ncpu,
+                                            readsampler.COMPRESS_LEVEL)
+                        for f in out_fmt
+                    ]
+                for b, outh in zip(batches, ouths[j]):
+                    outh.write(b.raw_selected(sel))
+    finally:
+        for hs in ouths.values():
+            for outh in hs:
+                outh.close()
+    return [(names[j], [f % names[j] for f in out_fmt], int(counts[j]))
+            for j in range(len(names)) if counts[j]]
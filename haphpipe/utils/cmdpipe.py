@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+"""Run command pipelines without a shell
+"""
+from __future__ import print_function
+import os
+import re
+import glob
+import time
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import telemetry
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Shell operators understood by the pipeline parser. Commands using any
+    other shell syntax (";", "&&", subshells, quoted variables, etc.) are
+    run with /bin/sh.
+"""
+REDIRECTS = ['>', '>>', '2>', '2>>', '&>', '<', '2>&1', ]
+OPERATORS = ['|', ] + REDIRECTS
+
+SHELL_CHARS = set(';&|<>()`')
+GLOB_CHARS = set('*?[')
+ASSIGNMENT = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+VARIABLE = re.compile(r'\$(?:([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)\})')
+
+""" Stream targets for a process. Output goes to the next process in the
+    pipeline (or to the log for the last process), errors go to the log.
+"""
+_DEFAULT_OUT = ('default_out', )
+_DEFAULT_ERR = ('default_err', )
+
+
+class NeedsShell(Exception):
+    """ Raised when a command uses shell syntax the parser does not handle
+    """
+    pass
+
+
+class Word(object):
+    """ Word of a command line
+
+    Attributes:
+        text (str): Word with quotes and escapes removed
+        raw (str): Word as written
+        bare (str): Characters of word outside quotes
+        quoted (bool): Word contains quotes or escapes
+    """
+    def __init__(self):
+        self.text = ''
+        self.raw = ''
+        self.bare = ''
+        self.quoted = False
+
+
+def split_words(cmdstr):
+    """ Split command string into words, following shell quoting rules
+
+    Raises NeedsShell if a quoted word contains command substitution or
+    variable expansion.
+
+    Args:
+        cmdstr (str): Command string
+
+    Returns:
+        words (list): Word objects
+
+    """
+    words = []
+    cur = None
+    i = 0
+    while i < len(cmdstr):
+        c = cmdstr[i]
+        if c.isspace():
+            if cur is not None:
+                words.append(cur)
+                cur = None
+            i += 1
+            continue
+        if cur is None:
+            cur = Word()
+        if c == "'":
+            j = cmdstr.find("'", i + 1)
+            if j == -1:
+                raise NeedsShell('Unterminated quote')
+            cur.text += cmdstr[i+1:j]
+            cur.raw += cmdstr[i:j+1]
+            cur.quoted = True
+            i = j + 1
+        elif c == '"':
+            j = i + 1
+            while j < len(cmdstr) and cmdstr[j] != '"':
+                if cmdstr[j] in '$`':
+                    raise NeedsShell('Expansion in double quotes')
+                if cmdstr[j] == '\\' and j + 1 < len(cmdstr) and cmdstr[j+1] in '"\\$`':
+                    j += 1
+                cur.text += cmdstr[j]
+                j += 1
+            if j >= len(cmdstr):
+                raise NeedsShell('Unterminated quote')
+            cur.raw += cmdstr[i:j+1]
+            cur.quoted = True
+            i = j + 1
+        elif c == '\\':
+            if i + 1 < len(cmdstr):
+                cur.text += cmdstr[i+1]
+            cur.raw += cmdstr[i:i+2]
+            cur.quoted = True
+            i += 2
+        else:
+            cur.text += c
+            cur.raw += c
+            cur.bare += c
+            i += 1
+    if cur is not None:
+        words.append(cur)
+    return words
+
+
+def expand_word(word, cwd=None):
+    """ Expand variables and glob patterns in an unquoted word
+
+    Variables that are not set expand to an empty string, and patterns that
+    do not match any file are kept as written, as in the shell. Relative
+    patterns are matched in "cwd".
+
+    Returns:
+        texts (list): Expanded words
+
+    """
+    if word.quoted:
+        if set(word.bare) & (GLOB_CHARS | set('$~')):
+            # Quoted word with an unquoted expansion
+            raise NeedsShell('Partially quoted expansion')
+        return [word.text, ]
+    if '$' in word.text:
+        if '$(' in word.text:
+            raise NeedsShell('Command substitution')
+        text = VARIABLE.sub(
+            lambda m: os.environ.get(m.group(1) or m.group(2), ''), word.text
+        )
+        if '$' in text:
+            raise NeedsShell('Special parameter')
+    else:
+        text = word.text
+    if text.startswith('~'):
+        text = os.path.expanduser(text)
+    if set(text) & GLOB_CHARS:
+        if cwd is None or os.path.isabs(text):
+            matches = sorted(glob.glob(text))
+        else:
+            prefix = os.path.join(cwd, '')
+            matches = sorted(m[len(prefix):] for m in glob.glob(prefix + text))
+        if matches:
+            return matches
+    return [text, ]
+
+
+class Process(object):
+    """ Single process of a pipeline
+
+    Attributes:
+        argv (list): Program and arguments
+        env (dict): Environment variables assigned for this process
+        stdin (str): Path to file read as standard input
+        stdout (tuple): Where standard output is written
+        stderr (tuple): Where standard error is written
+        label (str): Name used in logs, if not the program name
+        pid (int): Process ID once started
+        returncode (int): Exit status once finished
+        start (float): Time process was started
+        end (float): Time process finished
+        rusage (resource.struct_rusage): Resource usage once finished
+    """
+    def __init__(self):
+        self.argv = []
+        self.env = {}
+        self.stdin = None
+        self.stdout = _DEFAULT_OUT
+        self.stderr = _DEFAULT_ERR
+        self.label = None
+        self.pid = None
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.rusage = None
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def name(self):
+        if self.label is not None:
+            return self.label
+        return os.path.basename(self.argv[0]) if self.argv else ''
+
+    def redirect(self, op, target):
+        if op == '<':
+            self.stdin = target
+        elif op == '>':
+            self.stdout = ('file', target, 'wb')
+        elif op == '>>':
+            self.stdout = ('file', target, 'ab')
+        elif op == '2>':
+            self.stderr = ('file', target, 'wb')
+        elif op == '2>>':
+            self.stderr = ('file', target, 'ab')
+        elif op == '&>':
+            self.stdout = ('file', target, 'wb')
+            self.stderr = self.stdout
+        elif op == '2>&1':
+            self.stderr = self.stdout
+
+
+class Pipeline(object):
+    """ Processes connected by pipes
+
+    Standard output of each process is connected to standard input of the
+    next by an OS pipe. Redirections are opened in Python, and output not
+    redirected to a file (standard error of every process and standard
+    output of the last) is copied to the stage log.
+
+    Commands that cannot be parsed are run with "/bin/sh -c" as a single
+    process.
+
+    Args:
+        args (list): Command as a list of words, as passed to
+            sysutils.command_runner(). Elements may contain several words.
+        cwd (str): Working directory
+    """
+    def __init__(self, args, cwd=None):
+        self.cmdstr = ' '.join(args)
+        self.cwd = cwd
+        self.shell = False
+        self.terminated = False
+        self._running = []
+        self._lock = threading.Lock()
+        try:
+            self.procs = self.parse(self.cmdstr, cwd)
+        except NeedsShell:
+            self.shell = True
+            p = Process()
+            p.argv = ['/bin/sh', '-c', self.cmdstr]
+            p.label = os.path.basename(self.cmdstr.split()[0])
+            self.procs = [p, ]
+
+    @staticmethod
+    def parse(cmdstr, cwd=None):
+        """ Parse command string into processes
+
+        Raises NeedsShell if the command uses shell syntax that is not
+        supported.
+        """
+        procs = [Process(), ]
+        words = split_words(cmdstr)
+        i = 0
+        while i < len(words):
+            w = words[i]
+            p = procs[-1]
+            if not w.quoted and w.text in OPERATORS:
+                if w.text == '|':
+                    if not p.argv:
+                        raise NeedsShell('Empty command')
+                    procs.append(Process())
+                elif w.text == '2>&1':
+                    p.redirect(w.text, None)
+                else:
+                    if i + 1 >= len(words):
+                        raise NeedsShell('Missing redirection target')
+                    t = words[i + 1]
+                    if not t.quoted and t.text in OPERATORS:
+                        raise NeedsShell('Missing redirection target')
+                    target = expand_word(t, cwd)
+                    if len(target) != 1:
+                        raise NeedsShell('Ambiguous redirect')
+                    p.redirect(w.text, target[0])
+                    i += 1
+            elif set(w.bare) & SHELL_CHARS:
+                raise NeedsShell('Shell operator')
+            elif not p.argv and ASSIGNMENT.match(w.bare):
+                # Variable assignment before the command, as in
+                # '_JAVA_OPTIONS="-Xmx32g" picard ...'
+                name, value = w.text.split('=', 1)
+                if '$' in w.bare:
+                    raise NeedsShell('Expansion in assignment')
+                p.env[name] = value
+            else:
+                p.argv.extend(expand_word(w, cwd))
+            i += 1
+        if not procs[-1].argv:
+            raise NeedsShell('Empty command')
+        return procs
+
+    def is_chdir(self):
+        """ Command is "cd DIR" """
+        p = self.procs[0]
+        return (not self.shell and len(self.procs) == 1 and
+                len(p.argv) == 2 and p.argv[0] == 'cd' and
+                p.stdin is None and p.stdout is _DEFAULT_OUT and
+                p.stderr is _DEFAULT_ERR)
+
+    def failed(self):
+        """ Processes that failed
+
+        A process (other than the last) killed by SIGPIPE is not considered
+        failed, since this happens when a later process stops reading.
+        """
+        ret = []
+        for i, p in enumerate(self.procs):
+            if p.returncode == 0:
+                continue
+            if i < len(self.procs) - 1 and p.returncode == -signal.SIGPIPE:
+                continue
+            ret.append(p)
+        return ret
+
+    def run(self, quiet=False, logfile=None):
+        """ Run pipeline and wait for all processes to finish
+
+        Args:
+            quiet (bool): Do not write output to console
+            logfile (file): Append console output to this file
+
+        Returns:
+            failed (list): Processes that failed
+
+        """
+        cwd = self.cwd
+
+        def path(f):
+            return f if cwd is None else os.path.join(cwd, f)
+
+        logr, logw = os.pipe()
+        opened = {}
+        started = []
+        prev_out = None
+
+        def open_target(t):
+            if id(t) not in opened:
+                opened[id(t)] = open(path(t[1]), t[2])
+            return opened[id(t)]
+
+        try:
+            for i, p in enumerate(self.procs):
+                last = i == len(self.procs) - 1
+                if p.stdin is not None:
+                    stdin = open(path(p.stdin), 'rb')
+                    opened[id(stdin)] = stdin
+                else:
+                    stdin = prev_out
+
+                if p.stdout is _DEFAULT_OUT:
+                    stdout = logw if last else subprocess.PIPE
+                else:
+                    stdout = open_target(p.stdout)
+
+                if p.stderr is _DEFAULT_ERR:
+                    stderr = logw
+                elif p.stderr is p.stdout:
+                    stderr = subprocess.STDOUT
+                else:
+                    stderr = open_target(p.stderr)
+
+                env = None
+                if p.env:
+                    env = dict(os.environ)
+                    env.update(p.env)
+
+                p.start = time.time()
+                with self._lock:
+                    if self.terminated:
+                        # Terminated before this process was started
+                        p.end = p.start
+                        p.returncode = -signal.SIGTERM
+                        proc = None
+                    else:
+                        try:
+                            proc = subprocess.Popen(
+                                p.argv, stdin=stdin, stdout=stdout,
+                                stderr=stderr, cwd=cwd, env=env,
+                                close_fds=True,
+                            )
+                            p.pid = proc.pid
+                            self._running.append((p, proc))
+                        except OSError as e:
+                            p.end = time.time()
+                            p.returncode = 127
+                            msg = '%s: %s\n' % (p.argv[0], e.strerror)
+                            os.write(logw, msg.encode('utf-8'))
+                            proc = None
+
+                # Parent no longer needs the read end of the previous pipe
+                if prev_out is not None:
+                    prev_out.close()
+                prev_out = proc.stdout if proc is not None else None
+                if prev_out is None and not last:
+                    prev_out = open(os.devnull, 'rb')
+                    opened[id(prev_out)] = prev_out
+                started.append((p, proc))
+        finally:
+            os.close(logw)
+            for fh in opened.values():
+                fh.close()
+
+        # Reap each process as it exits to record its run time
+        def reap(p, proc):
+            _, status, p.rusage = os.wait4(proc.pid, 0)
+            p.end = time.time()
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+            proc.returncode = p.returncode
+        threads = []
+        for p, proc in started:
+            if proc is not None:
+                t = threading.Thread(target=reap, args=(p, proc))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        with os.fdopen(logr, 'rb') as fh:
+            for line in iter(fh.readline, b''):
+                sysutils.log_message(line.decode('utf-8', 'replace'), quiet, logfile)
+
+        for t in threads:
+            t.join()
+        return self.failed()
+
+    def terminate(self):
+        """ Send SIGTERM to running processes and do not start others """
+        with self._lock:
+            self.terminated = True
+            for p, proc in self._running:
+                # Return code is set when the process has been reaped
+                if p.returncode is None:
+                    try:
+                        proc.send_signal(signal.SIGTERM)
+                    except OSError:
+                        pass
+
+    def summary(self):
+        """ Run time of each process """
+        return ', '.join(
+            '%s (%.1f seconds)' % (p.name, p.elapsed)
+            for p in self.procs if p.elapsed is not None
+        )
+
+
+def trace_process(p, stage, command, cmdstr):
+    """ Add record for finished process to the trace """
+    if p.start is None or p.end is None:
+        return
+    fields = {
+        'stage': stage, 'command': command, 'cmdline': cmdstr,
+        'child_pid': p.pid, 'returncode': p.returncode,
+    }
+    if p.rusage is not None:
+        fields['user'] = p.rusage.ru_utime
+        fields['sys'] = p.rusage.ru_stime
+        fields['maxrss_kb'] = telemetry.maxrss_kb(p.rusage.ru_maxrss)
+    telemetry.record('process', p.name, p.start, p.end, **fields)
+
+
+def _run_pipeline(pipeline, stage, num, quiet, logfile):
+    """ Run pipeline, then trace and log each process
+
+    Returns:
+        error (tuple): Description of failed processes and exit status, or
+            None if all processes succeeded
+
+    """
+    failed = pipeline.run(quiet, logfile)
+    for p in pipeline.procs:
+        trace_process(p, stage, num, pipeline.cmdstr)
+    sysutils.log_message(
+        '[--- %s command %d ---] %s\n' % (stage, num, pipeline.summary()),
+        quiet, logfile
+    )
+    if not failed:
+        return None
+    msg = 'Command %d:\n%s\n' % (num, pipeline.cmdstr)
+    msg += '\n'.join(
+        'Process "%s" exited with status %d' % (' '.join(p.argv), p.returncode)
+        for p in failed
+    )
+    return msg, failed[-1].returncode
+
+
+def run_commands(cmds, stage=None, quiet=False, logfile=None):
+    """ Run commands in order, stopping at the first failure
+
+    Each command is run as a Pipeline. A command "cd DIR" changes the working
+    directory for the commands that follow it, as it would in the shell.
+    Commands in a sysutils.ConcurrentCommands group are run at the same time
+    in separate threads. Every command in the group is allowed to finish,
+    and each failure in the group is reported. In a sysutils.StreamingCommands
+    group, the first failure terminates the other commands, and only
+    commands that were not terminated are reported.
+
+    Args:
+        cmds (list): Commands, each a list of words or a ConcurrentCommands
+        stage (str): Name of stage
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+
+    Returns:
+        pipelines (list): Pipeline objects that were run
+
+    """
+    cwd = None
+    ret = []
+    num = 0
+    for c in cmds:
+        if isinstance(c, sysutils.ConcurrentCommands):
+            jobs = []
+            for args in c:
+                num += 1
+                pipeline = Pipeline(args, cwd)
+                if pipeline.is_chdir():
+                    raise sysutils.PipelineStepError(
+                        'Command %d: "cd" cannot be run concurrently' % num
+                    )
+                jobs.append((num, pipeline))
+            max_jobs = c.max_jobs or len(jobs)
+            fail_fast = isinstance(c, sysutils.StreamingCommands)
+            # Trace tags are per thread, so they are passed to the workers
+            tags = telemetry.current_tags()
+            def run_job(pipeline, n):
+                with telemetry.context(**tags):
+                    return _run_pipeline(pipeline, stage, n, quiet, logfile)
+            with ThreadPoolExecutor(max_workers=max(1, max_jobs)) as pool:
+                futs = {
+                    pool.submit(run_job, pipeline, n): pipeline
+                    for n, pipeline in jobs
+                }
+                for f in as_completed(futs):
+                    if fail_fast and f.result() is not None:
+                        # Only the first failure terminates the others
+                        fail_fast = False
+                        for pipeline in futs.values():
+                            if pipeline is not futs[f]:
+                                pipeline.terminate()
+                results = [(futs[f], f.result()) for f in futs]
+            ret.extend(pipeline for _, pipeline in jobs)
+            errors = [r for pipeline, r in results
+                      if r is not None and not pipeline.terminated]
+        else:
+            num += 1
+            pipeline = Pipeline(c, cwd)
+            if pipeline.is_chdir():
+                d = pipeline.procs[0].argv[1]
+                cwd = d if cwd is None else os.path.join(cwd, d)
+                if not os.path.isdir(cwd):
+                    raise sysutils.PipelineStepError(
+                        '\n[--- FAILED: %s ---]\ncd: %s: No such directory' % (stage, cwd),
+                        returncode=1
+                    )
+                continue
+            ret.append(pipeline)
+            r = _run_pipeline(pipeline, stage, num, quiet, logfile)
+            errors = [r, ] if r is not None else []
+
+        if errors:
+            msg = '\n[--- FAILED: %s ---]\n' % stage
+            msg += '\n'.join(e[0] for e in errors)
+            raise sysutils.PipelineStepError(msg, returncode=errors[-1][1])
+    return ret
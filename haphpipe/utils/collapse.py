@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Collapse exact duplicate reads, and expand them again
+
+Reads (or pairs, with mate files read in lockstep) with identical sequences
+are collapsed to the first occurrence, and the number of copies is added to
+the read name as ";size=N", before any "/1" or "/2" suffix:
+
+    @M01234:8:000000000-A1B2C:1:1101:15589:1331;size=12/1
+
+Both mates of a pair get the same tag, and the tag is kept by aligners as
+part of the read name, so abundance can be recovered later by expanding
+the reads again.
+
+Identical reads are found by a 64-bit hash of the sequences. To bound
+memory, large inputs are first split by hash into buckets written to a
+temporary directory, and each bucket is collapsed separately. All copies of
+a read fall in the same bucket.
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import re
+import math
+import tempfile
+
+import numpy as np
+
+from haphpipe.utils import fastq
+from haphpipe.utils import gzutils
+from haphpipe.utils import readsampler
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Default memory for collapsing, in bytes """
+MAX_MEMORY = 2 << 30
+
+""" Memory used per byte of FASTQ held for collapsing (record text and
+    Python objects)
+"""
+MEMORY_FACTOR = 1.5
+
+""" Assumed compression ratio of gzipped FASTQ """
+GZIP_RATIO = 4
+
+""" Records written at a time """
+WRITE_CHUNK = 10000
+
+_HEADER = re.compile(br'^@(\S*?)(?:;size=(\d+))?(/[12])?(\s.*)?$', re.DOTALL)
+
+
+def split_header(rec):
+    """ Split header line of record
+
+    Returns:
+        name (bytes): Read name without size tag and mate suffix
+        size (int): Number of copies from size tag, or None
+        mate (bytes): Mate suffix ("/1", "/2" or "")
+        rest (bytes): Rest of the header line, including whitespace
+        body (bytes): Rest of the record, starting with newline
+
+    """
+    e = rec.index(b'\n')
+    m = _HEADER.match(rec[:e])
+    size = int(m.group(2)) if m.group(2) is not None else None
+    return m.group(1), size, m.group(3) or b'', m.group(4) or b'', rec[e:]
+
+
+def tag_record(rec, size):
+    """ Record with ";size=<size>" in read name """
+    name, _, mate, rest, body = split_header(rec)
+    return b''.join([b'@', name, b';size=', str(size).encode(), mate, rest,
+                     body])
+
+
+def expand_record(rec):
+    """ Copies of a collapsed record
+
+    The first copy has the original name, the others get ".2", ".3", ...
+    Records without a size tag are returned once, unchanged.
+
+    Returns:
+        recs (list): Records (bytes)
+
+    """
+    name, size, mate, rest, body = split_header(rec)
+    if size is None:
+        return [rec, ]
+    ret = [b''.join([b'@', name, mate, rest, body]), ]
+    for k in range(2, size + 1):
+        ret.append(b''.join([b'@', name, b'.', str(k).encode(), mate, rest,
+                             body]))
+    return ret
+
+
+def pair_hash(batches):
+    """ Hash of the sequences of each read (or pair) """
+    h = batches[0].seq_hash(0)
+    for i, b in enumerate(batches[1:]):
+        h ^= b.seq_hash(i + 1)
+    return h
+
+
+def _sizes(batch):
+    """ Number of copies of each read, from size tags """
+    ret = np.ones(len(batch), dtype=np.int64)
+    for i in range(len(batch)):
+        _, size, _, _, _ = split_header(b'@' + batch.name(i) + b'\n')
+        if size is not None:
+            ret[i] = size
+    return ret
+
+
+def _is_tagged(path):
+    """ First record of FASTQ has a size tag """
+    for batch in fastq.read_records(path, 1):
+        if len(batch):
+            return split_header(b'@' + batch.name(0) + b'\n')[1] is not None
+    return False
+
+
+class Collapser(object):
+    """ Collapse reads (or pairs) of a stream of batches in memory
+    """
+    def __init__(self, tagged=False):
+        self.tagged = tagged
+        self.nreads = 0
+        self._index = {}
+        self.reps = []
+        self.sizes = []
+
+    def add(self, batches):
+        h = pair_hash(batches)
+        w = _sizes(batches[0]) if self.tagged else None
+        u, first, inv = np.unique(h, return_index=True, return_inverse=True)
+        counts = np.bincount(inv.ravel(), weights=w, minlength=len(u))
+        counts = counts.astype(np.int64)
+        self.nreads += int(counts.sum())
+        new = []
+        for hv, f, c in zip(u.tolist(), first.tolist(), counts.tolist()):
+            i = self._index.get(hv)
+            if i is None:
+                new.append((f, hv, c))
+            else:
+                self.sizes[i] += c
+        # Representatives are kept in input order
+        new.sort()
+        recs = list(zip(*[b.raw_list([f for f, _, _ in new]) for b in batches]))
+        for (f, hv, c), r in zip(new, recs):
+            self._index[hv] = len(self.reps)
+            self.reps.append(r)
+            self.sizes.append(c)
+
+    def write(self, ouths):
+        """ Write tagged representatives, one file per mate """
+        for j, outh in enumerate(ouths):
+            for start in range(0, len(self.reps), WRITE_CHUNK):
+                chunk = zip(self.reps[start:start + WRITE_CHUNK],
+                            self.sizes[start:start + WRITE_CHUNK])
+                outh.write(b''.join(tag_record(r[j], s) for r, s in chunk))
+
+
+def num_buckets(paths, max_memory=MAX_MEMORY):
+    """ Number of buckets needed to collapse paths within max_memory """
+    nbytes = 0
+    for p in paths:
+        size = os.path.getsize(p)
+        nbytes += size * GZIP_RATIO if gzutils.is_gzip(p) else size
+    return max(1, int(math.ceil(nbytes * MEMORY_FACTOR / max_memory)))
+
+
+def _split(paths, tempdir, nbuckets):
+    """ Write reads to bucket files by hash
+
+    Returns:
+        buckets (list): Paths of bucket files for each bucket, one per mate
+
+    """
+    buckets = [
+        [os.path.join(tempdir, 'bucket%04d_%d.fastq' % (k, j))
+         for j in range(len(paths))]
+        for k in range(nbuckets)
+    ]
+    ouths = [[open(f, 'wb') for f in b] for b in buckets]
+    try:
+        for batches in readsampler.lockstep_batches(paths):
+            h = pair_hash(batches)
+            k = (h >> np.uint64(32)) % np.uint64(nbuckets)
+            order = np.argsort(k, kind='stable')
+            bounds = np.searchsorted(k[order],
+                                     np.arange(nbuckets + 1, dtype=np.uint64))
+            for kk in range(nbuckets):
+                idx = order[bounds[kk]:bounds[kk + 1]]
+                if len(idx) == 0:
+                    continue
+                for b, outh in zip(batches, ouths[kk]):
+                    outh.write(b.raw_selected(idx))
+    finally:
+        for hs in ouths:
+            for outh in hs:
+                outh.close()
+    return buckets
+
+
+def collapse(paths, outs, tempdir=None, max_memory=MAX_MEMORY, ncpu=1):
+    """ Collapse duplicate reads (or pairs)
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        outs (list): Output file for each input. Files named ".gz" are
+            compressed.
+        tempdir (str): Directory for buckets, needed if the input does not
+            fit in max_memory
+        max_memory (int): Memory to use, in bytes
+        ncpu (int): Number of CPUs for compression
+
+    Returns:
+        (nreads, ndistinct) (tuple): Number of reads (or pairs) read and
+            written
+
+    """
+    tagged = _is_tagged(paths[0])
+    nbuckets = num_buckets(paths, max_memory)
+    if nbuckets > 1 and tempdir is None:
+        raise ValueError('Temporary directory is needed to collapse %s' %
+                         ', '.join(paths))
+
+    nreads = ndistinct = 0
+    ouths = [gzutils.open_writer(o, ncpu, readsampler.COMPRESS_LEVEL)
+             for o in outs]
+    try:
+        if nbuckets == 1:
+            streams = [paths, ]
+        else:
+            bucketdir = tempfile.mkdtemp(prefix='collapse', dir=tempdir)
+            streams = _split(paths, bucketdir, nbuckets)
+        for bucket in streams:
+            c = Collapser(tagged)
+            for batches in readsampler.lockstep_batches(bucket):
+                c.add(batches)
+            c.write(ouths)
+            nreads += c.nreads
+            ndistinct += len(c.reps)
+            if nbuckets > 1:
+                for f in bucket:
+                    os.unlink(f)
+        if nbuckets > 1:
+            os.rmdir(bucketdir)
+    finally:
+        for outh in ouths:
+            outh.close()
+    return nreads, ndistinct
+
+
+def expand(path, out, ncpu=1):
+    """ Write each collapsed read as many times as its size tag
+
+    Mate files can be expanded separately, since both mates of a pair have
+    the same size.
+
+    Args:
+        path (str): FASTQ file with collapsed reads
+        out (str): Output file. Files named ".gz" are compressed.
+        ncpu (int): Number of CPUs for compression
+
+    Returns:
+        (nreads, nexpanded) (tuple): Number of reads read and written
+
+    """
+    nreads = nexpanded = 0
+    outh = gzutils.open_writer(out, ncpu, readsampler.COMPRESS_LEVEL)
+    try:
+        for batch in fastq.read_batches(path):
+            recs = []
+            for r in batch.raw_list(slice(None)):
+                recs.extend(expand_record(r))
+            outh.write(b''.join(recs))
+            nreads += len(batch)
+            nexpanded += len(recs)
+    finally:
+        outh.close()
+    return nreads, nexpanded
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""Worker daemon for Python stages ("haphpipe serve") and its client
+
+The daemon listens on a UNIX socket. Each request is one line of JSON with
+the command line arguments of a stage, the working directory and the
+HAPHPIPE_* environment variables of the client. The stage runs in one of a
+pool of worker processes that have already imported the stage modules and
+keep parsed references (see refstore). The response is one line of JSON with
+the exit status and the output of the stage.
+
+Stages are sent to the daemon only if HAPHPIPE_SERVE is set. The socket is
+in a directory private to the user, and both ends check that the other is
+run by the same user, so other users cannot receive or answer jobs.
+
+This module only imports the standard library at the top, so the client is
+cheap to load.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import stat
+import time
+import errno
+import signal
+import socket
+import struct
+import tempfile
+import threading
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Environment variable with path to the daemon socket """
+SOCKET_ENV = 'HAPHPIPE_SOCKET'
+
+""" Stages are sent to the daemon only if this environment variable is set """
+SERVE_ENV = 'HAPHPIPE_SERVE'
+
+""" Stages that can be run by the daemon. These stages run in Python and do
+    not depend on state outside the files named on the command line.
+"""
+SERVE_STAGES = ['vcf_to_consensus', 'pairwise_align', 'extract_pairwise',
+                'ph_parser', 'summary_stats', ]
+
+
+def socket_path():
+    """ Path to daemon socket
+
+    HAPHPIPE_SOCKET, or "haphpipe/serve.sock" in XDG_RUNTIME_DIR, or
+    "haphpipe-<uid>/serve.sock" in the temporary directory.
+    """
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'haphpipe',
+                            'serve.sock')
+    return os.path.join(
+        tempfile.gettempdir(), 'haphpipe-%d' % os.getuid(), 'serve.sock'
+    )
+
+
+def check_private(path, kind='socket'):
+    """ Check that path is owned by this user and not writable by others
+
+    Returns:
+        problem (str): Description of the problem, or None if path is safe
+
+    """
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        return str(e)
+    if st.st_uid != os.getuid():
+        return '%s %s is owned by another user' % (kind, path)
+    if kind == 'socket' and not stat.S_ISSOCK(st.st_mode):
+        return '%s is not a socket' % path
+    if kind == 'directory' and not stat.S_ISDIR(st.st_mode):
+        return '%s is not a directory' % path
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return '%s %s is writable by other users' % (kind, path)
+    return None
+
+
+def _peer_uid(sock):
+    """ User ID of process at other end of socket, None if not available """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+def _recv(sock):
+    """ Read one line of JSON, or None if the connection was closed """
+    buf = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None
+        buf.append(chunk)
+        if chunk.endswith(b'\n'):
+            return json.loads(b''.join(buf).decode('utf-8'))
+
+
+def connect(path=None):
+    """ Connect to daemon
+
+    The socket and its directory must belong to this user and not be
+    writable by others, and the daemon must run as this user.
+
+    Returns:
+        sock (socket.socket): Connected socket, or None if no daemon is
+            listening at path
+
+    """
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    problem = check_private(os.path.dirname(os.path.abspath(path)),
+                            'directory') or check_private(path)
+    if problem is not None:
+        print('warning: not using haphpipe serve: %s' % problem,
+              file=sys.stderr)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    uid = _peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        sock.close()
+        print('warning: not using haphpipe serve: %s is served by another '
+              'user' % path, file=sys.stderr)
+        return None
+    return sock
+
+
+def request(obj, path=None):
+    """ Send a request to the daemon and return the response
+
+    Returns:
+        response (dict): Response, or None if no daemon is running
+
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    try:
+        _send(sock, obj)
+        return _recv(sock)
+    finally:
+        sock.close()
+
+
+def submit(argv, path=None):
+    """ Run a stage in the daemon, if HAPHPIPE_SERVE is set and one is running
+
+    Output of the stage is written to stdout and stderr of this process.
+
+    Args:
+        argv (list): Command line arguments, starting with stage name
+        path (str): Path to daemon socket
+
+    Returns:
+        status (int): Exit status of the stage, or None if the stage was not
+            run by a daemon
+
+    """
+    if not os.environ.get(SERVE_ENV) or not argv or argv[0] not in SERVE_STAGES:
+        return None
+    sock = connect(path)
+    if sock is None:
+        return None
+    env = {k:v for k,v in os.environ.items() if k.startswith('HAPHPIPE_')}
+    try:
+        _send(sock, {'op': 'run', 'argv': argv, 'cwd': os.getcwd(), 'env': env})
+        resp = _recv(sock)
+    finally:
+        sock.close()
+    if resp is None:
+        print('error: connection to haphpipe serve was lost', file=sys.stderr)
+        return 1
+    sys.stdout.write(resp['stdout'])
+    sys.stdout.flush()
+    sys.stderr.write(resp['stderr'])
+    return resp['status']
+
+
+def _worker_init(preload):
+    """ Import stage modules and parse references in a new worker """
+    import importlib
+    from haphpipe.haphpipe import STAGES
+    from haphpipe.utils import refstore
+    for name in SERVE_STAGES:
+        importlib.import_module(STAGES[name])
+    refstore.preload(preload or [])
+
+
+def run_job(argv, cwd, env):
+    """ Run a stage in this process, capturing its output
+
+    The working directory and HAPHPIPE_* environment of the client are used
+    while the stage runs.
+
+    Returns:
+        response (dict): Exit status, stdout and stderr of the stage
+
+    """
+    import traceback
+    from io import StringIO
+    from haphpipe.haphpipe import dispatch
+    from haphpipe.utils import scratch
+
+    saved = (os.getcwd(), dict(os.environ), sys.stdout, sys.stderr)
+    out, err = StringIO(), StringIO()
+    try:
+        os.chdir(cwd)
+        for k in list(os.environ):
+            if k.startswith('HAPHPIPE_'):
+                del os.environ[k]
+        os.environ.update(env)
+        sys.stdout, sys.stderr = out, err
+        with scratch.toplevel():
+            dispatch(argv)
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=err)
+            status = 1
+    except Exception:
+        traceback.print_exc(file=err)
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = saved[2], saved[3]
+        os.environ.clear()
+        os.environ.update(saved[1])
+        os.chdir(saved[0])
+    return {'status': status, 'stdout': out.getvalue(),
+            'stderr': err.getvalue()}
+
+
+class Server(object):
+    """ Accept stage jobs on a UNIX socket and run them in worker processes
+    """
+    def __init__(self, path=None, nworkers=1, preload=None,
+                 quiet=False, logfile=None):
+        self.path = path or socket_path()
+        self.nworkers = nworkers
+        self.preload = [os.path.abspath(p) for p in preload or []]
+        self.quiet = quiet
+        self.logfile = logfile
+        self.jobs = 0
+        self.started = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _log(self, msg):
+        from haphpipe.utils import sysutils
+        sysutils.log_message('[--- serve ---] %s\n' % msg,
+                             self.quiet, self.logfile)
+
+    def _new_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(
+            max_workers=self.nworkers,
+            initializer=_worker_init,
+            initargs=(self.preload,),
+        )
+
+    def _bind(self):
+        from haphpipe.utils.sysutils import PipelineStepError
+        sockdir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(sockdir):
+            os.makedirs(sockdir, 0o700)
+        problem = check_private(sockdir, 'directory')
+        if problem is not None:
+            raise PipelineStepError('Cannot serve on %s: %s' %
+                                    (self.path, problem))
+        if os.path.exists(self.path):
+            if request({'op': 'status'}, self.path) is not None:
+                raise PipelineStepError(
+                    'haphpipe serve is already running on %s' % self.path
+                )
+            # Stale socket left by a daemon that was killed
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old)
+        listener.listen(64)
+        listener.settimeout(1.0)
+        return listener
+
+    def _run(self, req):
+        from concurrent.futures.process import BrokenProcessPool
+        argv = req.get('argv') or []
+        if not argv or argv[0] not in SERVE_STAGES:
+            return {'status': 2, 'stdout': '',
+                    'stderr': 'error: stage not served: %s\n' % ' '.join(argv)}
+        with self._lock:
+            pool = self._pool
+        t0 = time.time()
+        try:
+            resp = pool.submit(
+                run_job, argv, req['cwd'], req.get('env', {})
+            ).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = self._new_pool()
+            resp = {'status': 1, 'stdout': '',
+                    'stderr': 'error: haphpipe serve worker died\n'}
+        with self._lock:
+            self.jobs += 1
+        self._log('%s finished with status %s (%.2fs)' % (
+            argv[0], resp['status'], time.time() - t0
+        ))
+        return resp
+
+    def _handle(self, conn):
+        try:
+            uid = _peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                self._log('Rejected connection from user %d' % uid)
+                return
+            req = _recv(conn)
+            if req is None:
+                return
+            op = req.get('op', 'run')
+            if op == 'run':
+                resp = self._run(req)
+            elif op == 'status':
+                resp = self.status()
+            elif op == 'stop':
+                self._stop.set()
+                resp = {'stopping': True}
+            else:
+                resp = {'status': 2, 'stdout': '',
+                        'stderr': 'error: unknown request "%s"\n' % op}
+            _send(conn, resp)
+        except socket.error as e:
+            if e.errno != errno.EPIPE:
+                self._log('Connection error: %s' % e)
+        finally:
+            conn.close()
+
+    def status(self):
+        return {
+            'pid': os.getpid(), 'socket': self.path,
+            'nworkers': self.nworkers, 'jobs': self.jobs,
+            'uptime': time.time() - self.started, 'preload': self.preload,
+            'stages': SERVE_STAGES,
+        }
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def serve_forever(self):
+        """ Serve until stopped by SIGTERM, SIGINT or a "stop" request """
+        listener = self._bind()
+        self.started = time.time()
+        self._pool = self._new_pool()
+        # Start workers now, so that the first job does not wait for imports
+        for _ in range(self.nworkers):
+            self._pool.submit(time.sleep, 0)
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, self.stop)
+        self._log('Listening on %s with %d workers' % (self.path, self.nworkers))
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                conn.settimeout(None)
+                t = threading.Thread(target=self._handle, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._pool.shutdown(wait=True)
+            self._log('Stopped after %d jobs' % self.jobs)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""Run pipeline stages as a directed acyclic graph
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import scratch
+from haphpipe.utils import stagecache
+from haphpipe.utils import telemetry
+from haphpipe.utils.sysutils import PipelineStepError
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Stage arguments that do not change the outputs of a stage. These are
+    excluded when deciding whether a completed stage is still current.
+"""
+RUNTIME_PARAMS = ['ncpu', 'keep_tmp', 'quiet', 'logfile', 'debug', ]
+
+
+class StageNode(object):
+    """ A single stage call within a pipeline DAG
+
+    Attributes:
+        name (str): Unique name for node
+        func (callable): Stage function to call
+        kwargs (dict): Keyword arguments passed to stage function
+        deps (list): Names of nodes that must be completed first
+        outputs (list): Paths to files created by the stage
+        max_threads (int): Maximum number of CPUs the stage can make use
+            of. If None, the stage can use any number of CPUs. The "ncpu"
+            argument is only passed to stages with max_threads != 1.
+    """
+    def __init__(self, name, func, kwargs=None, deps=None, outputs=None,
+                 max_threads=1):
+        self.name = name
+        self.func = func
+        self.kwargs = dict(kwargs) if kwargs is not None else {}
+        self.deps = list(deps) if deps is not None else []
+        self.outputs = list(outputs) if outputs is not None else []
+        self.max_threads = max_threads
+
+    def threads_wanted(self, avail):
+        if self.max_threads is None:
+            return avail
+        return max(1, min(self.max_threads, avail))
+
+    def param_digest(self):
+        """ Digest of the parameters that determine the outputs """
+        d = {k:v for k,v in self.kwargs.items() if k not in RUNTIME_PARAMS}
+        s = json.dumps(d, sort_keys=True, default=str)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return 'StageNode(%s)' % self.name
+
+
+class StageDAG(object):
+    """ Collection of stage nodes and their dependencies
+
+    Completed nodes are recorded with a stamp file in "statedir". A node is
+    considered complete if its stamp exists, its parameters are unchanged,
+    every output has the size and modification time recorded in the stamp,
+    and none of its upstream nodes were rerun.
+
+    If "sample" is given, trace records for the nodes are tagged with it.
+    """
+    def __init__(self, name='pipeline', statedir=None, sample=None):
+        self.name = name
+        self.statedir = statedir
+        self.sample = sample
+        self.nodes = OrderedDict()
+
+    def add(self, name, func, kwargs=None, deps=None, outputs=None,
+            max_threads=1):
+        if name in self.nodes:
+            raise PipelineStepError('Duplicate node name: %s' % name)
+        node = StageNode(name, func, kwargs, deps, outputs, max_threads)
+        self.nodes[name] = node
+        return node
+
+    def topological_order(self):
+        """ Return nodes ordered so that dependencies come first
+
+        Raises PipelineStepError if a dependency is missing or there is a
+        cycle in the graph.
+        """
+        for node in self.nodes.values():
+            for d in node.deps:
+                if d not in self.nodes:
+                    msg = 'Node "%s" depends on unknown node "%s"' % (node.name, d)
+                    raise PipelineStepError(msg)
+        ret = []
+        visited = {}
+        def visit(node):
+            if visited.get(node.name) == 'done':
+                return
+            if visited.get(node.name) == 'active':
+                raise PipelineStepError('Cycle found at node "%s"' % node.name)
+            visited[node.name] = 'active'
+            for d in node.deps:
+                visit(self.nodes[d])
+            visited[node.name] = 'done'
+            ret.append(node)
+        for node in self.nodes.values():
+            visit(node)
+        return ret
+
+    def stamp_path(self, node):
+        return os.path.join(self.statedir, '%s.done' % node.name)
+
+    def is_complete(self, node):
+        if self.statedir is None:
+            return False
+        stamp = self.stamp_path(node)
+        if not os.path.isfile(stamp):
+            return False
+        with open(stamp, 'r') as fh:
+            try:
+                d = json.load(fh)
+            except ValueError:
+                return False
+        if d.get('params') != node.param_digest():
+            return False
+        for f in node.outputs:
+            if f not in d['outputs'] or not os.path.exists(f):
+                return False
+            st = os.stat(f)
+            if [st.st_size, int(st.st_mtime)] != d['outputs'][f]:
+                return False
+        return True
+
+    def mark_complete(self, node, elapsed=None):
+        if self.statedir is None:
+            return
+        if not os.path.isdir(self.statedir):
+            os.makedirs(self.statedir)
+        outputs = {}
+        for f in node.outputs:
+            if not os.path.exists(f):
+                raise PipelineStepError(
+                    'Stage "%s" did not create output %s' % (node.name, f)
+                )
+            st = os.stat(f)
+            outputs[f] = [st.st_size, int(st.st_mtime)]
+        tmp = self.stamp_path(node) + '.tmp'
+        with open(tmp, 'w') as outh:
+            json.dump({
+                'params': node.param_digest(),
+                'outputs': outputs,
+                'elapsed': elapsed,
+            }, outh, indent=1)
+        os.rename(tmp, self.stamp_path(node))
+
+    def clear(self, node):
+        if self.statedir is not None and os.path.exists(self.stamp_path(node)):
+            os.unlink(self.stamp_path(node))
+
+
+def _call_node(node, nthreads, quiet, logfile, debug, cache=None,
+               sample=None):
+    """ Call the stage function for a node
+
+    Nodes may set their own "quiet" and "logfile" arguments. If "logfile" is
+    a path it is opened here, so that nodes can be sent to worker processes.
+    If a stage cache is given, the stage function is wrapped so that cached
+    results are restored instead of running the stage. The call is recorded
+    in the trace, if enabled, tagged with "sample".
+    """
+    func = node.func if cache is None else stagecache.CachedStage(node.func, cache)
+    kwargs = dict(node.kwargs)
+    if node.max_threads != 1:
+        kwargs['ncpu'] = nthreads
+    kwargs.setdefault('quiet', quiet)
+    kwargs.setdefault('logfile', logfile)
+    kwargs['debug'] = debug
+    t0 = time.time()
+    with telemetry.context(sample=sample), scratch.toplevel(), \
+            telemetry.span('stage', node.name, ncpu=nthreads):
+        if isinstance(kwargs['logfile'], str):
+            with open(kwargs['logfile'], 'a') as logfh:
+                kwargs['logfile'] = logfh
+                func(**kwargs)
+        else:
+            func(**kwargs)
+    return time.time() - t0
+
+
+def _msg(dag, txt):
+    return '[--- %s ---] (%s) %s\n' % (dag.name, time.ctime(), txt)
+
+
+def run_dags(dags, ncpu=1, executor='thread', force=False, cache=None,
+             quiet=False, logfile=None, debug=False):
+    """ Run the nodes of one or more DAGs within a shared CPU budget
+
+    Nodes are started as soon as all of their dependencies have completed.
+    Free CPUs are divided evenly among the nodes that are ready to run, with
+    each node receiving no more than its "max_threads". When there are more
+    ready nodes than CPUs each node runs with a single thread, which favors
+    overall throughput over the latency of any one DAG. Ready nodes from DAGs
+    earlier in the list are started first.
+
+    A failed node stops the remaining nodes of its own DAG only; other DAGs
+    continue to run.
+
+    Args:
+        dags (list): StageDAG objects to run
+        ncpu (int): Total number of CPUs available to all running stages
+        executor (str): Run stages in threads ("thread") or in worker
+            processes ("process")
+        force (bool): Rerun nodes even if they are complete
+        cache (stagecache.StageCache): Reuse stage results from this cache
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        executed (dict): Names of nodes that were run in each DAG
+        failed (dict): Exceptions raised by failed nodes in each DAG
+
+    """
+    ncpu = max(1, ncpu)
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=ncpu)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=ncpu)
+    else:
+        raise PipelineStepError('Unknown executor: %s' % executor)
+
+    pending = [(dag, node) for dag in dags for node in dag.topological_order()]
+    done = {dag.name: set() for dag in dags}
+    executed = OrderedDict((dag.name, []) for dag in dags)
+    failed = OrderedDict()
+    running = {}
+    free = ncpu
+
+    with pool:
+        while pending or running:
+            progress = False
+            ready = [(dag, n) for dag, n in pending
+                     if dag.name not in failed
+                     and all(d in done[dag.name] for d in n.deps)]
+            for i, (dag, node) in enumerate(ready):
+                rerun_upstream = any(d in executed[dag.name] for d in node.deps)
+                if not force and not rerun_upstream and dag.is_complete(node):
+                    sysutils.log_message(
+                        _msg(dag, 'EXISTS: %s' % node.name), quiet, logfile
+                    )
+                    pending.remove((dag, node))
+                    done[dag.name].add(node.name)
+                    progress = True
+                    continue
+                if free < 1:
+                    break
+                # Share free CPUs between the nodes that are ready to run
+                share = max(1, free // (len(ready) - i))
+                nthreads = node.threads_wanted(share)
+                dag.clear(node)
+                sysutils.log_message(
+                    _msg(dag, 'Stage: %s (ncpu=%d)' % (node.name, nthreads)),
+                    quiet, logfile
+                )
+                fut = pool.submit(
+                    _call_node, node, nthreads,
+                    quiet, None if executor == 'process' else logfile, debug,
+                    cache, dag.sample
+                )
+                running[fut] = (dag, node, nthreads)
+                pending.remove((dag, node))
+                free -= nthreads
+                progress = True
+            if progress:
+                continue
+            if not running:
+                break
+
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                dag, node, nthreads = running.pop(fut)
+                free += nthreads
+                try:
+                    elapsed = fut.result()
+                except Exception as e:
+                    failed.setdefault(dag.name, OrderedDict())[node.name] = e
+                    sysutils.log_message(
+                        _msg(dag, 'FAILED: %s\n%s' % (node.name, e)),
+                        quiet, logfile
+                    )
+                    continue
+                if not debug:
+                    dag.mark_complete(node, elapsed)
+                done[dag.name].add(node.name)
+                executed[dag.name].append(node.name)
+                sysutils.log_message(
+                    _msg(dag, 'COMPLETED: %s (%.1f seconds)' % (node.name, elapsed)),
+                    quiet, logfile
+                )
+
+    return executed, failed
+
+
+def run_dag(dag, ncpu=1, force=False, cache=None,
+            quiet=False, logfile=None, debug=False):
+    """ Run the nodes of a DAG concurrently within a CPU budget
+
+    See run_dags() for how nodes are scheduled.
+
+    Args:
+        dag (StageDAG): Pipeline to run
+        ncpu (int): Total number of CPUs available to all running stages
+        force (bool): Rerun nodes even if they are complete
+        cache (stagecache.StageCache): Reuse stage results from this cache
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        executed (list): Names of nodes that were run
+
+    """
+    executed, failed = run_dags(
+        [dag, ], ncpu=ncpu, force=force, cache=cache,
+        quiet=quiet, logfile=logfile, debug=debug
+    )
+    if failed:
+        errors = failed[dag.name]
+        msg = 'Pipeline %s failed at stage(s): %s' % (dag.name, ', '.join(errors))
+        for name, e in errors.items():
+            msg += '\n[--- %s ---]\n%s' % (name, e)
+        raise PipelineStepError(msg)
+
+    return executed[dag.name]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""FASTA index (.fai) and sequence dictionary (.dict) without external tools
+
+Both files are written in one pass over the FASTA, and are the same as the
+files written by "samtools faidx" and "picard CreateSequenceDictionary"
+(picard 2.18), so no JVM has to be started to index a reference.
+
+The .fai has a line for each sequence: name, length, offset of the first
+base, bases per line and bytes per line. As in samtools, sequence names end
+at the first whitespace, all lines of a sequence except the last must have
+the same length, and a sequence may be followed by empty lines.
+
+The .dict is a SAM header with an @SQ line for each sequence, including the
+MD5 of the upper-cased sequence (M5) and the URI of the FASTA (UR).
+"""
+from __future__ import print_function
+import os
+import re
+import hashlib
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" @HD line written by picard CreateSequenceDictionary """
+DICT_HEADER = '@HD\tVN:1.5\tSO:unsorted\n'
+
+_NOT_GRAPH = bytes(bytearray(c for c in range(256) if not 33 <= c <= 126))
+_NAME = re.compile(br'[^ \t\n\v\f\r]*')
+
+
+class FastaIndexError(Exception):
+    pass
+
+
+class _Sequence(object):
+    """ Index entry of a sequence, filled in line by line
+
+    Lines are checked as in samtools: after a line that differs from the
+    first line, only empty lines may follow.
+    """
+    FIRST, FULL, LAST, ENDED = range(4)
+
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+        self.length = 0
+        self.line_bases = 0
+        self.line_width = 0
+        self.state = self.FIRST
+        self.dict_length = 0
+        self.md5 = hashlib.md5()
+
+    def add_line(self, line):
+        """ Add a sequence line (bytes, with the newline if any) """
+        content = line[:-1] if line.endswith(b'\n') else line
+        if not content:
+            if self.state == self.FIRST:
+                # Empty lines before the sequence are skipped
+                self.offset += len(line)
+                return
+            if self.state == self.FULL:
+                self.state = self.LAST
+            if self.state != self.ENDED:
+                return
+        if self.state == self.ENDED:
+            raise FastaIndexError(
+                'Inlined empty line is not allowed in sequence "%s"' %
+                self.name)
+        if self.state == self.LAST:
+            self.state = self.ENDED
+        # Bases are the printable characters of the line
+        nbases = len(content.translate(None, _NOT_GRAPH))
+        width = len(content) + 1
+        if self.state == self.ENDED and nbases:
+            raise FastaIndexError(
+                'Different line length in sequence "%s"' % self.name)
+        self.length += nbases
+        if self.state == self.FIRST:
+            self.line_bases, self.line_width = nbases, width
+            self.state = self.FULL
+        elif self.state == self.FULL:
+            if (nbases, width) != (self.line_bases, self.line_width):
+                self.state = self.LAST
+        # picard counts all characters of the line except the terminator
+        bases = content.rstrip(b'\r')
+        self.dict_length += len(bases)
+        self.md5.update(bases.upper())
+
+    def fai_line(self):
+        return '%s\t%d\t%d\t%d\t%d\n' % (self.name, self.length, self.offset,
+                                         self.line_bases, self.line_width)
+
+    def dict_line(self, uri):
+        return '@SQ\tSN:%s\tLN:%d\tM5:%s\tUR:%s\n' % (
+            self.name, self.dict_length, self.md5.hexdigest(), uri)
+
+
+def read_index(path):
+    """ Index entries of the sequences of a FASTA file
+
+    Returns:
+        seqs (list): _Sequence for each sequence, in order of the file
+
+    """
+    seqs = []
+    cur = None
+    offset = 0
+    with open(path, 'rb') as fh:
+        for line in fh:
+            offset += len(line)
+            if line.startswith(b'>'):
+                name = _NAME.match(line, 1).group(0)
+                cur = _Sequence(name.decode(), offset)
+                seqs.append(cur)
+            elif cur is not None:
+                cur.add_line(line)
+    return seqs
+
+
+def write_indexes(fasta, fai=None, seq_dict=None, uri=None):
+    """ Write FASTA index and sequence dictionary
+
+    Args:
+        fasta (str): Path to FASTA file (not compressed)
+        fai (str): Path to write FASTA index, if given
+        seq_dict (str): Path to write sequence dictionary, if given
+        uri (str): UR of sequences in dictionary. Default is "file:" and the
+            absolute path of the FASTA, as used by picard.
+
+    Returns:
+        seqs (list): Index entries of the sequences
+
+    """
+    seqs = read_index(fasta)
+    if fai is not None:
+        # samtools keeps the first of sequences with the same name
+        seen = set()
+        with open(fai, 'w') as outh:
+            for s in seqs:
+                if s.name not in seen:
+                    outh.write(s.fai_line())
+                    seen.add(s.name)
+    if seq_dict is not None:
+        names = [s.name for s in seqs]
+        if len(set(names)) != len(names):
+            dups = sorted(set(n for n in names if names.count(n) > 1))
+            raise FastaIndexError('Duplicate sequence names in %s: %s' %
+                                  (fasta, ', '.join(dups)))
+        if uri is None:
+            uri = 'file:%s' % os.path.abspath(fasta)
+        with open(seq_dict, 'w') as outh:
+            outh.write(DICT_HEADER)
+            for s in seqs:
+                outh.write(s.dict_line(uri))
+    return seqs
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""Batched FASTQ reader
+
+Reads plain or gzip (including BGZF) FASTQ in large blocks and yields
+batches of records. Sequences and qualities of a batch are stored as
+contiguous NumPy byte arrays, so that whole batches can be processed with
+array operations instead of one character at a time.
+
+Records must have four lines (sequence and quality on one line each), as
+written by Illumina instruments and every tool in the pipeline.
+"""
+from __future__ import print_function
+from __future__ import division
+import io
+import gzip
+
+import numpy as np
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Bytes read from the file at a time. A batch holds the complete records
+    in one block.
+"""
+BLOCK_SIZE = 4 << 20
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+_NL = ord('\n')
+_CR = ord('\r')
+
+
+class FastqFormatError(Exception):
+    pass
+
+
+def open_fastq(fh):
+    """ Open FASTQ for reading bytes
+
+    Compressed files are recognized by their content, not the file name.
+
+    Args:
+        fh (str or file): Path or open file
+
+    Returns:
+        fh (file): File object returning bytes, or the object given
+
+    """
+    if not isinstance(fh, basestring):
+        return fh
+    raw = io.open(fh, 'rb')
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    return raw
+
+
+class FastqBatch(object):
+    """ Records from one block of a FASTQ file
+
+    Attributes:
+        seq (numpy.ndarray): Sequences of all records, concatenated (uint8)
+        qual (numpy.ndarray): Qualities of all records, concatenated (uint8)
+        offsets (numpy.ndarray): Start of each record in seq and qual. The
+            last element is the total length.
+        first (int): Index of the first record in the file
+
+    """
+    def __init__(self, buf, hstart, hend, rend, seq, qual, offsets, first=0):
+        self._buf = buf
+        self._hstart = hstart
+        self._hend = hend
+        self._rend = rend
+        self.seq = seq
+        self.qual = qual
+        self.offsets = offsets
+        self.first = first
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def name(self, i):
+        """ Header of record i, without "@" """
+        return self._buf[self._hstart[i] + 1:self._hend[i]].tobytes()
+
+    def names(self):
+        return [self.name(i) for i in range(len(self))]
+
+    def record(self, i):
+        """ Record i as (name, seq, qual) bytes """
+        s, e = self.offsets[i], self.offsets[i + 1]
+        return (self.name(i), self.seq[s:e].tobytes(),
+                self.qual[s:e].tobytes())
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def slice(self, start, stop):
+        """ Batch with records start to stop (exclusive) """
+        s, e = self.offsets[start], self.offsets[stop]
+        return FastqBatch(self._buf, self._hstart[start:stop],
+                          self._hend[start:stop], self._rend[start:stop],
+                          self.seq[s:e], self.qual[s:e],
+                          self.offsets[start:stop + 1] - s, self.first + start)
+
+    def raw(self, i):
+        """ Text of record i, as in the file """
+        return self._buf[self._hstart[i]:self._rend[i]].tobytes()
+
+    def raw_list(self, idx):
+        """ Text of records idx, as a list of bytes """
+        data = self._buf.tobytes()
+        return [data[s:e] for s, e in zip(self._hstart[idx].tolist(),
+                                          self._rend[idx].tolist())]
+
+    def raw_selected(self, mask):
+        """ Text of the records where mask is True, as in the file """
+        data, _ = _gather(self._buf, self._hstart[mask], self._rend[mask])
+        return data.tobytes()
+
+    def name_hash(self, seed=0):
+        """ 64-bit hash of each read name
+
+        The name is the header up to the first whitespace, without a "/1"
+        or "/2" suffix, so that both mates of a pair have the same hash.
+
+        Args:
+            seed (int): Seed mixed into the hash
+
+        Returns:
+            hashes (numpy.ndarray): Hash of each record (uint64)
+
+        """
+        hdr, hoff = _gather(self._buf, self._hstart + 1, self._hend)
+        n = len(self)
+        hlen = np.diff(hoff)
+        # Position of each character within its header
+        rel = np.arange(len(hdr), dtype=np.int64) - np.repeat(hoff[:-1], hlen)
+        ws = (hdr == ord(' ')) | (hdr == ord('\t'))
+        nlen = hlen.copy()
+        nonempty = hlen > 0
+        if ws.any() and nonempty.any():
+            first_ws = np.where(ws, rel, np.iinfo(np.int64).max)
+            nlen[nonempty] = np.minimum(
+                hlen[nonempty], np.minimum.reduceat(first_ws, hoff[:-1][nonempty])
+            )
+        # Mate suffix
+        last = hoff[:-1] + nlen - 1
+        mate = (nlen >= 2) & (hdr[np.maximum(last - 1, 0)] == ord('/')) & \
+               np.isin(hdr[np.maximum(last, 0)], [ord('1'), ord('2')])
+        nlen[mate] -= 2
+
+        with np.errstate(over='ignore'):
+            inname = rel < np.repeat(nlen, hlen)
+            terms = hdr.astype(np.uint64) * _powers(int(hlen.max()) if n else 0)[rel]
+            terms[~inname] = 0
+            h = np.zeros(n, dtype=np.uint64)
+            if nonempty.any():
+                h[nonempty] = np.add.reduceat(terms, hoff[:-1][nonempty])
+            h += np.uint64(seed & 0xFFFFFFFFFFFFFFFF) * _GOLDEN
+            return _mix64(h)
+
+    def seq_hash(self, seed=0):
+        """ 64-bit hash of each sequence
+
+        Args:
+            seed (int): Seed mixed into the hash
+
+        Returns:
+            hashes (numpy.ndarray): Hash of each record (uint64)
+
+        """
+        lens = self.lengths
+        rel = self.cycles()
+        nonempty = lens > 0
+        with np.errstate(over='ignore'):
+            terms = self.seq.astype(np.uint64) * \
+                    _powers(int(lens.max()) if len(lens) else 0)[rel]
+            h = lens.astype(np.uint64)
+            if nonempty.any():
+                h[nonempty] += np.add.reduceat(terms, self.offsets[:-1][nonempty])
+            h += np.uint64(seed & 0xFFFFFFFFFFFFFFFF) * _GOLDEN
+            return _mix64(h)
+
+    def cycles(self):
+        """ Position of each base of seq (and qual) within its read """
+        return np.arange(len(self.seq), dtype=np.int64) - \
+               np.repeat(self.offsets[:-1], self.lengths)
+
+    def qual_min(self):
+        """ Minimum quality character of each record """
+        return self._reduce(np.minimum, 255)
+
+    def qual_max(self):
+        """ Maximum quality character of each record """
+        return self._reduce(np.maximum, 0)
+
+    def _reduce(self, ufunc, empty):
+        starts = self.offsets[:-1]
+        nonempty = starts < self.offsets[1:]
+        ret = np.full(len(self), empty, dtype=np.uint8)
+        if nonempty.any():
+            ret[nonempty] = ufunc.reduceat(self.qual, starts[nonempty])
+        return ret
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_POWERS = np.ones(1, dtype=np.uint64)
+
+
+def _powers(n):
+    """ Powers of the string hash multiplier, modulo 2**64 """
+    global _POWERS
+    if len(_POWERS) < n:
+        pw = np.empty(max(n, 2 * len(_POWERS)), dtype=np.uint64)
+        pw[0] = 1
+        with np.errstate(over='ignore'):
+            for i in range(1, len(pw)):
+                pw[i] = pw[i - 1] * np.uint64(1099511628211)
+        _POWERS = pw
+    return _POWERS
+
+
+def _mix64(h):
+    """ splitmix64 finalizer, spreads bits of h over the whole word """
+    with np.errstate(over='ignore'):
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return h ^ (h >> np.uint64(31))
+
+
+def _gather(arr, starts, ends):
+    """ Concatenate arr[starts[i]:ends[i]] for all i
+
+    Returns:
+        values (numpy.ndarray): Concatenated slices
+        offsets (numpy.ndarray): Start of each slice in values
+
+    """
+    lens = ends - starts
+    offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    idx = np.arange(offsets[-1], dtype=np.int64)
+    idx += np.repeat(starts - offsets[:-1], lens)
+    return arr[idx], offsets
+
+
+def _parse_block(data, first):
+    """ Parse the complete records in data
+
+    Returns:
+        batch (FastqBatch): Records, or None if there is no complete record
+        used (int): Number of bytes of data used
+
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    nl = np.flatnonzero(arr == _NL)
+    nrec = len(nl) // 4
+    if nrec == 0:
+        return None, 0
+    nl = nl[:nrec * 4]
+    starts = np.empty(nrec * 4, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = nl[:-1] + 1
+    ends = nl.copy()
+    # Windows line endings
+    crlf = (ends > starts) & (arr[np.maximum(ends - 1, 0)] == _CR)
+    ends[crlf] -= 1
+
+    hs, ps = starts[0::4], starts[2::4]
+    bad = (arr[hs] != ord('@')) | (arr[ps] != ord('+'))
+    if bad.any():
+        i = int(np.flatnonzero(bad)[0])
+        raise FastqFormatError('Record %d is not a 4-line FASTQ record' %
+                               (first + i + 1))
+    if not np.array_equal(ends[1::4] - starts[1::4], ends[3::4] - starts[3::4]):
+        i = int(np.flatnonzero(
+            (ends[1::4] - starts[1::4]) != (ends[3::4] - starts[3::4])
+        )[0])
+        raise FastqFormatError(
+            'Record %d: sequence and quality lengths differ' % (first + i + 1)
+        )
+
+    seq, offsets = _gather(arr, starts[1::4], ends[1::4])
+    qual, _ = _gather(arr, starts[3::4], ends[3::4])
+    batch = FastqBatch(arr, hs, ends[0::4], nl[3::4] + 1, seq, qual, offsets,
+                       first)
+    return batch, int(nl[-1]) + 1
+
+
+def read_batches(fh, block_size=BLOCK_SIZE):
+    """ Iterate over batches of records in FASTQ file
+
+    Args:
+        fh (str or file): Path to plain or gzipped FASTQ, or open file
+        block_size (int): Bytes read at a time
+
+    Yields:
+        batch (FastqBatch): Records in one block
+
+    """
+    infh = open_fastq(fh)
+    try:
+        rest = b''
+        nrec = 0
+        while True:
+            chunk = infh.read(block_size)
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            eof = not chunk
+            data = rest + chunk
+            if eof:
+                data = data.rstrip(b'\r\n')
+                if not data:
+                    break
+                data += b'\n'
+            batch, used = _parse_block(data, nrec)
+            if batch is not None:
+                nrec += len(batch)
+                yield batch
+            rest = data[used:]
+            if eof:
+                if rest.strip():
+                    raise FastqFormatError('Truncated record at end of file')
+                break
+    finally:
+        if infh is not fh:
+            infh.close()
+
+
+def read_records(fh, nreads=None, block_size=BLOCK_SIZE):
+    """ Iterate over batches of the first nreads records
+
+    Args:
+        fh (str or file): Path to FASTQ, or open file
+        nreads (int): Maximum number of records, or None for all
+
+    Yields:
+        batch (FastqBatch): Records in one block
+
+    """
+    if nreads is not None and nreads <= 0:
+        return
+    n = 0
+    for batch in read_batches(fh, block_size):
+        if nreads is not None and n + len(batch) > nreads:
+            batch = batch.slice(0, nreads - n)
+        n += len(batch)
+        yield batch
+        if nreads is not None and n >= nreads:
+            return
+
+
+def quality_histogram(fh, nreads=None):
+    """ Count of each quality character
+
+    Args:
+        fh (str or file): Path to FASTQ, or open file
+        nreads (int): Number of records to read, or None for all
+
+    Returns:
+        counts (numpy.ndarray): Number of occurrences of each byte value
+            (length 256)
+
+    """
+    counts = np.zeros(256, dtype=np.int64)
+    for batch in read_records(fh, nreads):
+        counts += np.bincount(batch.qual, minlength=256)
+    return counts
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Relay FASTQ records from named pipes to standard output
+
+Used to stream reads from one program to the next without writing them to
+disk. Records from two mate files are interleaved (read 1, read 2, read 1,
+...), as expected by "bowtie2 --interleaved". Each input is read by its own
+thread, so a program writing both mates is never blocked on one mate while
+the other is waiting to be read. Records can also be copied to files, and
+read statistics (see readqc) collected on the way.
+
+Usage:
+    python -m haphpipe.utils.fqstream IN1 [IN2] [--keep OUT1 [OUT2]]
+        [--ncpu N] [--qc SIDECAR [--encoding Phred+33]] [--no_output]
+"""
+from __future__ import print_function
+import sys
+import signal
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from haphpipe.utils import fastq
+from haphpipe.utils import gzutils
+from haphpipe.utils import readqc
+from haphpipe.utils import readsampler
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Bytes read from an input at a time """
+BLOCK_SIZE = 1 << 20
+
+""" Batches held for each input. Programs writing mates to two files write
+    them at nearly the same rate, so this only needs to cover buffering in
+    the writer; it also bounds memory use when the reader is slower.
+"""
+QUEUE_BATCHES = 32
+
+_DONE = object()
+
+
+def _reader(path, q):
+    try:
+        for batch in fastq.read_batches(path, BLOCK_SIZE):
+            q.put(batch)
+        q.put(_DONE)
+    except Exception as e:
+        q.put(e)
+
+
+def _drain(q):
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def queued_batches(path):
+    """ Start reading batches of FASTQ in a separate thread
+
+    The thread starts reading (and opens path) right away, not when the
+    first batch is requested.
+
+    Returns:
+        batches (iterator): Iterator of FastqBatch
+
+    """
+    q = queue.Queue(QUEUE_BATCHES)
+    t = threading.Thread(target=_reader, args=(path, q))
+    t.daemon = True
+    t.start()
+    return _drain(q)
+
+
+def relay(paths, outh, keep=None, qcs=None, ncpu=1):
+    """ Write records of paths to outh, interleaving mates
+
+    Args:
+        paths (list): One or two FASTQ files or named pipes
+        outh (file): Binary file for interleaved records, or None
+        keep (list): Files to copy records of each input to. Files named
+            ".gz" are compressed (at readsampler.COMPRESS_LEVEL).
+        qcs (list): readqc.ReadQC for each input
+        ncpu (int): Number of CPUs for compressing each file in keep
+
+    Returns:
+        nrecs (int): Number of records (or pairs) relayed
+
+    """
+    keeph = [gzutils.open_writer(k, ncpu, readsampler.COMPRESS_LEVEL)
+             for k in keep or []]
+    nrecs = 0
+    try:
+        iters = [queued_batches(p) for p in paths]
+        for batches in readsampler.lockstep(iters, paths):
+            for b, qc in zip(batches, qcs or []):
+                qc.add(b)
+            recs = [b.raw_list(slice(None)) for b in batches]
+            for r, kh in zip(recs, keeph):
+                kh.write(b''.join(r))
+            if outh is not None:
+                outh.write(b''.join(x for rr in zip(*recs) for x in rr))
+            nrecs += len(batches[0])
+    finally:
+        for kh in keeph:
+            kh.close()
+    return nrecs
+
+
+def console():
+    """ Entry point
+
+    Returns:
+        None
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Relay FASTQ records to stdout, interleaving mates.',
+    )
+    parser.add_argument('inputs', nargs='+',
+                        help='FASTQ files or named pipes (one or two)')
+    parser.add_argument('--keep', nargs='+',
+                        help='Also write records of each input to these files')
+    parser.add_argument('--ncpu', type=int, default=1,
+                        help='Number of CPUs for compressing each kept file')
+    parser.add_argument('--qc',
+                        help='Write read statistics of each input to this file')
+    parser.add_argument('--encoding', default='Phred+33',
+                        choices=['Phred+33', 'Phred+64'],
+                        help='Quality score encoding, for read statistics')
+    parser.add_argument('--no_output', action='store_true',
+                        help='Do not write records to stdout')
+    args = parser.parse_args()
+    # Exit quietly when the next program in the pipeline stops reading
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if len(args.inputs) > 2:
+        parser.error('at most two inputs are allowed')
+    if args.keep and len(args.keep) != len(args.inputs):
+        parser.error('--keep needs one file per input')
+    outh = None if args.no_output else getattr(sys.stdout, 'buffer', sys.stdout)
+    qcs = None
+    if args.qc:
+        offset = readqc.encoding_offset(args.encoding)
+        qcs = [readqc.ReadQC(offset) for _ in args.inputs]
+    try:
+        relay(args.inputs, outh, args.keep, qcs, args.ncpu)
+        if outh is not None:
+            outh.flush()
+        if qcs:
+            labels = ['1', '2'] if len(qcs) == 2 else ['U']
+            readqc.write_sidecar(args.qc, dict(zip(labels, qcs)))
+    except (fastq.FastqFormatError, readsampler.MateMismatchError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    console()
@@ -5,11 +5,15 @@ from __future__ import print_function
 from builtins import zip
 from builtins import str
 from builtins import object
-from past.builtins import basestring
 
 import re
 import sys
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 from haphpipe.utils.helpers import cast_str
 
 
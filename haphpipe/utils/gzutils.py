@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Compressed read files
+
+Reads are compressed with the fastest multi-threaded compressor found in
+PATH: bgzip (block gzip, BGZF), then pigz, then gzip. All produce files that
+gzip and every read tool in the pipeline can read.
+"""
+from __future__ import print_function
+import os
+import gzip
+import subprocess
+
+from haphpipe.utils import sysutils
+from haphpipe.utils.sysutils import PipelineStepError
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compressors in order of preference: (program, thread args, level args) """
+COMPRESSORS = [
+    ('bgzip', ['-@', '{ncpu}'], ['-l', '{level}']),
+    ('pigz', ['-p', '{ncpu}'], ['-{level}']),
+    ('gzip', [], ['-{level}']),
+]
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+_found = {}
+
+
+def _in_path(prog):
+    if prog not in _found:
+        try:
+            sysutils.check_dependency(prog)
+            _found[prog] = True
+        except PipelineStepError:
+            _found[prog] = False
+    return _found[prog]
+
+
+def find_compressor():
+    """ Name of the preferred compressor in PATH, or None """
+    for prog, _, _ in COMPRESSORS:
+        if _in_path(prog):
+            return prog
+    return None
+
+
+def compressor_args(ncpu=1, level=None):
+    """ Compressor program and its arguments, without "-c"
+
+    Args:
+        ncpu (int): Number of compression threads
+        level (int): Compression level (1-9), or None for the default
+
+    Returns:
+        args (list): Program followed by arguments
+
+    """
+    prog = find_compressor()
+    if prog is None:
+        raise PipelineStepError('No gzip compressor (bgzip, pigz or gzip) found')
+    _, targs, largs = [c for c in COMPRESSORS if c[0] == prog][0]
+    ret = [prog]
+    if ncpu > 1:
+        ret += [a.format(ncpu=ncpu) for a in targs]
+    if level is not None:
+        ret += [a.format(level=level) for a in largs]
+    return ret
+
+
+def compress_cmd(ncpu=1, level=None):
+    """ Command compressing stdin to stdout """
+    return compressor_args(ncpu, level) + ['-c', ]
+
+
+def decompress_cmd(ncpu=1):
+    """ Command writing a file to stdout, decompressing it if needed """
+    prog = find_compressor()
+    if prog == 'bgzip':
+        # bgzip cannot pass through uncompressed input
+        prog = 'pigz' if _in_path('pigz') else 'gzip'
+    if prog == 'pigz' and ncpu > 1:
+        return ['pigz', '-p', '%d' % ncpu, '-dcf', ]
+    return [prog or 'gzip', '-dcf', ]
+
+
+def is_gzip(path):
+    """ File is gzip-compressed, judged by content """
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+def fastq_name(path, compress):
+    """ FASTQ output name, with ".gz" added if compressed """
+    return path + '.gz' if compress and not path.endswith('.gz') else path
+
+
+class GzipWriter(object):
+    """ Write a gzip file through the preferred compressor
+
+    Compression runs in a separate process (with ncpu threads), in parallel
+    with the Python code producing the data. Falls back to the gzip module
+    if no compressor program is found.
+    """
+    def __init__(self, path, ncpu=1, level=None):
+        self.path = path
+        self._proc = None
+        if find_compressor() is None:
+            self._fh = gzip.open(path, 'wb', compresslevel=level or 6)
+            return
+        self._out = open(path, 'wb')
+        self._proc = subprocess.Popen(
+            compress_cmd(ncpu, level), stdin=subprocess.PIPE, stdout=self._out
+        )
+        self._fh = self._proc.stdin
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def close(self):
+        self._fh.close()
+        if self._proc is not None:
+            status = self._proc.wait()
+            self._out.close()
+            if status != 0:
+                raise PipelineStepError(
+                    'Compressing %s failed with status %d' % (self.path, status)
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(path, ncpu=1, level=None):
+    """ Open output file for bytes, compressed if named ".gz"
+
+    Returns:
+        fh (file): GzipWriter for ".gz" files, otherwise a plain file
+
+    """
+    if path.endswith('.gz'):
+        return GzipWriter(path, ncpu, level)
+    return open(path, 'wb')
+
+
+def uncompressed(paths, tempdir, ncpu=1):
+    """ Decompress gzipped files for tools that require plain text
+
+    Args:
+        paths (list): Input paths. None entries are passed through.
+        tempdir (str): Directory for decompressed copies
+
+    Returns:
+        paths (list): Plain text paths, in the same order
+        cmds (list): Commands creating the decompressed copies
+
+    """
+    ret, cmds = [], []
+    for p in paths:
+        if p is None:
+            ret.append(p)
+            continue
+        if not (is_gzip(p) if os.path.isfile(p) else p.endswith('.gz')):
+            ret.append(p)
+            continue
+        base = os.path.basename(p)[:-3] if p.endswith('.gz') else os.path.basename(p)
+        plain = os.path.join(tempdir, 'plain%d.%s' % (len(cmds), base))
+        cmds.append(decompress_cmd(ncpu) + [p, '>', plain, ])
+        ret.append(plain)
+    return ret, cmds
@@ -5,7 +5,6 @@ from __future__ import absolute_import
 from builtins import next
 from builtins import str
 from builtins import zip
-from past.builtins import basestring
 
 import math
 from itertools import tee
@@ -14,7 +13,6 @@ try:
 except ImportError:
     pass
 
-from haphpipe.utils import sysutils
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
@@ -83,40 +81,34 @@ def guess_encoding(fh, nsamp=100):
         fh (str or file): Fastq file to guess encoding
         
     """
-    fh = sysutils.get_filehandle(fh)
+    import numpy as np
+    from haphpipe.utils import fastq
 
     # Initialize min and max
-    minq, maxq = ('z', '!')
-
-    for i,l in enumerate(fh):
-        if i % 4 == 3:
-            l = l.decode('utf-8') if isinstance(l, bytes) else l
-            """ Solexa+64 can be as low as -5, so if there are any ASCII characters below
-                59 (64-5), it is definitely phred-33.
-                chr(64-5) == ';'
-            """
-            if any(c < ';' for c in l.strip('\n')):
-                return 'Phred+33'
-            """ Phred+33 maxes out at 74 (33+41) for Illumina data, but PacBio QV can be
-                above 60. We'll assume that we will not see any QVs above 64. If there are
-                ASCII characters above 97 (33+64) we will assume this is Phred+64.
-                chr(33+64) == 'a'
-            """
-            if any(c >= 'a' for c in l.strip('\n')):
-                return 'Phred+64'
-            """ Otherwise just set the overall min and max values """
-            minq = min(minq+l)
-            maxq = max(maxq+l)
-        if i >= nsamp*4:
-            break
-    
-    """ All sample lines have been processed and no characters below chr(64-5) == ';'
-        (indicating Phred+33) or above chr(33+64) == 'a' (indicating Phred+64) were found.
-        We will assume that the file is Phred+64 if qualities greater than chr(75) == 'K'
-        were observed, since 1.8+ Illumina reads max out at Q41 ('J').
-        
-    """
-    return 'Phred+64' if maxq > 'K' else 'Phred+33'
+    minq, maxq = (ord('z'), ord('!'))
+
+    for batch in fastq.read_records(fh, nsamp):
+        rmin, rmax = batch.qual_min(), batch.qual_max()
+        """ Solexa+64 can be as low as -5, so if there are any ASCII characters below
+            59 (64-5), it is definitely phred-33.
+            chr(64-5) == ';'
+            Phred+33 maxes out at 74 (33+41) for Illumina data, but PacBio QV can be
+            above 60. We'll assume that we will not see any QVs above 64. If there are
+            ASCII characters above 97 (33+64) we will assume this is Phred+64.
+            chr(33+64) == 'a'
+            The first read with either is decisive.
+        """
+        lo = rmin < ord(';')
+        hi = rmax >= ord('a')
+        if lo.any() or hi.any():
+            i = int(np.flatnonzero(lo | hi)[0])
+            return 'Phred+33' if lo[i] else 'Phred+64'
+        """ Otherwise just set the overall min and max values """
+        if len(batch):
+            minq = min(minq, int(rmin.min()))
+            maxq = max(maxq, int(rmax.max()))
+
+    return 'Phred+64' if maxq > ord('K') else 'Phred+33'
 
 
 def pairwise(iterable):
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""K-mers of batches of sequences, packed as 2-bit integers
+
+Bases are encoded as A=0, C=1, G=2, T=3, so a k-mer with k <= 31 fits in a
+64-bit integer. K-mers are canonical: the smaller of the k-mer and its
+reverse complement, so a read and its reverse complement have the same
+k-mers. K-mers containing ambiguous bases (anything other than ACGT) are
+skipped.
+
+Sequences are given as batches: concatenated uint8 arrays with offsets.
+fastq.FastqBatch is such a batch, and SeqBatch holds sequences from FASTA
+files or strings. All k-mers of a batch are computed with array operations.
+
+K-mers are counted exactly (KmerCounter) or approximately in fixed memory
+(CountMinSketch). Both have the same add() and query() methods, so either
+can answer containment questions: which fraction of the k-mers of each
+sequence was seen in a reference?
+
+    ref = KmerCounter(21)
+    for batch in read_fasta_batches('references.fasta'):
+        ref.add_batch(batch)
+    for batch in fastq.read_batches('reads.fastq'):
+        frac = containment(batch, ref)
+"""
+from __future__ import print_function
+from __future__ import division
+import gzip
+
+import numpy as np
+
+from haphpipe.utils import fastq
+from haphpipe.utils import gzutils
+from haphpipe.utils import sequtils
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Largest k-mer size that fits in 64 bits """
+MAX_K = 31
+
+""" Code for ambiguous bases """
+AMBIG = 4
+
+""" Bases of FASTA sequences per batch """
+BATCH_BASES = 4 << 20
+
+""" Pending k-mers added to a KmerCounter before they are merged """
+MERGE_SIZE = 8 << 20
+
+_CODES = np.full(256, AMBIG, dtype=np.uint8)
+for _i, _b in enumerate('ACGT'):
+    _CODES[ord(_b)] = _CODES[ord(_b.lower())] = _i
+
+
+def encode(seq):
+    """ 2-bit codes of bases (uint8 array of characters), AMBIG if not ACGT """
+    return _CODES[seq]
+
+
+def check_k(k):
+    if not 1 <= k <= MAX_K:
+        raise ValueError('k-mer size must be between 1 and %d: %d' % (MAX_K, k))
+
+
+class SeqBatch(object):
+    """ Sequences, concatenated as in fastq.FastqBatch
+
+    Attributes:
+        names (list): Name of each sequence
+        seq (numpy.ndarray): Sequences, concatenated (uint8)
+        offsets (numpy.ndarray): Start of each sequence in seq. The last
+            element is the total length.
+
+    """
+    def __init__(self, names, seq, offsets):
+        self.names = names
+        self.seq = seq
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_records(cls, records):
+        """ Batch of (name, sequence) string pairs """
+        names = [n for n, _ in records]
+        seqs = [s.encode('ascii') for _, s in records]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in seqs], out=offsets[1:])
+        seq = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        return cls(names, seq, offsets)
+
+
+def read_fasta_batches(path, batch_bases=BATCH_BASES):
+    """ Read FASTA file (optionally gzipped) as batches
+
+    Yields:
+        batch (SeqBatch): Batch of about batch_bases bases
+
+    """
+    opener = gzip.open if gzutils.is_gzip(path) else open
+    with opener(path, 'rt') as fh:
+        records, nbases = [], 0
+        for name, s in sequtils.fastagen(fh):
+            if name is None:
+                continue
+            records.append((name, s))
+            nbases += len(s)
+            if nbases >= batch_bases:
+                yield SeqBatch.from_records(records)
+                records, nbases = [], 0
+        if records:
+            yield SeqBatch.from_records(records)
+
+
+def batch_kmers(batch, k):
+    """ Canonical k-mers of a batch (fastq.FastqBatch or SeqBatch)
+
+    Returns:
+        kmers (numpy.ndarray): Canonical k-mers (uint64), in order of
+            sequence and position
+        index (numpy.ndarray): Sequence number of each k-mer
+
+    """
+    return packed_kmers(batch.seq, batch.offsets, k)
+
+
+def packed_kmers(seq, offsets, k):
+    """ Canonical k-mers of concatenated sequences
+
+    Args:
+        seq (numpy.ndarray): Sequences, concatenated (uint8)
+        offsets (numpy.ndarray): Start of each sequence in seq. The last
+            element is the total length.
+        k (int): K-mer size
+
+    Returns:
+        kmers (numpy.ndarray): Canonical k-mers (uint64), in order of
+            sequence and position
+        index (numpy.ndarray): Sequence number of each k-mer
+
+    """
+    check_k(k)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    codes = encode(seq)
+    nseq = len(offsets) - 1
+    nk = np.maximum(np.diff(offsets) - k + 1, 0)
+    index = np.repeat(np.arange(nseq, dtype=np.int64), nk)
+    if len(index) == 0:
+        return np.zeros(0, dtype=np.uint64), index
+    # Start of each window
+    starts = np.arange(len(index), dtype=np.int64) - \
+             np.repeat(np.cumsum(nk) - nk, nk) + offsets[:-1][index]
+
+    # Windows with ambiguous bases
+    nambig = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == AMBIG, out=nambig[1:])
+    ok = nambig[starts + k] == nambig[starts]
+
+    c = (codes & 3).astype(np.uint64)
+    fwd = _windows(c, k, False)
+    rev = _windows(np.uint64(3) - c, k, True)
+    kmers = np.minimum(fwd, rev)[starts[ok]]
+    return kmers, index[ok]
+
+
+def _join(left, right, nleft, reverse):
+    """ Pack windows of nleft bases followed by windows of right """
+    n = len(right) - nleft
+    if reverse:
+        return (right[nleft:] << np.uint64(2 * nleft)) | left[:n]
+    shift = 2 * (len(left) - len(right) + nleft)
+    return (left[:n] << np.uint64(shift)) | right[nleft:]
+
+
+def _windows(c, k, reverse=False):
+    """ Packed windows of k codes at every position of c
+
+    Windows of 2m codes are packed from windows of m codes, so only
+    O(log k) passes over the sequence are needed. With reverse, the codes
+    are packed in reverse order (for reverse complements).
+
+    """
+    ret, nret = None, 0
+    cur, m = c, 1
+    while True:
+        if k & m:
+            if ret is None:
+                ret, nret = cur, m
+            else:
+                ret = _join(ret, cur, nret, reverse)
+                nret += m
+        if 2 * m > k:
+            return ret
+        cur = _join(cur, cur, m, reverse)
+        m *= 2
+
+
+def decode(kmer, k):
+    """ Sequence of a packed k-mer """
+    return ''.join('ACGT'[(int(kmer) >> (2 * (k - 1 - j))) & 3]
+                   for j in range(k))
+
+
+class KmerCounter(object):
+    """ Exact counts of canonical k-mers
+
+    Distinct k-mers are kept as a sorted array with counts. Added k-mers
+    are merged in when MERGE_SIZE are pending, or when counts are needed.
+
+    Args:
+        k (int): K-mer size
+    """
+    def __init__(self, k):
+        check_k(k)
+        self.k = k
+        self.kmers = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._npending = 0
+
+    def __len__(self):
+        self._merge()
+        return len(self.kmers)
+
+    def add(self, kmers, counts=None):
+        """ Count kmers (uint64 array), each once or counts times """
+        if counts is None:
+            counts = np.ones(len(kmers), dtype=np.int64)
+        self._pending.append((kmers, np.asarray(counts, dtype=np.int64)))
+        self._npending += len(kmers)
+        if self._npending >= MERGE_SIZE:
+            self._merge()
+
+    def add_batch(self, batch):
+        """ Count k-mers of a batch (fastq.FastqBatch or SeqBatch) """
+        self.add(batch_kmers(batch, self.k)[0])
+
+    def _merge(self):
+        if not self._pending:
+            return
+        km = np.concatenate([self.kmers] + [p[0] for p in self._pending])
+        n = np.concatenate([self.counts] + [p[1] for p in self._pending])
+        self.kmers, inv = np.unique(km, return_inverse=True)
+        self.counts = np.bincount(inv.ravel(), weights=n,
+                                  minlength=len(self.kmers)).astype(np.int64)
+        self._pending, self._npending = [], 0
+
+    def query(self, kmers):
+        """ Counts of kmers (uint64 array), 0 if not seen """
+        self._merge()
+        ret = np.zeros(len(kmers), dtype=np.int64)
+        if len(self.kmers):
+            idx = np.minimum(np.searchsorted(self.kmers, kmers),
+                             len(self.kmers) - 1)
+            found = self.kmers[idx] == kmers
+            ret[found] = self.counts[idx[found]]
+        return ret
+
+
+class CountMinSketch(object):
+    """ Approximate k-mer counts in fixed memory
+
+    Each k-mer is counted in one cell of each of depth rows, chosen by
+    double hashing, and its count is the minimum over the rows. Counts
+    are never underestimated, and overestimated only by collisions.
+    Counters saturate at MAX_COUNT.
+
+    Args:
+        width (int): Cells per row, rounded down to a power of 2
+        depth (int): Number of rows
+        k (int): K-mer size, needed to add batches
+    """
+    MAX_COUNT = np.iinfo(np.uint16).max
+
+    def __init__(self, width, depth=4, k=None):
+        if k is not None:
+            check_k(k)
+        self.k = k
+        self.width = 1 << max(int(width).bit_length() - 1, 0)
+        self.depth = depth
+        self.table = np.zeros((depth, self.width), dtype=np.uint16)
+        self._mask = np.uint64(self.width - 1)
+
+    @classmethod
+    def from_memory(cls, nbytes, depth=4, k=None):
+        """ Sketch using at most nbytes for counters """
+        itemsize = np.dtype(np.uint16).itemsize
+        return cls(max(nbytes // (depth * itemsize), 1), depth, k)
+
+    def _cells(self, kmers):
+        """ Cell of kmers in each row, by double hashing """
+        with np.errstate(over='ignore'):
+            h = fastq._mix64(kmers)
+            step = (h >> np.uint64(32)) | np.uint64(1)
+            for row in range(self.depth):
+                yield h & self._mask
+                h += step
+
+    def add(self, kmers, counts=None):
+        """ Count kmers (uint64 array), each once or counts times """
+        if len(kmers) == 0:
+            return
+        for row, cells in enumerate(self._cells(kmers)):
+            u, inv = np.unique(cells, return_inverse=True)
+            n = np.bincount(inv.ravel(), weights=counts, minlength=len(u))
+            t = self.table[row]
+            t[u] = np.minimum(t[u] + n.astype(np.int64), self.MAX_COUNT)
+
+    def query(self, kmers):
+        """ Counts of kmers (uint64 array) """
+        ret = np.full(len(kmers), self.MAX_COUNT, dtype=np.int64)
+        for row, cells in enumerate(self._cells(kmers)):
+            np.minimum(ret, self.table[row][cells], out=ret)
+        return ret
+
+    def add_batch(self, batch):
+        """ Count k-mers of a batch (fastq.FastqBatch or SeqBatch) """
+        self.add(batch_kmers(batch, self.k)[0])
+
+
+def containment(batch, counter, min_count=1):
+    """ Fraction of k-mers of each sequence found in counter
+
+    Args:
+        batch (fastq.FastqBatch or SeqBatch): Sequences
+        counter (KmerCounter or CountMinSketch): Counted k-mers, for
+            instance of references
+        min_count (int): K-mers counted fewer times are not found
+
+    Returns:
+        fractions (numpy.ndarray): Fraction of k-mers of each sequence found,
+            NaN for sequences without k-mers
+
+    """
+    km, index = batch_kmers(batch, counter.k)
+    found = counter.query(km) >= min_count
+    total = np.bincount(index, minlength=len(batch))
+    nfound = np.bincount(index, weights=found, minlength=len(batch))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return nfound / total
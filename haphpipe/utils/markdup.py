@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Duplicate marking backends for aligned reads
+
+"picard" runs picard MarkDuplicates on the sorted BAM. "samtools" marks
+duplicates as the alignments are sorted, in the pipeline that produces them:
+
+    bowtie2 | samtools fixmate -m | samtools sort | samtools markdup
+
+Both mark the same reads: for each set of reads (or pairs) with the same
+unclipped 5' positions and orientations, all but the one with the highest
+sum of base qualities are duplicates. bowtie2 writes the mates of a pair
+next to each other, so its output can go to fixmate without collating.
+
+samtools markdup reports its counts on stderr (with "-s"); they are written
+as a picard DuplicationMetrics file, with the library size estimated as
+picard does, so the metrics of both backends can be read the same way.
+samtools does not detect optical duplicates, which are counted as ordinary
+duplicates.
+"""
+from __future__ import print_function
+from __future__ import division
+import re
+import math
+import time
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Duplicate marking backends, the first is the default """
+BACKENDS = ['picard', 'samtools', ]
+
+METRICS_COLUMNS = [
+    'LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED',
+    'SECONDARY_OR_SUPPLEMENTARY_RDS', 'UNMAPPED_READS',
+    'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+    'READ_PAIR_OPTICAL_DUPLICATES', 'PERCENT_DUPLICATION',
+    'ESTIMATED_LIBRARY_SIZE',
+]
+
+# Counts are "NAME count" (samtools 1.9) or "NAME: count" (later versions)
+_STAT = re.compile(r'([A-Z][A-Z_ ]*?):?\s+(\d+)')
+
+
+def fixmate_cmd():
+    """ Command adding mate tags to name-grouped alignments (a pipe) """
+    return ['samtools', 'fixmate', '-m', '-O', 'sam', '-', '-', ]
+
+
+def markdup_cmd(in_bam, out_bam, stats, remove=False, tmp_prefix=None):
+    """ samtools markdup command, with counts written to stats
+
+    Args:
+        in_bam (str): Coordinate-sorted BAM with mate tags, "-" for stdin
+        out_bam (str): Path to write BAM with duplicates marked
+        stats (str): Path to write samtools markdup counts
+        remove (bool): Remove duplicates instead of marking them
+        tmp_prefix (str): Prefix for temporary files
+
+    Returns:
+        cmd (list): Command
+
+    """
+    cmd = ['samtools', 'markdup', '-s', ]
+    if remove:
+        cmd += ['-r', ]
+    if tmp_prefix is not None:
+        cmd += ['-T', tmp_prefix, ]
+    return cmd + [in_bam, out_bam, '2>', stats, ]
+
+
+def parse_markdup_stats(text):
+    """ Counts reported by samtools markdup -s
+
+    Returns:
+        stats (dict): Count for each name (e.g. "DUPLICATE PAIR")
+
+    """
+    ret = {}
+    for line in text.splitlines():
+        for name, count in _STAT.findall(line):
+            # samtools 1.9 misspells "DUPLICATE PAIR"
+            name = name.strip().replace('DULPICATE', 'DUPLICATE')
+            ret[name] = int(count)
+    return ret
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    """ Library size from duplication of pairs, as in picard
+
+    Returns:
+        size (int): Estimated number of distinct molecules, None if there
+            are no duplicates
+
+    """
+    f = lambda x, c, n: c / x - 1 + math.exp(-n / x)
+    n, c = read_pairs, unique_read_pairs
+    if n <= 0 or n - c <= 0:
+        return None
+    m, M = 1.0, 100.0
+    if c >= n or f(m * c, c, n) < 0:
+        raise ValueError('Invalid values for pairs and unique pairs: %d, %d' %
+                         (n, c))
+    while f(M * c, c, n) > 0:
+        M *= 10.0
+    for _ in range(40):
+        r = (m + M) / 2.0
+        u = f(r * c, c, n)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(c * (m + M) / 2.0)
+
+
+def duplication_metrics(stats, library):
+    """ picard DuplicationMetrics from samtools markdup counts
+
+    Mates, and duplicate mates, are counted by samtools as reads and by
+    picard as pairs. All reads excluded by samtools are counted as unmapped,
+    since bowtie2 writes no secondary or supplementary alignments.
+
+    Returns:
+        metrics (dict): Value of each of METRICS_COLUMNS
+
+    """
+    ret = {
+        'LIBRARY': library,
+        'UNPAIRED_READS_EXAMINED': stats.get('SINGLE', 0),
+        'READ_PAIRS_EXAMINED': stats.get('PAIRED', 0) // 2,
+        'SECONDARY_OR_SUPPLEMENTARY_RDS': 0,
+        'UNMAPPED_READS': stats.get('EXCLUDED', 0),
+        'UNPAIRED_READ_DUPLICATES': stats.get('DUPLICATE SINGLE', 0),
+        'READ_PAIR_DUPLICATES': stats.get('DUPLICATE PAIR', 0) // 2,
+        'READ_PAIR_OPTICAL_DUPLICATES': 0,
+    }
+    examined = ret['UNPAIRED_READS_EXAMINED'] + 2 * ret['READ_PAIRS_EXAMINED']
+    dups = ret['UNPAIRED_READ_DUPLICATES'] + 2 * ret['READ_PAIR_DUPLICATES']
+    ret['PERCENT_DUPLICATION'] = dups / examined if examined else 0.0
+    ret['ESTIMATED_LIBRARY_SIZE'] = estimate_library_size(
+        ret['READ_PAIRS_EXAMINED'] - ret['READ_PAIR_OPTICAL_DUPLICATES'],
+        ret['READ_PAIRS_EXAMINED'] - ret['READ_PAIR_DUPLICATES'],
+    )
+    return ret
+
+
+def _format(v):
+    """ Metric value as written by picard """
+    if v is None:
+        return ''
+    if isinstance(v, float):
+        return ('%.6f' % v).rstrip('0').rstrip('.')
+    return str(v)
+
+
+def write_metrics(stats_file, metrics_file, library, command):
+    """ Write samtools markdup counts as a picard metrics file
+
+    Args:
+        stats_file (str): Path to samtools markdup -s output
+        metrics_file (str): Path to write metrics
+        library (str): Library name (LB of the read group)
+        command (str): Command line recorded in the header
+
+    Returns:
+        metrics (dict): Value of each of METRICS_COLUMNS
+
+    """
+    with open(stats_file, 'r') as fh:
+        stats = parse_markdup_stats(fh.read())
+    metrics = duplication_metrics(stats, library)
+    with open(metrics_file, 'w') as outh:
+        outh.write('## htsjdk.samtools.metrics.StringHeader\n')
+        outh.write('# %s\n' % command)
+        outh.write('## htsjdk.samtools.metrics.StringHeader\n')
+        outh.write('# Started on: %s\n\n' % time.strftime('%c'))
+        outh.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        outh.write('\t'.join(METRICS_COLUMNS) + '\n')
+        outh.write('\t'.join(_format(metrics[c]) for c in METRICS_COLUMNS))
+        outh.write('\n\n\n')
+    return metrics
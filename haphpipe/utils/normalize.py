@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Digital normalization of reads by median k-mer abundance
+
+Reads are read once, in order. The abundance of a read is the median count
+of its k-mers among the reads kept so far; reads with abundance below the
+target coverage are kept and their k-mers counted, the others are
+discarded. Coverage of each region is thus capped near the target, while
+reads from regions with low coverage are all kept. K-mers are counted in a
+count-min sketch (kmers.CountMinSketch), so memory is fixed whatever the
+size of the input.
+
+Pairs are kept or discarded together: a pair is kept if either mate has
+abundance below the target. Reads without k-mers (shorter than k, or with
+too many ambiguous bases) are always kept.
+
+Reads are processed a batch at a time. Within a batch, k-mers of earlier
+reads in the batch are added to the counts from the sketch, so duplicates
+within a batch are discarded too. These include k-mers of reads that are
+themselves discarded, so slightly more reads are discarded than if reads
+were processed one at a time.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+from haphpipe.utils import gzutils
+from haphpipe.utils import kmers
+from haphpipe.utils import readsampler
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Default target coverage and k-mer size """
+TARGET = 20
+KSIZE = 20
+
+""" Default memory for the sketch, in bytes """
+MAX_MEMORY = 1 << 30
+
+
+def _group(km, index):
+    """ Group k-mers of a batch
+
+    Args:
+        km (numpy.ndarray): K-mers (uint64)
+        index (numpy.ndarray): Read number of each k-mer
+
+    Returns:
+        uniq (numpy.ndarray): Distinct k-mers
+        group (numpy.ndarray): Index of each k-mer in uniq
+        earlier (numpy.ndarray): Number of occurrences of each k-mer in
+            reads with smaller read numbers
+
+    """
+    # Sort by read number, then (stably) by k-mer
+    order = np.argsort(index, kind='stable')
+    order = order[np.argsort(km[order], kind='stable')]
+    skm, sidx = km[order], index[order]
+    n = len(km)
+    pos = np.arange(n, dtype=np.int64)
+    new_kmer = np.ones(n, dtype=bool)
+    new_kmer[1:] = skm[1:] != skm[:-1]
+    new_read = new_kmer.copy()
+    new_read[1:] |= sidx[1:] != sidx[:-1]
+    kmer_start = np.maximum.accumulate(np.where(new_kmer, pos, 0))
+    read_start = np.maximum.accumulate(np.where(new_read, pos, 0))
+    group = np.empty(n, dtype=np.int64)
+    group[order] = np.cumsum(new_kmer) - 1
+    earlier = np.empty(n, dtype=np.int64)
+    earlier[order] = read_start - kmer_start
+    return skm[new_kmer], group, earlier
+
+
+def _medians(counts, index, nreads, cap):
+    """ Median of counts (capped at cap) for each read
+
+    Returns:
+        medians (numpy.ndarray): Median count of each read
+        has_kmers (numpy.ndarray): Read has at least one k-mer
+
+    """
+    nk = np.bincount(index, minlength=nreads)
+    has_kmers = nk > 0
+    medians = np.zeros(nreads)
+    if len(counts):
+        key = np.sort(index * (cap + 1) + np.minimum(counts, cap))
+        start = np.cumsum(nk) - nk
+        lo = key[(start + (nk - 1) // 2)[has_kmers]] % (cap + 1)
+        hi = key[(start + nk // 2)[has_kmers]] % (cap + 1)
+        medians[has_kmers] = (lo + hi) / 2
+    return medians, has_kmers
+
+
+class Normalizer(object):
+    """ Keep reads (or pairs) until their k-mers reach target coverage
+
+    Args:
+        target (int): Target coverage
+        k (int): K-mer size
+        max_memory (int): Memory for the sketch, in bytes
+    """
+    def __init__(self, target=TARGET, k=KSIZE, max_memory=MAX_MEMORY):
+        kmers.check_k(k)
+        if not 1 <= target < kmers.CountMinSketch.MAX_COUNT:
+            raise ValueError('Target coverage must be between 1 and %d: %d' %
+                             (kmers.CountMinSketch.MAX_COUNT - 1, target))
+        self.target = target
+        self.k = k
+        self.sketch = kmers.CountMinSketch.from_memory(max_memory, k=k)
+
+    def select(self, batches):
+        """ Decide which reads (or pairs) of batches to keep
+
+        Args:
+            batches (list): One fastq.FastqBatch per mate, with the same
+                records
+
+        Returns:
+            keep (numpy.ndarray): Read (or pair) is kept
+
+        """
+        n = len(batches[0])
+        per_mate = [kmers.batch_kmers(b, self.k) for b in batches]
+        km = np.concatenate([m[0] for m in per_mate])
+        index = np.concatenate([m[1] for m in per_mate])
+        mate = np.repeat(np.arange(len(per_mate)),
+                         [len(m[1]) for m in per_mate])
+
+        # Counts only grow, so reads at target coverage in the sketch are
+        # discarded whatever the earlier reads of the batch
+        counts = self.sketch.query(km)
+        keep = self._below(counts, index, mate, n)
+        sel = keep[index]
+        km, index, mate, counts = km[sel], index[sel], mate[sel], counts[sel]
+
+        uniq, group, earlier = _group(km, index)
+        keep &= self._below(counts + earlier, index, mate, n)
+        nkept = np.bincount(group, weights=keep[index], minlength=len(uniq))
+        self.sketch.add(uniq[nkept > 0], nkept[nkept > 0])
+        return keep
+
+    def _below(self, counts, index, mate, n):
+        """ Reads (or pairs) with any mate below target or without k-mers """
+        below = np.zeros(n, dtype=bool)
+        any_kmers = np.zeros(n, dtype=bool)
+        for m in range(mate.max() + 1 if len(mate) else 0):
+            sel = mate == m
+            med, has = _medians(counts[sel], index[sel], n, self.target)
+            below |= has & (med < self.target)
+            any_kmers |= has
+        return below | ~any_kmers
+
+
+def normalize(paths, outs, normalizer, ncpu=1):
+    """ Normalize reads (or pairs)
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        outs (list): Output file for each input. Files named ".gz" are
+            compressed.
+        normalizer (Normalizer): Normalizer, which may be shared by several
+            calls so that reads of all calls count towards coverage
+        ncpu (int): Number of CPUs for compression
+
+    Returns:
+        (nreads, nkept) (tuple): Number of reads (or pairs) read and kept
+
+    """
+    nreads = nkept = 0
+    ouths = [gzutils.open_writer(o, ncpu, readsampler.COMPRESS_LEVEL)
+             for o in outs]
+    try:
+        for batches in readsampler.lockstep_batches(paths):
+            keep = normalizer.select(batches)
+            for b, outh in zip(batches, ouths):
+                outh.write(b.raw_selected(keep))
+            nreads += len(keep)
+            nkept += int(keep.sum())
+    finally:
+        for outh in ouths:
+            outh.close()
+    return nreads, nkept
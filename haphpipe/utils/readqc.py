@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""Read quality statistics collected in a single pass
+
+A ReadQC object is fed batches of records (fastq.FastqBatch) by code that is
+already reading them, such as the read sampler or the FASTQ relay used for
+streaming, so statistics are collected without another pass over the data.
+All statistics are computed with array operations on whole batches:
+
+  * Quality: histogram of quality scores at each cycle (position in read),
+    from which per-cycle quantiles, mean quality and Q30 fraction are
+    reported.
+  * Length: histogram of read lengths.
+  * GC content: total GC fraction and histogram of per-read GC percent.
+  * Duplication: reads are sampled by a hash of their sequence, keeping at
+    most MAX_DISTINCT distinct sequences. Since identical sequences are
+    either all sampled or not sampled, the fraction of duplicates in the
+    sample estimates the fraction in all reads.
+
+Statistics for each read file are written to a small JSON sidecar that is
+read by summary_stats.
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+
+import numpy as np
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Version of the sidecar format """
+FORMAT_VERSION = 1
+
+""" Quality characters counted ("!" to "~"). Characters outside the range
+    are counted as the nearest one.
+"""
+QUAL_MIN = 33
+NQUAL = 94
+
+""" Quantiles of quality reported for each cycle (percent) """
+QUANTILES = [10, 25, 50, 75, 90]
+
+""" Maximum number of distinct sequences kept to estimate duplication """
+MAX_DISTINCT = 100000
+
+""" Sidecar file names """
+TRIMMED_QC = 'trimmed.qc.json'
+SAMPLE_QC = 'sample.qc.json'
+
+
+class ReadQC(object):
+    """ Statistics for one read file
+
+    Args:
+        offset (int): Quality encoding offset (33 for Phred+33, 64 for
+            Phred+64)
+    """
+    def __init__(self, offset=33):
+        self.offset = offset
+        self.nreads = 0
+        self.nbases = 0
+        self.ngc = 0
+        self.cycle_qual = np.zeros((0, NQUAL), dtype=np.int64)
+        self.length_hist = np.zeros(0, dtype=np.int64)
+        self.gc_hist = np.zeros(101, dtype=np.int64)
+        self.dup_limit = np.uint64(0xFFFFFFFFFFFFFFFF)
+        self.dup_hashes = np.zeros(0, dtype=np.uint64)
+        self.dup_counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, batch):
+        """ Add records of batch (fastq.FastqBatch) """
+        n = len(batch)
+        if n == 0:
+            return
+        lens = batch.lengths
+        self.nreads += n
+        self.nbases += len(batch.seq)
+
+        # Quality by cycle
+        maxlen = int(lens.max())
+        if maxlen > self.cycle_qual.shape[0]:
+            grown = np.zeros((maxlen, NQUAL), dtype=np.int64)
+            grown[:self.cycle_qual.shape[0]] = self.cycle_qual
+            self.cycle_qual = grown
+        q = np.clip(batch.qual.astype(np.int64) - QUAL_MIN, 0, NQUAL - 1)
+        key = batch.cycles() * NQUAL + q
+        self.cycle_qual[:maxlen] += np.bincount(
+            key, minlength=maxlen * NQUAL
+        ).reshape(maxlen, NQUAL)
+
+        # Length
+        lh = np.bincount(lens)
+        if len(lh) > len(self.length_hist):
+            lh[:len(self.length_hist)] += self.length_hist
+            self.length_hist = lh
+        else:
+            self.length_hist[:len(lh)] += lh
+
+        # GC content
+        seq = batch.seq
+        isgc = (seq == ord('G')) | (seq == ord('C')) | \
+               (seq == ord('g')) | (seq == ord('c'))
+        cs = np.zeros(len(seq) + 1, dtype=np.int64)
+        np.cumsum(isgc, out=cs[1:])
+        gc = cs[batch.offsets[1:]] - cs[batch.offsets[:-1]]
+        self.ngc += int(cs[-1])
+        nonempty = lens > 0
+        pct = np.rint(100 * gc[nonempty] / lens[nonempty]).astype(np.int64)
+        self.gc_hist += np.bincount(pct, minlength=101)
+
+        # Duplication
+        h = batch.seq_hash()
+        self._add_hashes(h[h <= self.dup_limit])
+
+    def _add_hashes(self, h):
+        allh = np.concatenate([self.dup_hashes, h])
+        alln = np.concatenate([self.dup_counts, np.ones(len(h), dtype=np.int64)])
+        u, inv = np.unique(allh, return_inverse=True)
+        counts = np.bincount(inv.ravel(), weights=alln).astype(np.int64)
+        # Halve the sampled part of the hash space until the sample fits
+        while len(u) > MAX_DISTINCT:
+            self.dup_limit = self.dup_limit >> np.uint64(1)
+            keep = u <= self.dup_limit
+            u, counts = u[keep], counts[keep]
+        self.dup_hashes, self.dup_counts = u, counts
+
+    def quality_quantiles(self):
+        """ Quantiles of quality score at each cycle
+
+        Returns:
+            quantiles (dict): Quantile (percent, as string) to list of
+                quality scores, one for each cycle
+
+        """
+        cum = np.cumsum(self.cycle_qual, axis=1)
+        total = cum[:, -1:] if len(cum) else np.zeros((0, 1))
+        ret = {}
+        for p in QUANTILES:
+            idx = np.argmax(cum >= np.ceil(total * p / 100.0), axis=1)
+            ret[str(p)] = (idx + QUAL_MIN - self.offset).tolist()
+        return ret
+
+    def summary(self):
+        """ Statistics as a dictionary, as written to the sidecar """
+        scores = np.arange(NQUAL) + QUAL_MIN - self.offset
+        qhist = self.cycle_qual.sum(axis=0)
+        nqual = int(qhist.sum())
+        lengths = np.flatnonzero(self.length_hist)
+        sampled = int(self.dup_counts.sum())
+        return {
+            'reads': self.nreads,
+            'bases': self.nbases,
+            'length': {
+                'min': int(lengths[0]) if len(lengths) else 0,
+                'max': int(lengths[-1]) if len(lengths) else 0,
+                'mean': self.nbases / self.nreads if self.nreads else 0.0,
+                'histogram': [[int(l), int(self.length_hist[l])]
+                              for l in lengths],
+            },
+            'gc': {
+                'fraction': self.ngc / self.nbases if self.nbases else 0.0,
+                'histogram': self.gc_hist.tolist(),
+            },
+            'quality': {
+                'offset': self.offset,
+                'mean': float((qhist * scores).sum()) / nqual if nqual else 0.0,
+                'q30_fraction': float(qhist[scores >= 30].sum()) / nqual
+                                if nqual else 0.0,
+                'cycle_quantiles': self.quality_quantiles(),
+            },
+            'duplication': {
+                'sampled_reads': sampled,
+                'distinct': len(self.dup_hashes),
+                'fraction': 1 - len(self.dup_hashes) / sampled
+                            if sampled else 0.0,
+            },
+        }
+
+
+def encoding_offset(encoding):
+    """ Quality offset for encoding name ("Phred+33" or "Phred+64") """
+    return 64 if encoding == 'Phred+64' else 33
+
+
+def write_sidecar(path, qcs):
+    """ Write statistics for several read files
+
+    Args:
+        path (str): Output path
+        qcs (dict): Read file label ("1", "2" or "U") to ReadQC
+
+    Returns:
+        None
+
+    """
+    out = {
+        'version': FORMAT_VERSION,
+        'reads': {k: qc.summary() for k, qc in qcs.items()},
+    }
+    with open(path, 'w') as outh:
+        json.dump(out, outh, sort_keys=True, separators=(',', ':'))
+        outh.write('\n')
+
+
+def read_sidecar(path):
+    """ Read statistics written by write_sidecar()
+
+    Returns:
+        reads (dict): Read file label to statistics
+
+    """
+    with open(path, 'r') as fh:
+        return json.load(fh)['reads']
+
+
+def overview(reads):
+    """ Combine statistics of the read files of one sample
+
+    Args:
+        reads (dict): Read file label to statistics, as returned by
+            read_sidecar()
+
+    Returns:
+        overview (dict): Number of reads, mean length, GC fraction, mean
+            quality, Q30 fraction and duplicate fraction over all files
+
+    """
+    nreads = sum(r['reads'] for r in reads.values())
+    nbases = sum(r['bases'] for r in reads.values())
+    sampled = sum(r['duplication']['sampled_reads'] for r in reads.values())
+    distinct = sum(r['duplication']['distinct'] for r in reads.values())
+
+    def by_bases(f):
+        if not nbases:
+            return 0.0
+        return sum(f(r) * r['bases'] for r in reads.values()) / nbases
+
+    return {
+        'reads': nreads,
+        'mean_length': nbases / nreads if nreads else 0.0,
+        'gc_fraction': by_bases(lambda r: r['gc']['fraction']),
+        'mean_quality': by_bases(lambda r: r['quality']['mean']),
+        'q30_fraction': by_bases(lambda r: r['quality']['q30_fraction']),
+        'dup_fraction': 1 - distinct / sampled if sampled else 0.0,
+    }
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Subsample FASTQ files in a single pass
+
+Two modes are available:
+
+  * Fraction: a read is kept if the hash of its name (with the seed) falls
+    below the fraction. The decision depends only on the read name, so it
+    is the same for both mates and for repeated runs with the same seed.
+  * Number of reads: reservoir sampling of exactly n reads (or all reads if
+    the file has fewer). Mate files are read in lockstep, so the same pairs
+    are sampled from both.
+
+Output is written gzip-compressed, by the compressor chosen in gzutils.
+
+estimate_reads() estimates the number of reads in a file and their mean
+length without reading the whole file, to choose how many reads to sample.
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import zlib
+
+import numpy as np
+
+from haphpipe.utils import fastq
+from haphpipe.utils import gzutils
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" gzip level for sampled reads. Sampled reads are usually intermediate
+    files that are read once, so speed matters more than size.
+"""
+COMPRESS_LEVEL = 1
+
+""" Bytes of FASTQ read to estimate the number of reads. Plain files are
+    read in SAMPLE_CHUNKS chunks spread over the file; gzipped files are
+    read from the start, since they cannot be read from an offset.
+"""
+SAMPLE_BYTES = 4 << 20
+SAMPLE_CHUNKS = 16
+
+
+class MateMismatchError(Exception):
+    pass
+
+
+def lockstep_batches(paths):
+    """ Iterate over batches of several FASTQ files in lockstep
+
+    Yields:
+        batches (list): One FastqBatch per file, with the same records
+            numbers
+
+    """
+    return lockstep([fastq.read_batches(p) for p in paths], paths)
+
+
+def lockstep(iters, paths):
+    """ Iterate over several iterators of batches in lockstep
+
+    Args:
+        iters (list): Iterators of FastqBatch
+        paths (list): Names of the files, for error messages
+
+    Yields:
+        batches (list): One FastqBatch per iterator, with the same records
+            numbers
+
+    """
+    pending = [None] * len(paths)
+    while True:
+        for i, it in enumerate(iters):
+            if pending[i] is None or len(pending[i]) == 0:
+                pending[i] = next(it, None)
+        if all(b is None for b in pending):
+            return
+        if any(b is None for b in pending):
+            raise MateMismatchError(
+                'Mate files have different numbers of reads: %s' %
+                ', '.join(paths)
+            )
+        n = min(len(b) for b in pending)
+        yield [b.slice(0, n) for b in pending]
+        pending = [b.slice(n, len(b)) for b in pending]
+
+
+class Reservoir(object):
+    """ Reservoir of k record numbers (Algorithm R, vectorized by batch)
+    """
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.seen = 0
+
+    def offer(self, n):
+        """ Offer the next n records
+
+        Returns:
+            slots (numpy.ndarray): Reservoir slot for each accepted record
+            idx (numpy.ndarray): Index within the batch of each accepted
+                record. When two records of the batch replace the same slot,
+                only the later one is returned.
+
+        """
+        recno = np.arange(self.seen, self.seen + n, dtype=np.int64)
+        self.seen += n
+        fill = recno < self.k
+        j = np.floor(self.rng.random_sample(n) * (recno + 1)).astype(np.int64)
+        slots = np.where(fill, recno, j)
+        idx = np.flatnonzero(slots < self.k)
+        slots = slots[idx]
+        # Later records replace earlier ones in the same slot
+        _, last = np.unique(slots[::-1], return_index=True)
+        keep = np.sort(len(slots) - 1 - last)
+        return slots[keep], idx[keep]
+
+
+def _open_outputs(outs):
+    return [gzutils.GzipWriter(o, level=COMPRESS_LEVEL) for o in outs]
+
+
+def _add_qc(batches, qcs):
+    for b, qc in zip(batches, qcs or []):
+        qc.add(b)
+
+
+def sample_frac(paths, outs, frac, seed=0, qcs=None):
+    """ Keep reads whose name hash falls below frac
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        outs (list): Output file for each input
+        frac (float): Fraction of reads to keep
+        seed (int): Seed for hash
+        qcs (list): readqc.ReadQC for each input, updated with all reads
+            read (not only the sampled reads)
+
+    Returns:
+        (nseen, nkept) (tuple): Number of reads (or pairs) read and kept
+
+    """
+    limit = int(frac * (1 << 53))
+    nseen = nkept = 0
+    ouths = _open_outputs(outs)
+    try:
+        for batches in lockstep_batches(paths):
+            _add_qc(batches, qcs)
+            h = batches[0].name_hash(seed) >> np.uint64(11)
+            mask = h < np.uint64(limit)
+            for b, outh in zip(batches, ouths):
+                outh.write(b.raw_selected(mask))
+            nseen += len(mask)
+            nkept += int(mask.sum())
+    finally:
+        for outh in ouths:
+            outh.close()
+    return nseen, nkept
+
+
+def sample_nreads(paths, outs, nreads, seed=0, qcs=None):
+    """ Reservoir sample of nreads reads
+
+    Sampled reads are written in the order they appear in the input.
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        outs (list): Output file for each input
+        nreads (int): Number of reads (or pairs) to keep
+        seed (int): Seed for random number generator
+        qcs (list): readqc.ReadQC for each input, updated with all reads
+            read (not only the sampled reads)
+
+    Returns:
+        (nseen, nkept) (tuple): Number of reads (or pairs) read and kept
+
+    """
+    res = Reservoir(nreads, np.random.RandomState(seed))
+    store = {}
+    for batches in lockstep_batches(paths):
+        _add_qc(batches, qcs)
+        first = res.seen
+        slots, idx = res.offer(len(batches[0]))
+        recs = list(zip(*[b.raw_list(idx) for b in batches]))
+        for s, i, r in zip(slots.tolist(), idx.tolist(), recs):
+            store[s] = (first + i, r)
+
+    kept = [store[s][1] for s in sorted(store, key=lambda s: store[s][0])]
+    ouths = _open_outputs(outs)
+    try:
+        for i, outh in enumerate(ouths):
+            for start in range(0, len(kept), 10000):
+                outh.write(b''.join(r[i] for r in kept[start:start + 10000]))
+    finally:
+        for outh in ouths:
+            outh.close()
+    return res.seen, len(kept)
+
+
+def _sample_records(data, at_record):
+    """ Complete records in a chunk of FASTQ
+
+    Args:
+        data (bytes): Chunk of FASTQ
+        at_record (bool): Chunk starts at a record. Otherwise the chunk is
+            read from the first line starting with "@" that is followed by
+            a "+" line two lines later.
+
+    Returns:
+        (nrecs, nbytes, nbases) (tuple): Number of records, their total size
+            and total length
+
+    """
+    lines = data.split(b'\n')[:-1]  # last line may be incomplete
+    i = 0
+    if not at_record:
+        while i + 2 < len(lines) and not (lines[i].startswith(b'@') and
+                                          lines[i + 2].startswith(b'+')):
+            i += 1
+    nrecs = nbytes = nbases = 0
+    while i + 4 <= len(lines):
+        nrecs += 1
+        nbytes += sum(len(l) for l in lines[i:i + 4]) + 4
+        nbases += len(lines[i + 1].rstrip(b'\r'))
+        i += 4
+    return nrecs, nbytes, nbases
+
+
+def _gunzip_head(fh, nbytes):
+    """ Decompress about nbytes from the start of a gzip file
+
+    Returns:
+        data (bytes): Decompressed data
+        consumed (int): Compressed bytes that were decompressed
+
+    """
+    out = []
+    nout = consumed = 0
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while nout < nbytes:
+        buf = fh.read(1 << 16)
+        if not buf:
+            break
+        while buf:
+            chunk = d.decompress(buf)
+            out.append(chunk)
+            nout += len(chunk)
+            if d.eof:
+                # Next member of a multi-member file (e.g. BGZF)
+                consumed += len(buf) - len(d.unused_data)
+                buf = d.unused_data
+                d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                consumed += len(buf)
+                buf = b''
+    return b''.join(out), consumed
+
+
+def estimate_reads(path, sample_bytes=SAMPLE_BYTES):
+    """ Estimate number of reads and mean read length of FASTQ file
+
+    The size of the records in a sample of the file is extrapolated to the
+    size of the file. For gzipped files, the compression ratio of the sample
+    is used. Counts are exact for files smaller than the sample.
+
+    Args:
+        path (str): Path to FASTQ file, optionally gzipped
+        sample_bytes (int): Bytes to sample
+
+    Returns:
+        nreads (int): Estimated number of reads
+        mean_length (float): Mean read length in the sample
+
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fh:
+        if gzutils.is_gzip(path):
+            data, consumed = _gunzip_head(fh, sample_bytes)
+            whole = consumed >= size
+            total = len(data) if whole else size * len(data) / max(consumed, 1)
+            samples = [_sample_records(data + (b'\n' if whole else b''), True)]
+        elif size <= sample_bytes:
+            total = size
+            samples = [_sample_records(fh.read() + b'\n', True)]
+        else:
+            total = size
+            chunk = sample_bytes // SAMPLE_CHUNKS
+            samples = []
+            for k in range(SAMPLE_CHUNKS):
+                fh.seek((size - chunk) * k // (SAMPLE_CHUNKS - 1))
+                samples.append(_sample_records(fh.read(chunk), k == 0))
+    nrecs, nbytes, nbases = [sum(x) for x in zip(*samples)]
+    if nrecs == 0:
+        return 0, 0.0
+    return int(round(total * nrecs / nbytes)), nbases / nrecs
+
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of reference indexes
+
+Indexes of a reference FASTA (FASTA index, sequence dictionary, bowtie2
+and bwa indexes) are built once and shared by all stages and
+processes using the same reference. Entries are stored in
+"cachedir/<digest>", keyed on the SHA-256 digest of the FASTA contents, so
+copies of a reference under different paths share an entry and a changed
+reference gets a new one. Each entry holds a copy of the FASTA as
+"ref.fasta" and the indexes built for it so far:
+
+    ref.fasta.fai        faidx
+    ref.dict             dict
+    ref.*.bt2            bowtie2 (prefix "ref")
+    ref.fasta.{bwt,...}  bwa (prefix "ref.fasta")
+
+A process using an entry creates an in-use file in it (under a shared lock
+of the entry) and removes it when the index is released. Each kind of index
+is built under its own exclusive lock, so concurrent stages build each index
+once and do not wait for stages using other indexes. When the total size of
+the cache exceeds its maximum size, the least recently used entries that
+are not in use are removed (under an exclusive lock of the entry).
+
+The cache directory is set by HAPHPIPE_REF_CACHE (by default
+"$XDG_CACHE_HOME/haphpipe/refindex"), and the maximum size by
+HAPHPIPE_REF_CACHE_SIZE (e.g. "5G").
+
+    idx = refindex.get_index(ref_fa, ['faidx', 'dict', 'bowtie2'], tempdir)
+    cmd = ['bowtie2', '-x', idx.path('bowtie2'), ...]
+    ...
+    idx.release()
+"""
+from __future__ import print_function
+import os
+import errno
+import fcntl
+import shutil
+import socket
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import fastaindex
+from haphpipe.utils.sysutils import PipelineStepError
+from haphpipe.utils.stagecache import parse_size, file_digest
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Default maximum size of the cache, in bytes """
+MAX_SIZE = 10 << 30
+
+""" Path passed to tools for each kind of index, relative to the entry """
+INDEX_PATHS = {
+    'faidx': 'ref.fasta',
+    'dict': 'ref.dict',
+    'bowtie2': 'ref',
+    'bwa': 'ref.fasta',
+}
+
+""" Indexes written by fastaindex instead of samtools and picard """
+NATIVE_KINDS = ['faidx', 'dict', ]
+
+FASTA = 'ref.fasta'
+LOCK = 'lock'
+INUSE = 'inuse'
+
+
+def build_commands(edir, kind):
+    """ Command that builds an index of kind in entry directory edir
+
+    Indexes in NATIVE_KINDS are not built by commands (see build_native).
+    """
+    fa = os.path.join(edir, FASTA)
+    if kind == 'bowtie2':
+        return ['bowtie2-build', fa, os.path.join(edir, INDEX_PATHS['bowtie2'])]
+    if kind == 'bwa':
+        return ['bwa', 'index', fa, ]
+    raise ValueError('Unknown index: %s' % kind)
+
+
+def build_native(edir, kinds):
+    """ Write indexes in NATIVE_KINDS in entry directory edir """
+    fa = os.path.join(edir, FASTA)
+    try:
+        fastaindex.write_indexes(
+            fa,
+            fai='%s.fai' % fa if 'faidx' in kinds else None,
+            seq_dict=os.path.join(edir, INDEX_PATHS['dict'])
+                     if 'dict' in kinds else None,
+        )
+    except fastaindex.FastaIndexError as e:
+        raise PipelineStepError(str(e))
+
+
+def _done(edir, kind):
+    """ Marker written when an index is complete """
+    return os.path.join(edir, '%s.done' % kind)
+
+
+def _makedirs(d):
+    try:
+        os.makedirs(d)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class RefIndex(object):
+    """ Indexes of a reference in a cache entry
+
+    The entry is not evicted until release() is called (or the process
+    exits).
+
+    Attributes:
+        edir (str): Entry directory
+        fasta (str): Path to the copy of the reference in the entry
+    """
+    def __init__(self, edir, inuse=None):
+        self.edir = edir
+        self.fasta = os.path.join(edir, FASTA)
+        self._inuse = inuse
+
+    def path(self, kind):
+        """ Path (or prefix) of index kind, as given to tools """
+        return os.path.join(self.edir, INDEX_PATHS[kind])
+
+    def release(self):
+        if self._inuse is not None:
+            try:
+                os.unlink(self._inuse)
+            except OSError:
+                pass
+            self._inuse = None
+
+
+def _inuse_name():
+    """ Name of in-use file of this process """
+    _inuse_name.count += 1
+    return '%s.%s.%d.%d' % (INUSE, socket.gethostname(), os.getpid(),
+                            _inuse_name.count)
+_inuse_name.count = 0
+
+
+def _in_use(edir):
+    """ Whether any running process uses entry edir
+
+    In-use files of processes on this host that are no longer running are
+    removed. Processes on other hosts are assumed to be running.
+    """
+    host = socket.gethostname()
+    ret = False
+    for f in os.listdir(edir):
+        if not f.startswith(INUSE + '.'):
+            continue
+        fhost, pid = f[len(INUSE) + 1:].rsplit('.', 2)[:2]
+        if fhost == host and not _alive(int(pid)):
+            try:
+                os.unlink(os.path.join(edir, f))
+            except OSError:
+                pass
+            continue
+        ret = True
+    return ret
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class RefIndexCache(object):
+    """ Cache of reference indexes keyed on reference contents
+
+    Args:
+        cachedir (str): Path to cache directory
+        max_size (int): Maximum size of cache in bytes. No limit if None.
+    """
+    def __init__(self, cachedir, max_size=MAX_SIZE):
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_size = max_size
+        _makedirs(self.cachedir)
+
+    def entry_dir(self, digest):
+        return os.path.join(self.cachedir, digest)
+
+    def _lock(self, edir, mode):
+        """ Open and lock the lock file of an entry
+
+        Returns:
+            lockfh (file): Locked file, or None if the entry was removed
+                while waiting for the lock
+
+        """
+        _makedirs(edir)
+        lockfh = open(os.path.join(edir, LOCK), 'a')
+        fcntl.flock(lockfh, mode)
+        # The entry may have been evicted before the lock was acquired
+        try:
+            same = os.fstat(lockfh.fileno()).st_ino == \
+                   os.stat(os.path.join(edir, LOCK)).st_ino
+        except OSError:
+            same = False
+        if not same:
+            lockfh.close()
+            return None
+        return lockfh
+
+    def _register(self, edir):
+        """ Mark entry as in use by this process
+
+        The in-use file is created under the shared lock of the entry, so it
+        cannot be created while the entry is being evicted.
+
+        Returns:
+            inuse (str): Path to in-use file
+
+        """
+        while True:
+            lockfh = self._lock(edir, fcntl.LOCK_SH)
+            if lockfh is not None:
+                break
+        try:
+            inuse = os.path.join(edir, _inuse_name())
+            open(inuse, 'w').close()
+            # Time of last use is the mtime of the lock file
+            os.utime(os.path.join(edir, LOCK), None)
+        finally:
+            lockfh.close()
+        return inuse
+
+    def get(self, ref_fa, kinds, stage, ncpu=1, quiet=False, logfile=None):
+        """ Look up indexes of a reference, building any that are missing
+
+        Args:
+            ref_fa (str): Path to reference FASTA
+            kinds (list): Kinds of index needed ("faidx", "dict", "bowtie2",
+                "bwa")
+            stage (str): Stage name for log messages
+            ncpu (int): Number of indexes to build at the same time
+            quiet (bool): Do not write output to console
+            logfile (file): Append console output to this file
+
+        Returns:
+            index (RefIndex): Indexes, held until released
+
+        """
+        digest = file_digest(ref_fa)
+        edir = self.entry_dir(digest)
+        index = RefIndex(edir, self._register(edir))
+        try:
+            missing = [k for k in kinds if not os.path.exists(_done(edir, k))]
+            if missing:
+                self._build(ref_fa, edir, missing, stage, ncpu, quiet,
+                            logfile)
+                self.evict(keep=edir)
+            else:
+                msg = '[--- %s ---] Using cached index %s\n' % (
+                    stage, digest[:12])
+                sysutils.log_message(msg, quiet, logfile)
+        except BaseException:
+            index.release()
+            raise
+        return index
+
+    def _build(self, ref_fa, edir, kinds, stage, ncpu, quiet, logfile):
+        """ Build missing indexes
+
+        Each kind of index is built under its own exclusive lock, so
+        processes needing different indexes do not wait for each other.
+        """
+        fa = os.path.join(edir, FASTA)
+        if not os.path.exists(fa):
+            tmp = '%s.%s.%d' % (fa, socket.gethostname(), os.getpid())
+            shutil.copyfile(ref_fa, tmp)
+            os.rename(tmp, fa)
+        # Locks are taken in the same order by all processes
+        locks = []
+        try:
+            for k in sorted(kinds):
+                lockfh = open(os.path.join(edir, '%s.%s' % (LOCK, k)), 'a')
+                locks.append(lockfh)
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+            missing = [k for k in kinds if not os.path.exists(_done(edir, k))]
+            native = [k for k in missing if k in NATIVE_KINDS]
+            if native:
+                msg = '[--- %s ---] Writing %s for %s\n' % (
+                    stage, ', '.join(native), fa)
+                sysutils.log_message(msg, quiet, logfile)
+                build_native(edir, native)
+            # Indexes are independent of each other
+            cmds = [build_commands(edir, k) for k in missing
+                    if k not in NATIVE_KINDS]
+            if cmds:
+                sysutils.command_runner(
+                    [sysutils.ConcurrentCommands(cmds, ncpu), ], stage,
+                    quiet, logfile
+                )
+            for k in missing:
+                open(_done(edir, k), 'w').close()
+        finally:
+            for lockfh in locks:
+                lockfh.close()
+
+    def entries(self):
+        """ List of (last_used, size, entry directory) for all entries """
+        ret = []
+        for digest in os.listdir(self.cachedir):
+            edir = self.entry_dir(digest)
+            try:
+                last_used = os.path.getmtime(os.path.join(edir, LOCK))
+                size = sum(os.path.getsize(os.path.join(edir, f))
+                           for f in os.listdir(edir))
+            except OSError:
+                continue
+            ret.append((last_used, size, edir))
+        return ret
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until cache fits max_size
+
+        Entries in use by any process and keep are not removed.
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for _, size, edir in entries:
+            if total <= self.max_size:
+                break
+            if edir == keep:
+                continue
+            try:
+                lockfh = open(os.path.join(edir, LOCK), 'a')
+            except (IOError, OSError):
+                continue
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Entry is being looked up
+                lockfh.close()
+                continue
+            try:
+                if _in_use(edir):
+                    continue
+                shutil.rmtree(edir, ignore_errors=True)
+            finally:
+                lockfh.close()
+            total -= size
+
+
+def cache_from_env():
+    """ RefIndexCache configured by environment variables
+
+    HAPHPIPE_REF_CACHE sets the cache directory, and HAPHPIPE_REF_CACHE_SIZE
+    the maximum size (e.g. "5G", or "0" for no limit).
+
+    """
+    cachedir = os.environ.get('HAPHPIPE_REF_CACHE')
+    if not cachedir:
+        root = os.environ.get('XDG_CACHE_HOME') or \
+               os.path.join(os.path.expanduser('~'), '.cache')
+        cachedir = os.path.join(root, 'haphpipe', 'refindex')
+    max_size = os.environ.get('HAPHPIPE_REF_CACHE_SIZE')
+    if max_size:
+        max_size = parse_size(max_size) or None
+    else:
+        max_size = MAX_SIZE
+    return RefIndexCache(cachedir, max_size)
+
+
+def get_index(ref_fa, kinds, tempdir, stage='refindex', ncpu=1,
+              quiet=False, logfile=None, debug=False):
+    """ Indexes of a reference from the cache, building any that are missing
+
+    If the cache directory cannot be created, the indexes are built in
+    tempdir instead.
+
+    Args:
+        ref_fa (str): Path to reference FASTA
+        kinds (list): Kinds of index needed ("faidx", "dict", "bowtie2",
+            "bwa")
+        tempdir (str): Temporary directory of the stage
+        stage (str): Stage name for log messages
+        ncpu (int): Number of indexes to build at the same time
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+        debug (bool): Print commands but do not run
+
+    Returns:
+        index (RefIndex): Indexes. Call release() when done with them.
+
+    """
+    if debug:
+        edir = os.path.join(tempdir, 'refindex', 'DIGEST')
+        cmds = [['cp', ref_fa, os.path.join(edir, FASTA)], ]
+        native = [k for k in kinds if k in NATIVE_KINDS]
+        other = [build_commands(edir, k) for k in kinds
+                 if k not in NATIVE_KINDS]
+        if other:
+            cmds.append(sysutils.ConcurrentCommands(other, ncpu))
+        sysutils.command_runner(cmds, stage, quiet, logfile, debug)
+        if native:
+            msg = '[--- %s ---] Writing %s for %s\n' % (
+                stage, ', '.join(native), os.path.join(edir, FASTA))
+            sysutils.log_message(msg, quiet, logfile)
+        return RefIndex(edir)
+    try:
+        cache = cache_from_env()
+    except (IOError, OSError) as e:
+        msg = '[--- %s ---] Reference index cache unavailable (%s), ' \
+              'indexing in %s\n' % (stage, e, tempdir)
+        sysutils.log_message(msg, quiet, logfile)
+        cache = RefIndexCache(os.path.join(tempdir, 'refindex'), None)
+    return cache.get(ref_fa, kinds, stage, ncpu, quiet, logfile)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Parsed reference sequences and annotations, kept for reuse
+
+Within a single stage call this is a plain loader. In the worker processes
+of "haphpipe serve" the parsed objects are kept between jobs, so that a
+reference or GTF is only parsed again when the file changes.
+"""
+from __future__ import print_function
+import os
+from collections import OrderedDict
+
+from haphpipe.utils import gtfparse
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Number of parsed files kept. The least recently used is dropped first. """
+MAX_ENTRIES = 32
+
+GTF_EXTENSIONS = ('.gtf', '.gff', '.gff3', )
+
+_store = OrderedDict()
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def cached(kind, path, loader):
+    """ Return loader(path), reusing the result while the file is unchanged
+
+    Args:
+        kind (str): Kind of object ("fasta", "gtf")
+        path (str): Path to file
+        loader (function): Function that parses path
+
+    Returns:
+        obj: Parsed object. Callers must not modify it.
+
+    """
+    k = (kind, os.path.realpath(path))
+    fkey = _file_key(path)
+    if k in _store and _store[k][0] == fkey:
+        _store[k] = _store.pop(k)
+        return _store[k][1]
+    obj = loader(path)
+    _store.pop(k, None)
+    _store[k] = (fkey, obj)
+    while len(_store) > MAX_ENTRIES:
+        _store.popitem(last=False)
+    return obj
+
+
+def _parse_fasta(path):
+    from Bio import SeqIO
+    return OrderedDict((s.id, s) for s in SeqIO.parse(path, 'fasta'))
+
+
+def _parse_gtf(path):
+    return list(gtfparse.gtf_parser(path))
+
+
+def load_fasta(path):
+    """ Sequences in FASTA file as an OrderedDict of id to SeqRecord """
+    return cached('fasta', path, _parse_fasta)
+
+
+def load_gtf(path):
+    """ Rows in GTF file as a list of GTFRow """
+    return cached('gtf', path, _parse_gtf)
+
+
+def preload(paths):
+    """ Parse files so later calls to load_fasta() or load_gtf() are fast
+
+    Files ending with a GTF_EXTENSIONS suffix are loaded as GTF, all other
+    files as FASTA.
+    """
+    for p in paths:
+        if p.lower().endswith(GTF_EXTENSIONS):
+            load_gtf(p)
+        else:
+            load_fasta(p)
+
+
+def loaded():
+    """ List of (kind, path) currently kept """
+    return list(_store.keys())
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""Memory and CPU limits of the current process
+"""
+from __future__ import print_function
+import os
+import re
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+GB = 1 << 30
+
+""" Largest heap given to a JVM. Above 32 GB the JVM can no longer use
+    compressed object pointers.
+"""
+MAX_HEAP_GB = 32
+MIN_HEAP_GB = 1
+
+""" Fraction of the memory limit that may be used by JVM heaps. The rest is
+    left for JVM overhead and the other tools in the pipeline.
+"""
+HEAP_FRACTION = 0.75
+
+""" Heap requested for a JVM stage: HEAP_BASE plus HEAP_PER_INPUT times
+    the total size of the inputs (reference, BAM, reads).
+"""
+HEAP_BASE = 2 * GB
+HEAP_PER_INPUT = 2
+
+""" Fraction of the memory limit that may be used by samtools sort, which
+    runs alongside the aligner feeding it. Memory per sort thread is kept
+    between SORT_MIN_MEM and SORT_MAX_MEM (samtools default is 768M).
+"""
+SORT_FRACTION = 0.25
+SORT_MIN_MEM = 256 << 20
+SORT_MAX_MEM = 2 * GB
+
+""" cgroup v1 reports "no limit" as a very large number """
+_UNLIMITED = 1 << 60
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as fh:
+            return fh.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_paths():
+    """ Map of controller to cgroup path, from /proc/self/cgroup
+
+    The cgroup v2 path is stored with the key "".
+    """
+    ret = {}
+    txt = _read('/proc/self/cgroup')
+    if txt is None:
+        return ret
+    for l in txt.splitlines():
+        parts = l.split(':', 2)
+        if len(parts) != 3:
+            continue
+        for ctrl in parts[1].split(','):
+            ret[ctrl] = parts[2]
+    return ret
+
+
+def _walk_up(base, path):
+    """ Directories from the cgroup of this process up to the root """
+    path = path.rstrip('/')
+    while True:
+        yield os.path.join(base, path.lstrip('/'))
+        if not path:
+            break
+        path = os.path.dirname(path)
+        if path == '/':
+            path = ''
+
+
+def cgroup_memory_limit():
+    """ Memory limit (bytes) of the cgroup of this process
+
+    Checks cgroup v2 (memory.max) and v1 (memory.limit_in_bytes). The
+    smallest limit of the cgroup and its parents is returned.
+
+    Returns:
+        limit (int): Limit in bytes, or None if there is no limit
+
+    """
+    paths = _cgroup_paths()
+    limits = []
+    if '' in paths:
+        base = CGROUP_ROOT
+        if os.path.isdir(os.path.join(CGROUP_ROOT, 'unified')):
+            base = os.path.join(CGROUP_ROOT, 'unified')
+        for d in _walk_up(base, paths['']):
+            v = _read(os.path.join(d, 'memory.max'))
+            if v and v != 'max':
+                limits.append(int(v))
+    if 'memory' in paths:
+        for d in _walk_up(os.path.join(CGROUP_ROOT, 'memory'), paths['memory']):
+            v = _read(os.path.join(d, 'memory.limit_in_bytes'))
+            if v and int(v) < _UNLIMITED:
+                limits.append(int(v))
+    return min(limits) if limits else None
+
+
+def cgroup_cpu_limit():
+    """ CPU quota of the cgroup of this process, in CPUs
+
+    Returns:
+        ncpu (float): CPU quota, or None if there is no quota
+
+    """
+    paths = _cgroup_paths()
+    if '' in paths:
+        v = _read(os.path.join(CGROUP_ROOT, paths[''].lstrip('/'), 'cpu.max'))
+        if v:
+            quota, _, period = v.partition(' ')
+            if quota != 'max' and period:
+                return float(quota) / float(period)
+    for ctrl in ['cpu', 'cpuacct']:
+        if ctrl in paths:
+            d = os.path.join(CGROUP_ROOT, 'cpu,cpuacct', paths[ctrl].lstrip('/'))
+            if not os.path.isdir(d):
+                d = os.path.join(CGROUP_ROOT, 'cpu', paths[ctrl].lstrip('/'))
+            quota = _read(os.path.join(d, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(d, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0:
+                return float(quota) / float(period)
+    return None
+
+
+def physical_memory():
+    """ Total physical memory in bytes """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def memory_limit():
+    """ Memory available to this process: physical memory or cgroup limit """
+    limits = [m for m in [physical_memory(), cgroup_memory_limit()] if m]
+    return min(limits) if limits else None
+
+
+def available_cpus(ncpu=None):
+    """ Number of CPUs this process may use
+
+    Takes into account CPU affinity and the cgroup CPU quota.
+
+    Args:
+        ncpu (int): Requested number of CPUs. If given, the result is no
+            larger than ncpu.
+
+    Returns:
+        ncpu (int): Number of CPUs
+
+    """
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        n = multiprocessing.cpu_count()
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        n = min(n, max(1, int(quota)))
+    if ncpu is not None:
+        n = min(n, ncpu)
+    return max(1, n)
+
+
+_XMX = re.compile(r'-Xmx(\d+)([kKmMgG]?)')
+
+
+def _parse_xmx(s):
+    m = None
+    for m in _XMX.finditer(s):
+        pass
+    if m is None:
+        return None
+    mult = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    return int(m.group(1)) * mult[m.group(2).lower()]
+
+
+def running_jvm_heaps():
+    """ Maximum heap of each Java process of this user on the host
+
+    The heap is taken from "-Xmx" on the command line or in _JAVA_OPTIONS or
+    JAVA_TOOL_OPTIONS. A JVM without "-Xmx" is counted with the JVM
+    default of one quarter of physical memory.
+
+    Returns:
+        heaps (list): Heap size of each JVM, in bytes
+
+    """
+    if not os.path.isdir('/proc'):
+        return []
+    uid = os.getuid()
+    default = (physical_memory() or 0) // 4
+    ret = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        d = os.path.join('/proc', pid)
+        try:
+            if os.stat(d).st_uid != uid:
+                continue
+            with open(os.path.join(d, 'cmdline'), 'rb') as fh:
+                argv = fh.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            continue
+        if not argv or os.path.basename(argv[0]) != 'java':
+            continue
+        heap = _parse_xmx(' '.join(argv))
+        if heap is None:
+            try:
+                with open(os.path.join(d, 'environ'), 'rb') as fh:
+                    env = fh.read().decode('utf-8', 'replace').split('\0')
+                opts = [e for e in env if e.startswith('_JAVA_OPTIONS=') or
+                        e.startswith('JAVA_TOOL_OPTIONS=')]
+                heap = _parse_xmx(' '.join(opts))
+            except (IOError, OSError):
+                pass
+        ret.append(heap if heap is not None else default)
+    return ret
+
+
+def java_heap_size(inputs=None):
+    """ Determine JVM heap size for a stage
+
+    The heap requested for the stage grows with the size of its inputs (see
+    HEAP_BASE and HEAP_PER_INPUT). It is limited by the memory available to
+    this process (physical memory or cgroup limit, times HEAP_FRACTION),
+    less the heaps of JVMs already running on the host, so that several
+    samples can be run on a node without exceeding its memory.
+
+    Args:
+        inputs (list): Paths to stage input files
+
+    Returns:
+        heap_size (int): Heap size in GB
+
+    """
+    need = HEAP_BASE
+    for f in inputs or []:
+        if f is not None and os.path.isfile(f):
+            need += HEAP_PER_INPUT * os.path.getsize(f)
+    limit = memory_limit()
+    if limit is None:
+        return MAX_HEAP_GB
+    budget = limit * HEAP_FRACTION - sum(running_jvm_heaps())
+    heap = min(need, budget, MAX_HEAP_GB * GB)
+    return max(MIN_HEAP_GB, int(heap // GB))
+
+
+def sort_options(ncpu=1):
+    """ Thread and memory options for samtools sort
+
+    Sort threads are the CPUs used by the stage, and memory per thread is
+    a share of SORT_FRACTION of the memory limit.
+
+    Returns:
+        opts (list): Options for samtools sort ("-@", "-m")
+
+    """
+    threads = available_cpus(ncpu)
+    limit = memory_limit()
+    if limit is None:
+        mem = SORT_MAX_MEM
+    else:
+        mem = int(limit * SORT_FRACTION // threads)
+    mem = min(max(mem, SORT_MIN_MEM), SORT_MAX_MEM)
+    return ['-@', '%d' % threads, '-m', '%dM' % (mem >> 20), ]
+
+
+def java_options(xmx, ncpu=1):
+    """ _JAVA_OPTIONS assignment placed before a java command
+
+    Sets the heap size and limits garbage collection threads to the number
+    of CPUs used by the stage.
+    """
+    return '_JAVA_OPTIONS="-Xmx%dg -XX:ParallelGCThreads=%d"' % (
+        xmx, available_cpus(ncpu)
+    )
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""Scratch space for stage temporary directories
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import errno
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from haphpipe.utils import sysutils
+from haphpipe.utils import telemetry
+from haphpipe.utils.stagecache import parse_size
+from haphpipe.utils.sysutils import PipelineStepError
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Scratch locations checked when HAPHPIPE_SCRATCH is not set. TMPDIR, if
+    set, is checked first.
+"""
+DEFAULT_ROOTS = ['/dev/shm', '/scratch', '/tmp', '/Temp', ]
+
+""" Preference for each kind of storage (lower is preferred) """
+STORAGE_RANK = {'tmpfs': 0, 'nvme': 1, 'local': 2, 'network': 3, }
+
+NETWORK_FS = ['nfs', 'nfs4', 'cifs', 'smbfs', 'lustre', 'gpfs', 'beegfs',
+              'fuse.sshfs', 'panfs', 'ceph', 'glusterfs', ]
+
+""" Temporary space used by each stage, as a multiple of the (uncompressed)
+    size of its inputs. Stages not listed use DEFAULT_FACTOR.
+"""
+FOOTPRINT_FACTOR = {
+    'assemble_spades': 20,
+    'assemble_trinity': 30,
+    'ec_reads': 6,
+    'align_reads': 4,
+    'refine_assembly': 4,
+    'finalize_assembly': 4,
+    'predict_haplo': 4,
+    'clique_snv': 4,
+    'join_reads': 2,
+}
+DEFAULT_FACTOR = 2
+
+""" Assumed compression ratio of gzipped inputs """
+GZIP_RATIO = 4
+
+""" Minimum footprint, so stages with small inputs still need some space """
+MIN_FOOTPRINT = 64 << 20
+
+""" Fraction of free space in tmpfs that may be used. tmpfs is backed by
+    memory, which the stage itself also needs.
+"""
+TMPFS_FRACTION = 0.25
+
+""" Free space that is always left on a filesystem """
+RESERVE_FRACTION = 0.05
+
+
+def _mounts():
+    """ List of (mountpoint, source, fstype), longest mountpoint first """
+    ret = []
+    try:
+        with open('/proc/mounts', 'r') as fh:
+            for l in fh:
+                f = l.split()
+                if len(f) >= 3:
+                    ret.append((f[1].replace('\\040', ' '), f[0], f[2]))
+    except IOError:
+        pass
+    return sorted(ret, key=lambda m: len(m[0]), reverse=True)
+
+
+def storage_kind(path):
+    """ Kind of storage for path: "tmpfs", "nvme", "local" or "network" """
+    path = os.path.realpath(path)
+    for mnt, source, fstype in _mounts():
+        if path == mnt or path.startswith(mnt.rstrip('/') + '/'):
+            if fstype == 'tmpfs':
+                return 'tmpfs'
+            if fstype in NETWORK_FS or ':' in source:
+                return 'network'
+            if 'nvme' in source:
+                return 'nvme'
+            return 'local'
+    return 'local'
+
+
+def free_space(path):
+    """ Bytes available to unprivileged users on filesystem for path """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def dir_size(path):
+    """ Total size of files below path """
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def estimate_footprint(step, inputs=None):
+    """ Estimate temporary space needed by a stage
+
+    Args:
+        step (str): Stage name, as passed to create_tempdir()
+        inputs (list): Paths to input files
+
+    Returns:
+        footprint (int): Estimated bytes
+
+    """
+    total = 0
+    for f in inputs or []:
+        if f is None or not os.path.isfile(f):
+            continue
+        size = os.path.getsize(f)
+        total += size * GZIP_RATIO if f.endswith('.gz') else size
+    factor = FOOTPRINT_FACTOR.get(step.split(':')[0], DEFAULT_FACTOR)
+    return max(MIN_FOOTPRINT, total * factor)
+
+
+def candidate_roots():
+    """ Scratch locations, most preferred first
+
+    Locations are taken from HAPHPIPE_SCRATCH (colon-separated), in the
+    order given. Otherwise TMPDIR, if set by the user or the scheduler, is
+    tried first, followed by DEFAULT_ROOTS ordered by storage kind,
+    preferring memory-backed and NVMe storage.
+    """
+    if os.environ.get('HAPHPIPE_SCRATCH'):
+        roots = [d for d in os.environ['HAPHPIPE_SCRATCH'].split(':') if d]
+        return [d for d in roots if os.path.isdir(d)]
+    usable = lambda d: os.path.isdir(d) and os.access(d, os.W_OK | os.X_OK)
+    ret = []
+    if os.environ.get('TMPDIR') and usable(os.environ['TMPDIR']):
+        ret.append(os.environ['TMPDIR'])
+    seen = set(os.path.realpath(d) for d in ret)
+    defaults = []
+    for d in DEFAULT_ROOTS:
+        if not usable(d) or os.path.realpath(d) in seen:
+            continue
+        seen.add(os.path.realpath(d))
+        defaults.append(d)
+    return ret + sorted(defaults, key=lambda d: STORAGE_RANK[storage_kind(d)])
+
+
+class Ledger(object):
+    """ Record of scratch space reserved by running stages on this host
+
+    The ledger is a JSON file shared by all haphpipe processes of the user,
+    locked while it is updated. Entries of processes that are no longer
+    running are removed.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('HAPHPIPE_SCRATCH_LEDGER')
+        if path is None:
+            path = os.path.join(
+                tempfile.gettempdir(), 'haphpipe_scratch.%d.json' % os.getuid()
+            )
+        self.path = path
+
+    def _locked(self, update):
+        with open(self.path + '.lock', 'a') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as fh:
+                        entries = json.load(fh)
+                except (IOError, ValueError):
+                    entries = {}
+                entries = {k:v for k,v in entries.items() if _alive(v['pid'])}
+                ret = update(entries)
+                tmp = '%s.%d' % (self.path, os.getpid())
+                with open(tmp, 'w') as outh:
+                    json.dump(entries, outh, indent=1)
+                os.rename(tmp, self.path)
+                return ret
+            finally:
+                fcntl.flock(lockfh, fcntl.LOCK_UN)
+
+    def entries(self):
+        return self._locked(lambda e: dict(e))
+
+    def reserve(self, choose, step, footprint):
+        """ Reserve space in the root returned by choose(entries)
+
+        Returns:
+            root (str): Chosen root, or None if none had room
+
+        """
+        def update(entries):
+            root = choose(entries)
+            if root is not None:
+                d = tempfile.mkdtemp(prefix='tmpHP_%s' % step, dir=root)
+                entries[d] = {'pid': os.getpid(), 'step': step, 'root': root,
+                              'reserved': footprint, 'start': time.time()}
+                return d
+            return None
+        return self._locked(update)
+
+    def release(self, d):
+        def update(entries):
+            return entries.pop(d, None)
+        return self._locked(update)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def reserved_in(entries, root):
+    dev = os.stat(root).st_dev
+    total = 0
+    for v in entries.values():
+        try:
+            if os.stat(v['root']).st_dev == dev:
+                total += v['reserved']
+        except OSError:
+            continue
+    return total
+
+
+# Temporary directories allocated by running stages of this thread, innermost
+# last. A stage run by another stage (e.g. align_reads in refine_assembly)
+# creates its directory inside the directory of the outer stage. Directories
+# with a reservation in the ledger are also listed in "reserved".
+_active = threading.local()
+
+
+def _outer_tempdir():
+    stack = getattr(_active, 'stack', [])
+    while stack and not os.path.isdir(stack[-1]):
+        stack.pop()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def toplevel():
+    """ Run a stage as a top-level stage of this thread
+
+    Directories left by earlier stages of the thread (e.g. a stage that
+    failed before removing its directory) are not used as outer directories
+    by stages run within the context. Reservations made within the context
+    that were not released, because the stage failed or kept its temporary
+    directory, are released when it exits. The directories are not removed.
+    """
+    saved = getattr(_active, 'stack', [])
+    saved_reserved = getattr(_active, 'reserved', [])
+    _active.stack = []
+    _active.reserved = []
+    try:
+        yield
+    finally:
+        left = _active.reserved
+        _active.stack = saved
+        _active.reserved = saved_reserved
+        if left:
+            ledger = Ledger()
+            for d in left:
+                ledger.release(d)
+
+
+def allocate(step, inputs=None, quiet=False, logfile=None):
+    """ Create temporary directory in the most suitable scratch location
+
+    The space needed by the stage is estimated from the size of its inputs
+    (see FOOTPRINT_FACTOR). The directory is created in the first location
+    with enough free space after subtracting the space reserved by other
+    running stages on this host. The total reserved by all running stages
+    is limited by HAPHPIPE_SCRATCH_QUOTA (e.g. "500G"), if set. When the
+    quota is reached, the stage waits up to HAPHPIPE_SCRATCH_WAIT seconds
+    (default 3600) for other stages to finish.
+
+    A stage called by another stage in the same thread is covered by the
+    reservation of the outer stage: its directory is created inside the
+    directory of the outer stage and no more space is reserved.
+
+    Args:
+        step (str): Stage name
+        inputs (list): Paths to input files
+        quiet (bool): Do not write output to console
+        logfile (file): Append console output to this file
+
+    Returns:
+        tempdir (str): Path to temporary directory
+
+    """
+    outer = _outer_tempdir()
+    if outer is not None:
+        tempdir = tempfile.mkdtemp(prefix='tmpHP_%s' % step, dir=outer)
+        _active.stack.append(tempdir)
+        msg = '\n[--- %s ---] Using temporary directory %s (in %s)\n' % (
+            step, tempdir, outer
+        )
+        sysutils.log_message(msg, quiet, logfile)
+        return tempdir
+
+    footprint = estimate_footprint(step, inputs)
+    roots = candidate_roots()
+    if not roots:
+        raise PipelineStepError("Could not identify temporary directory")
+
+    quota = os.environ.get('HAPHPIPE_SCRATCH_QUOTA')
+    quota = parse_size(quota) if quota else None
+    if quota is not None and footprint > quota:
+        raise PipelineStepError(
+            'Stage %s needs an estimated %s of scratch space, more than the '
+            'quota of %s' % (step, fmt_size(footprint), fmt_size(quota))
+        )
+    waitmax = float(os.environ.get('HAPHPIPE_SCRATCH_WAIT', 3600))
+
+    state = {}
+    def choose(entries):
+        used = sum(v['reserved'] for v in entries.values())
+        state['over_quota'] = quota is not None and used + footprint > quota
+        if state['over_quota']:
+            return None
+        state['free'] = []
+        for root in roots:
+            free = free_space(root) - reserved_in(entries, root)
+            state['free'].append((root, free))
+            if storage_kind(root) == 'tmpfs':
+                avail = free * TMPFS_FRACTION
+            else:
+                avail = free - free_space(root) * RESERVE_FRACTION
+            if footprint <= avail:
+                return root
+        return None
+
+    ledger = Ledger()
+    t0 = time.time()
+    waiting = False
+    while True:
+        tempdir = ledger.reserve(choose, step, footprint)
+        if tempdir is not None:
+            break
+        if not state.get('over_quota'):
+            msg = 'Not enough scratch space for %s (estimated %s).' % (
+                step, fmt_size(footprint)
+            )
+            for root, free in state.get('free', []):
+                msg += '\n  %s: %s available' % (root, fmt_size(max(0, free)))
+            raise PipelineStepError(msg)
+        if time.time() - t0 > waitmax:
+            raise PipelineStepError(
+                'Timed out waiting for scratch quota for %s' % step
+            )
+        if not waiting:
+            msg = '\n[--- %s ---] Waiting for scratch quota (need %s)\n' % (
+                step, fmt_size(footprint)
+            )
+            sysutils.log_message(msg, quiet, logfile)
+            waiting = True
+        time.sleep(10)
+
+    msg = '\n[--- %s ---] Using temporary directory %s (%s, estimated %s)\n' % (
+        step, tempdir, storage_kind(tempdir), fmt_size(footprint)
+    )
+    sysutils.log_message(msg, quiet, logfile)
+    _active.stack = getattr(_active, 'stack', []) + [tempdir]
+    _active.reserved = getattr(_active, 'reserved', []) + [tempdir]
+    return tempdir
+
+
+def release(d, step, quiet=False, logfile=None):
+    """ Record space used by temporary directory and release reservation
+
+    Returns:
+        used (int): Bytes used by directory
+
+    """
+    for l in [getattr(_active, 'stack', []), getattr(_active, 'reserved', [])]:
+        if d in l:
+            l.remove(d)
+    used = dir_size(d) if os.path.isdir(d) else 0
+    entry = Ledger().release(d)
+    if entry is not None:
+        msg = '\n[--- %s ---] Temporary directory used %s (estimated %s)\n' % (
+            step, fmt_size(used), fmt_size(entry['reserved'])
+        )
+        sysutils.log_message(msg, quiet, logfile)
+        telemetry.record(
+            'scratch', step, entry['start'], time.time(), tempdir=d,
+            root=entry['root'], reserved=entry['reserved'], used=used,
+        )
+    return used
+
+
+def fmt_size(n):
+    for unit in ['B', 'K', 'M', 'G', ]:
+        if abs(n) < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fT' % n
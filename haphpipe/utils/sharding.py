@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Split reads into shards aligned separately, and merge the results
+
+Reads (or pairs, with mate files read in lockstep) are dealt to the shards
+in turn, so shards have the same number of reads (to within one) and mate
+files of a shard stay synchronized.
+
+The bowtie2 summaries of the shards (written to stderr) are merged into a
+single summary in the same format: counts are summed, and percentages and
+the overall alignment rate are computed again from the summed counts, so
+that tools parsing the summary of an unsharded alignment can parse it.
+"""
+from __future__ import print_function
+from __future__ import division
+import re
+
+import numpy as np
+
+from haphpipe.utils import gzutils
+from haphpipe.utils import readsampler
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+_SUMMARY_START = re.compile(r'^\d+ reads; of these:$')
+_COUNT = re.compile(r'^(\s*)(\d+)( \(\d+\.\d+%\))?( .*)$')
+_OVERALL = re.compile(r'^\d+\.\d+% overall alignment rate$')
+
+
+def split_reads(paths, outs, ncpu=1):
+    """ Deal reads (or pairs) to shards
+
+    Args:
+        paths (list): FASTQ files. Several files are treated as mates.
+        outs (list): Output paths of each shard, one per input. Files named
+            ".gz" are compressed.
+        ncpu (int): Number of CPUs for compression
+
+    Returns:
+        counts (list): Number of reads (or pairs) in each shard
+
+    """
+    nshards = len(outs)
+    counts = [0] * nshards
+    ouths = [[gzutils.open_writer(f, ncpu, readsampler.COMPRESS_LEVEL)
+              for f in shard] for shard in outs]
+    try:
+        start = 0
+        for batches in readsampler.lockstep_batches(paths):
+            n = len(batches[0])
+            shard = (np.arange(n) + start) % nshards
+            for s in range(nshards):
+                sel = shard == s
+                for b, outh in zip(batches, ouths[s]):
+                    outh.write(b.raw_selected(sel))
+                counts[s] += int(sel.sum())
+            start += n
+    finally:
+        for hs in ouths:
+            for outh in hs:
+                outh.close()
+    return counts
+
+
+def _parse_summary(text):
+    """ Split bowtie2 stderr into other messages and summary lines
+
+    Returns:
+        messages (list): Lines before the summary (warnings, etc.)
+        summary (list): (indent, count, has_percent, rest) for each summary
+            line with a count, or (line, ) for other lines
+
+    """
+    lines = text.splitlines()
+    for i, l in enumerate(lines):
+        if _SUMMARY_START.match(l):
+            break
+    else:
+        return lines, []
+    summary = []
+    for l in lines[i:]:
+        m = _COUNT.match(l)
+        if m:
+            summary.append((m.group(1), int(m.group(2)),
+                            m.group(3) is not None, m.group(4)))
+        elif not _OVERALL.match(l):
+            summary.append((l, ))
+    return lines[:i], summary
+
+
+def merge_bt2_summaries(texts):
+    """ Merge bowtie2 summaries of shards
+
+    Args:
+        texts (list): bowtie2 stderr of each shard
+
+    Returns:
+        text (str): Merged stderr. Messages other than the summary are kept,
+            in order of shards, followed by the merged summary.
+
+    """
+    # bowtie2 leaves out the paired or unpaired part of the summary if a
+    # shard has no such reads, so lines are matched by their labels (and
+    # the labels of the lines they belong to)
+    messages, keys, merged = [], [], {}
+    for text in texts:
+        msgs, summary = _parse_summary(text)
+        messages.extend(msgs)
+        chain, pos = [], -1
+        for s in summary:
+            if len(s) == 1:
+                # Separators are placed after the preceding count
+                key = tuple(chain) + ((s[0], ), )
+            else:
+                while chain and len(chain[-1][0]) >= len(s[0]):
+                    chain.pop()
+                chain.append((s[0], s[3]))
+                key = tuple(chain)
+            if key in merged:
+                pos = keys.index(key)
+                if len(s) > 1:
+                    merged[key][1] += s[1]
+            else:
+                pos += 1
+                keys.insert(pos, key)
+                merged[key] = list(s)
+    # Unpaired reads are reported after pairs
+    keys.sort(key=lambda k: len(k) > 1 and len(k[1]) > 1
+                            and k[1][1].startswith(' were unpaired'))
+    merged = [merged[k] for k in keys] if keys else None
+
+    ret = list(messages)
+    if merged is not None:
+        # Percentages are relative to the closest line above with a smaller
+        # indent and a count
+        parents = []
+        paired = unpaired = unaligned = 0
+        for s in merged:
+            if len(s) == 1:
+                ret.append(s[0])
+                continue
+            indent, count, has_percent, rest = s
+            while parents and len(parents[-1][0]) >= len(indent):
+                parents.pop()
+            if has_percent:
+                total = parents[-1][1] if parents else count
+                pct = 100.0 * count / total if total else 0.0
+                ret.append('%s%d (%.2f%%)%s' % (indent, count, pct, rest))
+            else:
+                ret.append('%s%d%s' % (indent, count, rest))
+            parents.append((indent, count))
+            if rest.startswith(' were paired'):
+                paired += count
+            elif rest.startswith(' were unpaired'):
+                unpaired += count
+            elif rest == ' aligned 0 times':
+                unaligned += count
+        total = 2 * paired + unpaired
+        rate = 100.0 * (total - unaligned) / total if total else 0.0
+        ret.append('%.2f%% overall alignment rate' % rate)
+    return '\n'.join(ret) + '\n'
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache for stage results
+"""
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import stat
+import errno
+import fcntl
+import fnmatch
+import shutil
+import hashlib
+import tempfile
+
+from haphpipe.utils import sysutils
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Increment to invalidate all existing cache entries """
+CACHE_VERSION = 3
+
+""" ioctl request to share the storage of a file (Linux, btrfs/XFS) """
+FICLONE = 0x40049409
+
+""" Stage arguments that are not part of the cache key. "outdir" is excluded
+    so that results can be restored into a different output directory.
+"""
+UNKEYED_PARAMS = ['outdir', 'ncpu', 'keep_tmp', 'quiet', 'logfile', 'debug', ]
+
+""" Files a stage writes to its output directory besides the paths it
+    returns, as patterns relative to the output directory. Stages may share
+    an output directory and run at the same time, so only these files, and
+    only if they were written by the call, are stored with the outputs.
+"""
+SIDE_OUTPUTS = {
+    'haphpipe.stages.trim_reads.trim_reads': ['trimmed.qc.json', ],
+    'haphpipe.stages.sample_reads.sample_reads': ['sample.qc.json', ],
+    'haphpipe.stages.align_reads.align_reads': [
+        'trimmed_?.fastq', 'trimmed_?.fastq.gz', 'trimmomatic_summary.out',
+    ],
+    'haphpipe.stages.refine_assembly.refine_assembly': [
+        'refined.[0-9][0-9].fna', 'refined_bt2.[0-9][0-9].out',
+    ],
+    'haphpipe.stages.assemble_denovo.assemble_denovo': [
+        'assembly_summary.txt',
+    ],
+}
+
+""" Index files written next to stage outputs, stored with the output """
+INDEX_SUFFIXES = ['.bai', '.tbi', '.csi', '.fai', ]
+
+
+def parse_size(s):
+    """ Parse size with optional K, M, G or T suffix
+
+    Examples:
+        >>> parse_size('100')
+        100
+        >>> parse_size('2G')
+        2147483648
+    """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(s), re.I)
+    if m is None:
+        raise ValueError('Invalid size: %s' % s)
+    mult = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    return int(float(m.group(1)) * mult[m.group(2).upper()])
+
+
+def file_digest(path, blocksize=1 << 20):
+    """ SHA-256 digest of file contents """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _under(path, d):
+    path = os.path.abspath(path)
+    d = os.path.abspath(d)
+    return path.startswith(d.rstrip(os.sep) + os.sep)
+
+
+class StageCache(object):
+    """ Cache of stage outputs keyed on input contents and parameters
+
+    Entries are stored in "cachedir/entries/<key>". Each entry contains the
+    files written by one stage call (the paths it returns, their indexes and
+    its declared side outputs, see SIDE_OUTPUTS) and a manifest describing the value returned by the stage function. Stored
+    files are read-only and are restored into the output directory as
+    writable files, sharing storage with the cache where the filesystem
+    supports it (see clone_or_copy()), so later stages may modify them. When
+    the total size of the cache exceeds "max_size" the least recently used
+    entries are removed.
+
+    Args:
+        cachedir (str): Path to cache directory
+        max_size (int): Maximum size of cache in bytes. No limit if None.
+    """
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_size = max_size
+        for d in ['entries', 'digests', 'tmp']:
+            p = os.path.join(self.cachedir, d)
+            if not os.path.isdir(p):
+                try:
+                    os.makedirs(p)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def input_digest(self, path):
+        """ Content digest for an input file
+
+        Digests are remembered for each (path, inode, size, mtime) so large
+        inputs are only read once.
+        """
+        st = os.stat(path)
+        ident = '%s|%d|%d|%d' % (os.path.realpath(path), st.st_ino,
+                                 st.st_size, int(st.st_mtime * 1e6))
+        memo = os.path.join(self.cachedir, 'digests',
+                            hashlib.sha1(ident.encode('utf-8')).hexdigest())
+        if os.path.exists(memo):
+            with open(memo, 'r') as fh:
+                return fh.read().strip()
+        digest = file_digest(path)
+        tmp = '%s.%d' % (memo, os.getpid())
+        with open(tmp, 'w') as outh:
+            outh.write(digest)
+        os.rename(tmp, memo)
+        return digest
+
+    def _normalize(self, v):
+        if isinstance(v, (list, tuple)):
+            return [self._normalize(x) for x in v]
+        if isinstance(v, str) and os.path.isfile(v):
+            return {'file': self.input_digest(v)}
+        return v
+
+    def key(self, stage, params):
+        """ Cache key for a stage call
+
+        Args:
+            stage (str): Stage name
+            params (dict): Stage arguments, as returned by
+                sysutils.args_params()
+
+        Returns:
+            key (str): Hex digest identifying the stage call
+
+        """
+        norm = {k:self._normalize(v) for k,v in params.items()
+                if k not in UNKEYED_PARAMS and v is not None}
+        s = json.dumps({'version': CACHE_VERSION, 'stage': stage,
+                        'params': norm}, sort_keys=True, default=str)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cachedir, 'entries', key)
+
+    def _encode(self, v, outdir, files):
+        """ Describe return value with output paths relative to outdir """
+        if v is None or isinstance(v, (bool, int, float)):
+            return {'value': v}
+        if isinstance(v, (list, tuple)):
+            return {'list': [self._encode(x, outdir, files) for x in v],
+                    'tuple': isinstance(v, tuple)}
+        if isinstance(v, str):
+            if _under(v, outdir):
+                rel = os.path.relpath(v, outdir)
+                if os.path.isfile(v):
+                    files.append(rel)
+                return {'path': rel, 'exists': os.path.isfile(v)}
+            return {'value': v}
+        raise TypeError('Cannot cache value of type %s' % type(v).__name__)
+
+    def _decode(self, d, outdir):
+        if 'list' in d:
+            ret = [self._decode(x, outdir) for x in d['list']]
+            return tuple(ret) if d['tuple'] else ret
+        if 'path' in d:
+            return os.path.join(outdir, d['path'])
+        return d['value']
+
+    def lookup(self, key, outdir):
+        """ Restore outputs for key into outdir
+
+        Returns:
+            hit (bool): True if the entry was found and restored
+            ret: Value returned by the stage function
+
+        """
+        edir = self.entry_dir(key)
+        manifest = os.path.join(edir, 'manifest.json')
+        try:
+            with open(manifest, 'r') as fh:
+                m = json.load(fh)
+            for i, rel in enumerate(m['files']):
+                dest = os.path.join(outdir, rel)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+                clone_or_copy(os.path.join(edir, 'f%d' % i), dest)
+            os.utime(manifest, None)
+        except (IOError, OSError, ValueError):
+            # Missing or partially evicted entry
+            return False, None
+        return True, self._decode(m['ret'], outdir)
+
+    def store(self, key, stage, ret, outdir, written=None):
+        """ Store outputs of a stage call
+
+        Args:
+            key (str): Cache key of the call
+            stage (str): Stage name
+            ret: Value returned by the stage function
+            outdir (str): Output directory of the call
+            written (list): Side outputs and indexes written by the stage,
+                relative to outdir (see written_files()). Indexes are only
+                stored if the file they index is returned.
+
+        Returns:
+            stored (bool): False if the return value could not be cached
+
+        """
+        files = []
+        try:
+            enc = self._encode(ret, outdir, files)
+        except TypeError:
+            return False
+        if not files:
+            return False
+        returned = set(files)
+        for rel in written or []:
+            base, ext = os.path.splitext(rel)
+            if ext in INDEX_SUFFIXES and base not in returned:
+                continue
+            if rel not in files:
+                files.append(rel)
+        tmpdir = tempfile.mkdtemp(dir=os.path.join(self.cachedir, 'tmp'))
+        size = 0
+        for i, rel in enumerate(files):
+            dest = os.path.join(tmpdir, 'f%d' % i)
+            clone_or_copy(os.path.join(outdir, rel), dest)
+            os.chmod(dest, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            size += os.path.getsize(dest)
+        with open(os.path.join(tmpdir, 'manifest.json'), 'w') as outh:
+            json.dump({'stage': stage, 'files': files, 'ret': enc,
+                       'size': size, 'created': time.time()}, outh)
+        try:
+            os.rename(tmpdir, self.entry_dir(key))
+        except OSError:
+            # Entry was stored concurrently by another process
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """ List of (last_used, size, key) for all entries """
+        ret = []
+        edir = os.path.join(self.cachedir, 'entries')
+        for key in os.listdir(edir):
+            manifest = os.path.join(edir, key, 'manifest.json')
+            try:
+                with open(manifest, 'r') as fh:
+                    size = json.load(fh)['size']
+                ret.append((os.path.getmtime(manifest), size, key))
+            except (IOError, OSError, ValueError):
+                continue
+        return ret
+
+    def evict(self):
+        """ Remove least recently used entries until cache fits max_size """
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        while entries and total > self.max_size:
+            _, size, key = entries.pop(0)
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+
+def clone_or_copy(src, dest):
+    """ Copy src to dest, sharing storage if the filesystem supports it
+
+    On filesystems with reflinks (btrfs, XFS) the copy shares blocks with
+    src until either file is modified, so restoring large outputs is fast
+    and modifying a restored file never changes the cached copy.
+    """
+    with open(src, 'rb') as fh, open(dest, 'wb') as outh:
+        try:
+            fcntl.ioctl(outh.fileno(), FICLONE, fh.fileno())
+            return
+        except (IOError, OSError):
+            pass
+        shutil.copyfileobj(fh, outh, 1 << 20)
+
+
+def snapshot(outdir, patterns):
+    """ State of the files in outdir matching patterns
+
+    Args:
+        outdir (str): Output directory
+        patterns (list): fnmatch patterns for file names
+
+    Returns:
+        state (dict): (size, mtime, inode) of each file, by name
+
+    """
+    ret = {}
+    try:
+        names = os.listdir(outdir)
+    except OSError:
+        return ret
+    for f in names:
+        if not any(fnmatch.fnmatch(f, pat) for pat in patterns):
+            continue
+        try:
+            st = os.stat(os.path.join(outdir, f))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            ret[f] = (st.st_size, st.st_mtime, st.st_ino)
+    return ret
+
+
+def written_files(before, outdir, patterns):
+    """ Files in outdir matching patterns created or modified since before
+
+    Args:
+        before (dict): Snapshot taken before the stage ran
+        outdir (str): Output directory
+        patterns (list): fnmatch patterns for file names
+
+    Returns:
+        written (list): Paths relative to outdir
+
+    """
+    after = snapshot(outdir, patterns)
+    return sorted(rel for rel, st in after.items() if before.get(rel) != st)
+
+
+class CachedStage(object):
+    """ Stage function wrapper that reuses cached results
+
+    Calls with the same input file contents and parameters as an earlier call
+    restore the earlier outputs, with their indexes and the side outputs of
+    the stage (see SIDE_OUTPUTS), instead of running the stage. Other files
+    in "outdir" are never stored or restored, since other stages may be
+    writing them.
+    Calls in debug mode are never cached.
+
+    Args:
+        func (callable): Stage function
+        cache (StageCache): Cache to use
+    """
+    def __init__(self, func, cache):
+        self.func = func
+        self.cache = cache
+        self.stage = '%s.%s' % (func.__module__, func.__name__)
+
+    def __call__(self, **kwargs):
+        if kwargs.get('debug'):
+            return self.func(**kwargs)
+        quiet = kwargs.get('quiet', False)
+        logfile = kwargs.get('logfile', None)
+        outdir = kwargs.get('outdir', '.')
+        key = self.cache.key(self.stage, kwargs)
+
+        hit, ret = self.cache.lookup(key, outdir)
+        if hit:
+            msg = '[--- %s ---] Restored from cache %s\n' % (self.stage, key[:12])
+            sysutils.log_message(msg, quiet, logfile)
+            return ret
+
+        # Side outputs and indexes written by the call
+        patterns = SIDE_OUTPUTS.get(self.stage, []) + \
+            ['*%s' % ext for ext in INDEX_SUFFIXES]
+        before = snapshot(outdir, patterns)
+        ret = self.func(**kwargs)
+        written = written_files(before, outdir, patterns)
+        if self.cache.store(key, self.stage, ret, outdir, written):
+            msg = '[--- %s ---] Stored in cache %s\n' % (self.stage, key[:12])
+            sysutils.log_message(msg, quiet, logfile)
+        return ret
+
+
+def cache_from_env():
+    """ StageCache configured by environment variables
+
+    HAPHPIPE_CACHE_DIR sets the cache directory, and HAPHPIPE_CACHE_SIZE
+    optionally sets the maximum size (e.g. "200G").
+
+    Returns:
+        cache (StageCache): Cache, or None if HAPHPIPE_CACHE_DIR is not set
+
+    """
+    if not os.environ.get('HAPHPIPE_CACHE_DIR'):
+        return None
+    max_size = os.environ.get('HAPHPIPE_CACHE_SIZE')
+    return StageCache(
+        os.environ['HAPHPIPE_CACHE_DIR'],
+        parse_size(max_size) if max_size else None
+    )
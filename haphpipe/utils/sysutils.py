@@ -2,7 +2,6 @@
 
 from __future__ import print_function
 from builtins import str
-from past.builtins import basestring
 import sys
 import os
 import gzip
@@ -11,6 +10,11 @@ import tempfile
 import argparse
 import subprocess
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
@@ -104,10 +108,71 @@ def log_message(msg, quiet, logfile):
             logfile.write(msg) # python3
 
 
+class ConcurrentCommands(object):
+    """ Group of independent commands that may run at the same time
+
+    A group can be used in place of a single command in the list passed to
+    command_runner(). The commands in the group are started together, with at
+    most "max_jobs" running at once, and the group completes when all of its
+    commands have finished. Commands in the group must not depend on each
+    other's outputs.
+
+    Args:
+        cmds (list): Commands, each a list of words
+        max_jobs (int): Maximum number of commands running at once. All
+            commands run at once if None.
+    """
+    def __init__(self, cmds, max_jobs=None):
+        self.cmds = list(cmds)
+        self.max_jobs = max_jobs
+
+    def __iter__(self):
+        return iter(self.cmds)
+
+    def __len__(self):
+        return len(self.cmds)
+
+
+class StreamingCommands(ConcurrentCommands):
+    """ Group of commands connected by named pipes (FIFOs)
+
+    All commands in the group are started together, since a command that
+    opens a named pipe waits until another command opens the other end. If
+    any command fails, the rest of the group is terminated instead of
+    waiting on a pipe that will never be opened.
+
+    Named pipes must be passed to the programs as arguments, not used as
+    redirection targets, which are opened before the process starts.
+
+    Args:
+        cmds (list): Commands, each a list of words
+    """
+    def __init__(self, cmds):
+        super(StreamingCommands, self).__init__(cmds, max_jobs=None)
+
+
+def flatten_commands(cmds):
+    """ Iterate over commands, expanding ConcurrentCommands groups
+
+    Yields:
+        num (int): Command number, counting commands within groups
+        args (list): Command
+        concurrent (bool): Command is part of a ConcurrentCommands group
+    """
+    num = 0
+    for c in cmds:
+        group = c if isinstance(c, ConcurrentCommands) else [c, ]
+        for args in group:
+            num += 1
+            yield num, args, isinstance(c, ConcurrentCommands)
+
+
 def pretty_print_commands(cmds, stage, out_fh=sys.stderr):
     # Formatted print of each command
-    for i,args in enumerate(cmds):
-            print('\n[--- %s command %d ---]' % (stage, (i+1)), file=out_fh)
+    for i, args, concurrent in flatten_commands(cmds):
+            print('\n[--- %s command %d%s ---]' % (
+                stage, i, ' (concurrent)' if concurrent else ''
+            ), file=out_fh)
             s = '%s' % args[0]
             prev = 'init'
             for a in args[1:]:
@@ -130,9 +195,24 @@ def pretty_print_commands(cmds, stage, out_fh=sys.stderr):
 
 def command_runner(cmds, stage=None, quiet=False, logfile=None, debug=False):
     """ Run a list of commands
+
+    Commands are run in order, stopping at the first failure. Each command is
+    a list of words that may include pipes and redirections ("|", ">", "2>",
+    etc.), which are connected directly between processes (see
+    cmdpipe.Pipeline). Independent commands can be grouped with
+    ConcurrentCommands to run them at the same time. Raises
+    PipelineStepError naming each process that failed.
+
+    Returns:
+        pipelines (list): cmdpipe.Pipeline objects with the exit status and
+            run time of each process
     """
     # Join each command with whitespace and join commands with "&&"
-    cmdstr = ' && '.join(' '.join(c) for c in cmds)
+    cmdstr = ' && '.join(
+        '( %s & wait )' % ' & '.join(' '.join(g) for g in c)
+        if isinstance(c, ConcurrentCommands) else ' '.join(c)
+        for c in cmds
+    )
 
     if debug:
         # Print the joined command
@@ -147,22 +227,9 @@ def command_runner(cmds, stage=None, quiet=False, logfile=None, debug=False):
     if logfile is not None:
         pretty_print_commands(cmds, stage, logfile)
 
-    p = subprocess.Popen(
-        cmdstr, shell=True,
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-    )
-    for line in p.stdout:
-        log_message(line.decode("utf-8"), quiet, logfile)
-
-    returncode = p.wait()
-
-    if returncode != 0:
-        raise PipelineStepError(
-            '\n[--- FAILED: %s ---]\nCommand:\n%s' % (stage, cmdstr),
-            returncode=returncode
-        )
-
-    return
+    # Each command runs as a pipeline of processes without a shell
+    from haphpipe.utils import cmdpipe
+    return cmdpipe.run_commands(cmds, stage, quiet, logfile)
 
 
 """
@@ -214,21 +281,20 @@ def args_params(args):
     return d
 
 
-def create_tempdir(step='HPstep', basedir=None, quiet=False, logfile=None):
+def create_tempdir(step='HPstep', basedir=None, quiet=False, logfile=None,
+                   inputs=None):
     """ Creates temporary directory
+
+    If basedir is not given, the location is chosen by the scratch manager
+    (see scratch.allocate()), which checks free space for the footprint
+    estimated from "inputs" and records the reservation until
+    remove_tempdir() is called.
     """
-    checkdirs = ['/tmp', '/scratch', '/Temp']
-    # Temporary directory
     if basedir is None:
-        if 'TMPDIR' in os.environ:
-            basedir = os.environ['TMPDIR']
-        else:
-            for d in checkdirs:
-                if os.path.isdir(d):
-                    basedir = d
-                    break
-    
-    if not basedir or not os.path.isdir(basedir):
+        from haphpipe.utils import scratch
+        return scratch.allocate(step, inputs, quiet, logfile)
+
+    if not os.path.isdir(basedir):
         raise PipelineStepError("Could not identify temporary directory")
     
     curdir = tempfile.mkdtemp(prefix='tmpHP_%s' % step, dir=basedir)
@@ -240,6 +306,8 @@ def create_tempdir(step='HPstep', basedir=None, quiet=False, logfile=None):
 def remove_tempdir(d, step='HPstep', quiet=False, logfile=None):
     """ Removes temporary directory
     """
+    from haphpipe.utils import scratch
+    scratch.release(d, step, quiet, logfile)
     if os.path.isdir(d):
         msg = '\n[--- %s ---] Removing temporary directory %s\n' % (step, d)
         log_message(msg, quiet, logfile)
@@ -258,13 +326,19 @@ def get_filehandle(fh):
         return fh
 
 
-def get_java_heap_size():
+def get_java_heap_size(inputs=None):
     """ Determine a reasonable JVM heap size for this system
 
-     Have not yet implemented the logic here. Just returns 32
+    The heap is sized from the input sizes, the memory limit of this process
+    (physical memory or cgroup limit) and the JVMs already running on the
+    host. See resources.java_heap_size().
+
+    Args:
+        inputs (list): Paths to stage input files
 
     Returns:
         heap_size (int): Heap size in GB
 
     """
-    return 32
+    from haphpipe.utils import resources
+    return resources.java_heap_size(inputs)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Resource usage trace for stages and commands
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Environment variable with path to trace file. Tracing is disabled if it
+    is not set. Worker processes inherit the setting.
+"""
+TRACE_ENV = 'HAPHPIPE_TRACE'
+
+_local = threading.local()
+
+
+def trace_path():
+    return os.environ.get(TRACE_ENV) or None
+
+
+def enable(path):
+    """ Append trace records to path, in this process and its children """
+    os.environ[TRACE_ENV] = os.path.abspath(path)
+
+
+def current_tags():
+    """ Tags set by the enclosing context() calls in this thread """
+    ret = {}
+    for tags in getattr(_local, 'stack', []):
+        ret.update(tags)
+    return ret
+
+
+@contextmanager
+def context(**tags):
+    """ Tag records created within this context
+
+    Example:
+        with telemetry.context(sample='sample01', iteration=2):
+            align_reads(...)
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append({k:v for k,v in tags.items() if v is not None})
+    try:
+        yield
+    finally:
+        _local.stack.pop()
+
+
+def maxrss_kb(ru_maxrss):
+    """ ru_maxrss is in kilobytes on Linux and in bytes on macOS """
+    return ru_maxrss // 1024 if sys.platform == 'darwin' else ru_maxrss
+
+
+def record(kind, name, start, end, **fields):
+    """ Append one record to the trace
+
+    Each record is one line of JSON. Lines are written with a single append
+    so that concurrent stages can share a trace file.
+
+    Args:
+        kind (str): "stage", "iteration" or "process"
+        name (str): Stage or program name
+        start (float): Start time (seconds since epoch)
+        end (float): End time (seconds since epoch)
+        **fields: Additional fields (e.g. user, sys, maxrss_kb)
+
+    Returns:
+        None
+
+    """
+    path = trace_path()
+    if path is None:
+        return
+    rec = {
+        'kind': kind, 'name': name,
+        'start': start, 'end': end, 'wall': end - start,
+        'host': socket.gethostname(), 'pid': os.getpid(),
+    }
+    rec.update(current_tags())
+    rec.update(fields)
+    line = json.dumps(rec, sort_keys=True, default=str) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(kind, name, **fields):
+    """ Record the time spent within this context, and whether it failed """
+    start = time.time()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        record(kind, name, start, time.time(), status=status, **fields)
+
+
+def load(path):
+    """ Read records from trace file """
+    ret = []
+    with open(path, 'r') as fh:
+        for l in fh:
+            if l.strip():
+                ret.append(json.loads(l))
+    return ret
+
+
+def to_chrome(records):
+    """ Convert records to Chrome trace format
+
+    The result can be loaded in chrome://tracing or Perfetto. Each sample is
+    shown as a process. Stages and commands are shown as threads.
+
+    Args:
+        records (list): Trace records
+
+    Returns:
+        trace (dict): Chrome trace
+
+    """
+    events = []
+    pids = OrderedDict()
+    tids = OrderedDict()
+    t0 = min(r['start'] for r in records) if records else 0
+    for r in records:
+        sample = r.get('sample', r.get('host', 'haphpipe'))
+        if sample not in pids:
+            pids[sample] = len(pids) + 1
+        if r['kind'] == 'process':
+            track = ('process', r.get('child_pid', r['pid']))
+            label = '%s %s' % (r.get('stage', ''), r['name'])
+        else:
+            track = ('stage', r['name'], r.get('iteration'))
+            label = r['name']
+        if (sample, track) not in tids:
+            tids[(sample, track)] = len(tids) + 1
+            events.append({
+                'name': 'thread_name', 'ph': 'M',
+                'pid': pids[sample], 'tid': tids[(sample, track)],
+                'args': {'name': label.strip()},
+            })
+        args = {k:v for k,v in r.items() if k not in ('start', 'end', 'name')}
+        events.append({
+            'name': r['name'], 'cat': r['kind'], 'ph': 'X',
+            'ts': (r['start'] - t0) * 1e6, 'dur': r['wall'] * 1e6,
+            'pid': pids[sample], 'tid': tids[(sample, track)],
+            'args': args,
+        })
+    for sample, pid in pids.items():
+        events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': str(sample)},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def summarize(records, keys=('sample', 'iteration', 'stage', 'name')):
+    """ Total resource usage of processes, grouped by keys
+
+    Returns:
+        rows (list): One OrderedDict per group
+
+    """
+    groups = OrderedDict()
+    for r in records:
+        if r['kind'] != 'process':
+            continue
+        k = tuple(r.get(f) for f in keys)
+        if k not in groups:
+            groups[k] = OrderedDict(zip(keys, k))
+            groups[k].update([('n', 0), ('wall', 0.0), ('user', 0.0),
+                              ('sys', 0.0), ('maxrss_kb', 0)])
+        g = groups[k]
+        g['n'] += 1
+        g['wall'] += r['wall']
+        g['user'] += r.get('user') or 0.0
+        g['sys'] += r.get('sys') or 0.0
+        g['maxrss_kb'] = max(g['maxrss_kb'], r.get('maxrss_kb') or 0)
+    return list(groups.values())
@@ -38,11 +38,16 @@ setuptools.setup(name='haphpipe',
               'haphpipe=haphpipe.haphpipe:console',
               # miscellaneous subcommands
               'hp_demo=haphpipe.stages.demo:console',
+              'hp_trace_report=haphpipe.stages.trace_report:console',
+              'hp_serve=haphpipe.stages.serve:console',
               # hp_reads subcommands
               'hp_sample_reads=haphpipe.stages.sample_reads:console',
               'hp_trim_reads=haphpipe.stages.trim_reads:console',
               'hp_join_reads=haphpipe.stages.join_reads:console',
               'hp_ec_reads=haphpipe.stages.ec_reads:console',
+              'hp_collapse_reads=haphpipe.stages.collapse_reads:console',
+              'hp_normalize_reads=haphpipe.stages.normalize_reads:console',
+              'hp_bin_reads=haphpipe.stages.bin_reads:console',
               # hp_assemble subcommands
               'hp_assemble_denovo=haphpipe.stages.assemble_denovo:console',
               'hp_assemble_amplicons=haphpipe.stages.assemble_amplicons:console',
@@ -64,6 +69,9 @@ setuptools.setup(name='haphpipe',
               'hp_multiple_align=haphpipe.stages.multiple_align:console',
               'hp_model_test=haphpipe.stages.model_test:console',
               'hp_build_tree_NG=haphpipe.stages.build_tree_NG:console',
+              # pipelines
+              'hp_run=haphpipe.stages.run:console',
+              'hp_batch=haphpipe.stages.batch:console',
           ],
       },
       zip_safe=False,
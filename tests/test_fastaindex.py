@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Tests for haphpipe.utils.fastaindex
+
+Expected files in data/ were written by samtools 1.24:
+
+    samtools faidx <fasta>
+    samtools dict -u file:<fasta> -o <name>.samtools.dict <fasta>
+
+"samtools dict" writes the same @SQ lines (SN, LN, M5 and UR) as picard
+CreateSequenceDictionary; only the @HD line differs.
+"""
+import os
+import shutil
+
+import pytest
+
+from haphpipe.utils import fastaindex
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, 'data')
+REFS = os.path.join(os.path.dirname(HERE), 'bin', 'refs')
+
+FASTAS = [
+    # Single record, 100 bases per line
+    (os.path.join(REFS, 'HIV_B.K03455.HXB2.fasta'), 'HIV_B.K03455.HXB2'),
+    # Wrapped at different widths, CRLF, lowercase and N, descriptions
+    # after the name, trailing empty line
+    (os.path.join(DATA, 'multi_crlf.fasta'), 'multi_crlf'),
+]
+
+
+def _read(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+@pytest.fixture(params=FASTAS, ids=[n for _, n in FASTAS])
+def indexed(request, tmp_path):
+    fasta, name = request.param
+    fai = str(tmp_path / 'out.fai')
+    seq_dict = str(tmp_path / 'out.dict')
+    fastaindex.write_indexes(fasta, fai, seq_dict,
+                             uri='file:%s' % os.path.basename(fasta))
+    return fasta, name, fai, seq_dict
+
+
+def test_fai_matches_samtools(indexed):
+    fasta, name, fai, _ = indexed
+    expected = os.path.join(DATA, '%s.fasta.fai' % name)
+    assert _read(fai) == _read(expected)
+
+
+def test_dict_matches_samtools(indexed):
+    fasta, name, _, seq_dict = indexed
+    expected = os.path.join(DATA, '%s.samtools.dict' % name)
+    lines = _read(seq_dict).decode().splitlines(True)
+    exp_lines = _read(expected).decode().splitlines(True)
+    assert lines[0] == fastaindex.DICT_HEADER
+    assert lines[1:] == [l for l in exp_lines if l.startswith('@SQ')]
+
+
+def test_hxb2_length():
+    seqs = fastaindex.read_index(FASTAS[0][0])
+    assert [(s.name, s.length) for s in seqs] == [('HIV_B.K03455.HXB2', 9719)]
+
+
+def test_default_uri_is_absolute_path(tmp_path):
+    fasta = str(tmp_path / 'ref.fasta')
+    shutil.copy(FASTAS[0][0], fasta)
+    seq_dict = str(tmp_path / 'ref.dict')
+    fastaindex.write_indexes(fasta, seq_dict=seq_dict)
+    assert ('UR:file:%s\n' % fasta) in _read(seq_dict).decode()
+
+
+def test_uneven_lines_rejected(tmp_path):
+    fasta = str(tmp_path / 'bad.fasta')
+    with open(fasta, 'w') as outh:
+        outh.write('>s1\nACGT\nAC\nACGT\n')
+    with pytest.raises(fastaindex.FastaIndexError):
+        fastaindex.write_indexes(fasta, str(tmp_path / 'bad.fai'))
+
+
+def test_duplicate_names(tmp_path):
+    fasta = str(tmp_path / 'dup.fasta')
+    with open(fasta, 'w') as outh:
+        outh.write('>s1\nACGT\n>s1\nGGCC\n')
+    # samtools keeps the first sequence, picard refuses
+    fai = str(tmp_path / 'dup.fai')
+    fastaindex.write_indexes(fasta, fai)
+    assert _read(fai) == b's1\t4\t4\t4\t5\n'
+    with pytest.raises(fastaindex.FastaIndexError):
+        fastaindex.write_indexes(fasta, seq_dict=str(tmp_path / 'dup.dict'))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Tests for haphpipe.utils.markdup
+
+data/markdup.samtools_1.24.stats.txt was written by samtools 1.24 for 40
+distinct pairs, 7 duplicates of them, 10 distinct single reads, 3
+duplicates of them and 2 unmapped reads:
+
+    samtools fixmate -m | samtools sort | samtools markdup -s -f <stats>
+"""
+import os
+import math
+
+import pytest
+
+from haphpipe.utils import markdup
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+STATS = os.path.join(DATA, 'markdup.samtools_1.24.stats.txt')
+
+# The same counts as written by samtools 1.9 (no colons, misspelled)
+STATS_1_9 = '''READ 109 WRITTEN 109 EXCLUDED 2 EXAMINED 107
+PAIRED 94 SINGLE 13
+DULPICATE PAIR 14 DUPLICATE SINGLE 3
+DUPLICATE TOTAL 17
+'''
+
+EXPECTED = {
+    'LIBRARY': '1',
+    'UNPAIRED_READS_EXAMINED': 13,
+    'READ_PAIRS_EXAMINED': 47,
+    'SECONDARY_OR_SUPPLEMENTARY_RDS': 0,
+    'UNMAPPED_READS': 2,
+    'UNPAIRED_READ_DUPLICATES': 3,
+    'READ_PAIR_DUPLICATES': 7,
+    'READ_PAIR_OPTICAL_DUPLICATES': 0,
+    'PERCENT_DUPLICATION': 17 / 107.0,
+    # Reported by samtools 1.24 in the same file
+    'ESTIMATED_LIBRARY_SIZE': 141,
+}
+
+
+def test_parse_stats():
+    with open(STATS, 'r') as fh:
+        stats = markdup.parse_markdup_stats(fh.read())
+    assert stats['PAIRED'] == 94
+    assert stats['DUPLICATE PAIR'] == 14
+    assert stats['DUPLICATE SINGLE'] == 3
+    assert stats['EXCLUDED'] == 2
+
+
+def test_parse_stats_1_9():
+    stats = markdup.parse_markdup_stats(STATS_1_9)
+    assert stats['DUPLICATE PAIR'] == 14
+    assert stats['SINGLE'] == 13
+
+
+def test_write_metrics(tmp_path):
+    metrics_file = str(tmp_path / 'metrics.txt')
+    metrics = markdup.write_metrics(STATS, metrics_file, '1', 'samtools markdup')
+    assert metrics == pytest.approx(EXPECTED)
+    with open(metrics_file, 'r') as fh:
+        lines = fh.read().split('\n')
+    i = lines.index('## METRICS CLASS\tpicard.sam.DuplicationMetrics')
+    assert lines[i + 1].split('\t') == markdup.METRICS_COLUMNS
+    assert lines[i + 2].split('\t') == [
+        '1', '13', '47', '0', '2', '3', '7', '0', '0.158879', '141',
+    ]
+
+
+def test_library_size_matches_samtools():
+    with open(STATS, 'r') as fh:
+        stats = markdup.parse_markdup_stats(fh.read())
+    assert markdup.estimate_library_size(47, 40) == \
+        stats['ESTIMATED_LIBRARY_SIZE']
+
+
+@pytest.mark.parametrize('pairs,unique', [
+    (47, 40), (1000, 999), (10**6, 5 * 10**5), (10**8, 10**6),
+])
+def test_library_size_solves_equation(pairs, unique):
+    # picard: unique / size = 1 - exp(-pairs / size), rounded down
+    f = lambda x: unique / float(x) - 1 + math.exp(-pairs / float(x))
+    size = markdup.estimate_library_size(pairs, unique)
+    assert f(size) >= 0 >= f(size + 1)
+
+
+def test_library_size_without_duplicates():
+    assert markdup.estimate_library_size(100, 100) is None
+    assert markdup.estimate_library_size(0, 0) is None
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Tests for merging bowtie2 summaries in haphpipe.utils.sharding
+
+Summaries are in the format written by bowtie2 2.3 (see bt2_summary()),
+which leaves out the paired or unpaired part when there are no such reads.
+"""
+import pytest
+
+from haphpipe.utils import sharding
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+PAIRED_KEYS = ['conc0', 'conc1', 'concM', 'disc1', 'mate0', 'mate1', 'mateM', ]
+UNPAIRED_KEYS = ['unp0', 'unp1', 'unpM', ]
+
+# Shard with pairs and unpaired reads (-1, -2 and -U), and a warning
+SHARD_BOTH = '''Warning: skipping read 'r17' because it was < 2 characters long
+1200 reads; of these:
+  1000 (83.33%) were paired; of these:
+    100 (10.00%) aligned concordantly 0 times
+    850 (85.00%) aligned concordantly exactly 1 time
+    50 (5.00%) aligned concordantly >1 times
+    ----
+    100 pairs aligned concordantly 0 times; of these:
+      20 (20.00%) aligned discordantly 1 time
+    ----
+    80 pairs aligned 0 times concordantly or discordantly; of these:
+      160 mates make up the pairs; of these:
+        120 (75.00%) aligned 0 times
+        30 (18.75%) aligned exactly 1 time
+        10 (6.25%) aligned >1 times
+  200 (16.67%) were unpaired; of these:
+    40 (20.00%) aligned 0 times
+    150 (75.00%) aligned exactly 1 time
+    10 (5.00%) aligned >1 times
+92.73% overall alignment rate
+'''
+
+SHARD_PAIRED = '''500 reads; of these:
+  500 (100.00%) were paired; of these:
+    50 (10.00%) aligned concordantly 0 times
+    400 (80.00%) aligned concordantly exactly 1 time
+    50 (10.00%) aligned concordantly >1 times
+    ----
+    50 pairs aligned concordantly 0 times; of these:
+      10 (20.00%) aligned discordantly 1 time
+    ----
+    40 pairs aligned 0 times concordantly or discordantly; of these:
+      80 mates make up the pairs; of these:
+        60 (75.00%) aligned 0 times
+        15 (18.75%) aligned exactly 1 time
+        5 (6.25%) aligned >1 times
+94.00% overall alignment rate
+'''
+
+SHARD_UNPAIRED = '''100 reads; of these:
+  100 (100.00%) were unpaired; of these:
+    10 (10.00%) aligned 0 times
+    80 (80.00%) aligned exactly 1 time
+    10 (10.00%) aligned >1 times
+90.00% overall alignment rate
+'''
+
+MERGED = '''Warning: skipping read 'r17' because it was < 2 characters long
+1800 reads; of these:
+  1500 (83.33%) were paired; of these:
+    150 (10.00%) aligned concordantly 0 times
+    1250 (83.33%) aligned concordantly exactly 1 time
+    100 (6.67%) aligned concordantly >1 times
+    ----
+    150 pairs aligned concordantly 0 times; of these:
+      30 (20.00%) aligned discordantly 1 time
+    ----
+    120 pairs aligned 0 times concordantly or discordantly; of these:
+      240 mates make up the pairs; of these:
+        180 (75.00%) aligned 0 times
+        45 (18.75%) aligned exactly 1 time
+        15 (6.25%) aligned >1 times
+  300 (16.67%) were unpaired; of these:
+    50 (16.67%) aligned 0 times
+    230 (76.67%) aligned exactly 1 time
+    20 (6.67%) aligned >1 times
+93.03% overall alignment rate
+'''
+
+
+def bt2_summary(paired=None, unpaired=None):
+    """ Summary written by bowtie2 for the given counts """
+    pct = lambda n, d: 100.0 * n / d if d else 0.0
+    npairs = sum(paired[k] for k in ['conc0', 'conc1', 'concM']) if paired else 0
+    nunp = sum(unpaired.values()) if unpaired else 0
+    ret = ['%d reads; of these:' % (npairs + nunp)]
+    aligned = 0
+    if paired:
+        p = paired
+        pairs0 = p['conc0'] - p['disc1']
+        ret += [
+            '  %d (%.2f%%) were paired; of these:' % (npairs, pct(npairs, npairs + nunp)),
+            '    %d (%.2f%%) aligned concordantly 0 times' % (p['conc0'], pct(p['conc0'], npairs)),
+            '    %d (%.2f%%) aligned concordantly exactly 1 time' % (p['conc1'], pct(p['conc1'], npairs)),
+            '    %d (%.2f%%) aligned concordantly >1 times' % (p['concM'], pct(p['concM'], npairs)),
+            '    ----',
+            '    %d pairs aligned concordantly 0 times; of these:' % p['conc0'],
+            '      %d (%.2f%%) aligned discordantly 1 time' % (p['disc1'], pct(p['disc1'], p['conc0'])),
+            '    ----',
+            '    %d pairs aligned 0 times concordantly or discordantly; of these:' % pairs0,
+            '      %d mates make up the pairs; of these:' % (2 * pairs0),
+            '        %d (%.2f%%) aligned 0 times' % (p['mate0'], pct(p['mate0'], 2 * pairs0)),
+            '        %d (%.2f%%) aligned exactly 1 time' % (p['mate1'], pct(p['mate1'], 2 * pairs0)),
+            '        %d (%.2f%%) aligned >1 times' % (p['mateM'], pct(p['mateM'], 2 * pairs0)),
+        ]
+        aligned += 2 * npairs - p['mate0']
+    if unpaired:
+        u = unpaired
+        ret += [
+            '  %d (%.2f%%) were unpaired; of these:' % (nunp, pct(nunp, npairs + nunp)),
+            '    %d (%.2f%%) aligned 0 times' % (u['unp0'], pct(u['unp0'], nunp)),
+            '    %d (%.2f%%) aligned exactly 1 time' % (u['unp1'], pct(u['unp1'], nunp)),
+            '    %d (%.2f%%) aligned >1 times' % (u['unpM'], pct(u['unpM'], nunp)),
+        ]
+        aligned += nunp - u['unp0']
+    ret.append('%.2f%% overall alignment rate' % pct(aligned, 2 * npairs + nunp))
+    return '\n'.join(ret) + '\n'
+
+
+def _paired(*v):
+    return dict(zip(PAIRED_KEYS, v))
+
+
+def _unpaired(*v):
+    return dict(zip(UNPAIRED_KEYS, v))
+
+
+def _sum(dicts):
+    dicts = [d for d in dicts if d]
+    if not dicts:
+        return None
+    return {k: sum(d[k] for d in dicts) for k in dicts[0]}
+
+
+def test_renderer_matches_shard():
+    assert bt2_summary(
+        _paired(100, 850, 50, 20, 120, 30, 10), _unpaired(40, 150, 10)
+    ) == SHARD_BOTH.split('\n', 1)[1]
+
+
+def test_merge_mixed_shards():
+    merged = sharding.merge_bt2_summaries(
+        [SHARD_BOTH, SHARD_PAIRED, SHARD_UNPAIRED]
+    )
+    assert merged == MERGED
+
+
+def test_merge_unpaired_first():
+    # Unpaired part comes after the paired part, whichever shard has it first
+    merged = sharding.merge_bt2_summaries(
+        [SHARD_UNPAIRED, SHARD_PAIRED, SHARD_BOTH]
+    )
+    assert merged == MERGED
+
+
+@pytest.mark.parametrize('shards', [
+    [(_paired(10, 80, 10, 2, 10, 4, 2), None)] * 4,
+    [(None, _unpaired(5, 90, 5)), (None, _unpaired(0, 100, 0))],
+    [(_paired(10, 80, 10, 2, 10, 4, 2), _unpaired(5, 90, 5)),
+     (_paired(0, 100, 0, 0, 0, 0, 0), None),
+     (None, _unpaired(3, 7, 0))],
+])
+def test_merge_equals_summary_of_all_reads(shards):
+    texts = [bt2_summary(p, u) for p, u in shards]
+    expected = bt2_summary(_sum([p for p, _ in shards]),
+                           _sum([u for _, u in shards]))
+    assert sharding.merge_bt2_summaries(texts) == expected
+
+
+def test_messages_without_summary():
+    # A shard that failed before writing its summary
+    text = 'Error: reads file does not look like a FASTQ file\n'
+    assert sharding.merge_bt2_summaries([text]) == text